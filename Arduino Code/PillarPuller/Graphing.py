@@ -1,57 +1,44 @@
+import argparse
 import serial
 import matplotlib.pyplot as plt
 from matplotlib.animation import FuncAnimation
 import numpy as np
+from lineparser import LineParser
+from dsp import Decimate
 
 # Constants
 SERIAL_PORT = 'COM10'
 BAUD_RATE = 115200
+DISPLAY_DECIMATION = 16 # Plot one (anti-aliased) point per 16 samples, about 100 per second
 TIME_RANGE = 1000000 # 1 seconds in micro seconds
 
-# Initialize serial connection
-ser = serial.Serial(SERIAL_PORT, BAUD_RATE)
-
-# Initialise subplots
-fig, ax = plt.subplots()
-
-# Initialize lines (empty at the start)
-line1, = ax.plot([], [], label='Platform Distances')
-line2, = ax.plot([], [], label='Forces')
-ax.legend(loc='upper left')
-ax.set_title('Pillar Puller Data')
+# The serial port and the figure are opened in main, so importing this file has no side effects
+ser = None
+parser = LineParser(columns=3)
 
 # Initialise empty lists to store data
 micros = []
 forces = []
 platformDistances = []
 
-# Initialize a counter to plot every x data points.
-counter = 0
+# Low pass filters and keeps every DISPLAY_DECIMATION-th sample, carrying its state between reads
+decimator = Decimate(DISPLAY_DECIMATION)
 
 # Create a function to read and process data from Teensy
 def animate(frame):
-    global micros, forces, platformDistances, counter  # Declare global variables
-
-    # Flush the input buffer to clear old data
-    ser.reset_input_buffer()
-
-    # Read data from the serial connection
-    line = ser.readline().decode('utf-8').strip()  # Decode line from the serial port.
-    sensorValues = line.split(',')
-
-    # Parsing and saving lines of data
-    current_time = float(sensorValues[0])
-    force = float(sensorValues[1])
-    platform_distance = float(sensorValues[2])
+    global micros, forces, platformDistances  # Declare global variables
 
-    # Increment the counter
-    counter += 1
+    # Read everything buffered since the last frame instead of flushing it, so the parser keeps its place in the stream
+    samples, status = parser.read(ser)
+    if len(samples) == 0:
+        return line1, line2
 
-     # Only append every 2nd value
-    if counter % 2 == 0:
-        micros.append(current_time)
-        forces.append(force)
-        platformDistances.append(platform_distance)
+    # Every sample goes through the decimator, so nothing between frames is skipped or aliased
+    times, values = decimator.process(samples[:, 0], samples[:, 1:])
+    if len(times) > 0:
+        micros.extend(times.tolist())
+        forces.extend(values[:, 0].tolist())
+        platformDistances.extend(values[:, 1].tolist())
 
         # Limit the number of displayed points
         max_points = 100  # Adjust this value based on your needs
@@ -94,5 +81,22 @@ def animate(frame):
 
     return line1, line2
 
-ani = FuncAnimation(fig, animate, interval=20, blit=False, frames = 5000)  # 20ms draw freq
-plt.show()
\ No newline at end of file
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Plot the pillar puller's forces and platform position live")
+    arg_parser.add_argument('--port', default=SERIAL_PORT)
+    args = arg_parser.parse_args()
+
+    # Initialize serial connection
+    ser = serial.Serial(args.port, BAUD_RATE)
+
+    # Initialise subplots
+    fig, ax = plt.subplots()
+
+    # Initialize lines (empty at the start)
+    line1, = ax.plot([], [], label='Platform Distances')
+    line2, = ax.plot([], [], label='Forces')
+    ax.legend(loc='upper left')
+    ax.set_title('Pillar Puller Data')
+
+    ani = FuncAnimation(fig, animate, interval=20, blit=False, frames = 5000)  # 20ms draw freq
+    plt.show()
\ No newline at end of file
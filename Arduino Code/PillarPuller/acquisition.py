@@ -0,0 +1,285 @@
+import itertools
+import logging
+import multiprocessing
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+import numpy as np
+from breakdetect import BreakDetector, BreakEvent
+from device import DeviceSession
+from metrics import Metrics
+from ringbuffer import SharedRingBuffer
+from telemetry import StreamDecoder
+
+logger = logging.getLogger(__name__)
+
+# Acquisition in its own process. The GUI's reader thread shares the interpreter lock with
+# Tk and matplotlib, so a slow redraw can keep it from reading long enough for the OS serial
+# buffer to overflow. Here a worker process owns the port instead:
+#
+#   worker process:  DeviceSession -> StreamDecoder -> SharedRingBuffer (producer)
+#                                                   -> BreakDetector (sends "stop" itself)
+#   GUI process:     SharedRingBuffer (mapped, read in place) -> buffer.process() -> channels, graph, recorders
+#
+# Commands, status lines, break events, the connection state and the worker's metrics go
+# over a multiprocessing Pipe. The samples never do: the GUI reads them straight out of
+# the shared block, and however long it stalls the worker keeps reading. Samples are only
+# lost to the GUI's filtered channels if it falls a whole ring buffer behind; the ring
+# spills to disk in the worker as before, so the recording is complete either way. The
+# worker deletes the spill when it is closed, unless keep_spill is set; if the GUI dies
+# instead, the worker writes out what it still holds so it can be recovered.
+STATE_INTERVAL = 0.05  # Seconds between checks of the worker's connection state
+METRICS_INTERVAL = 1.0  # Seconds between metrics snapshots sent by the worker
+
+# Function run in the worker process.
+def run_acquisition(conn, port, baudrate, ring_name, capacity, spill_dir, spill_max_bytes, keep_spill, read_timeout):
+    samples = SharedRingBuffer(capacity, name=ring_name, producer=True, spill_dir=spill_dir, spill_max_bytes=spill_max_bytes)
+    _Acquirer(conn, port, baudrate, samples, read_timeout).run(keep_spill)
+
+class _Acquirer():
+    ''' The worker process' side: what a DeviceSession needs of a buffer, plus the pipe to the GUI '''
+    def __init__(self, conn, port, baudrate, samples, read_timeout):
+        self.conn = conn
+        self.samples = samples
+        self.decoder = StreamDecoder(columns=4)
+        self.break_detector = BreakDetector(force_column=3)
+        self.stop_on_break = False
+        self.metrics = Metrics()
+        self.session = DeviceSession(self, port, baudrate, read_timeout=read_timeout, metrics=self.metrics)
+        self._send_lock = threading.Lock()
+
+    def send(self, *message):
+        try:
+            with self._send_lock:
+                self.conn.send(message)
+        except (OSError, EOFError):
+            pass  # The GUI has gone, run() notices and stops
+
+    # Called by the session with every block it reads from the port
+    def ingest(self, samples, status):
+        if len(samples) > 0:
+            self.samples.extend(samples)
+            event = self.break_detector.feed(samples)
+            if event is not None:
+                stopped = self.stop_on_break
+                if stopped:
+                    self.stop_on_break = False
+                    self.session.submit("stop")
+                self.send('break', vars(event), stopped)
+        if status:
+            self.send('status', status)
+
+    def run(self, keep_spill=False):
+        self.session.start()
+        state = None
+        closed = False
+        next_metrics = time.monotonic() + METRICS_INTERVAL
+        try:
+            while True:
+                if self.conn.poll(STATE_INTERVAL):
+                    message = self.conn.recv()
+                    kind = message[0]
+                    if kind == 'command':
+                        self._command(*message[1:])
+                    elif kind == 'stop_on_break':
+                        self.stop_on_break = message[1]
+                    elif kind == 'reset_break':
+                        self.break_detector.reset()
+                    elif kind == 'close':
+                        closed = True
+                        break
+                current = (self.session.connected, self.session.ever_connected, self.session.reconnects, self.decoder.binary)
+                if current != state:
+                    state = current
+                    self.send('state', *state)
+                if time.monotonic() >= next_metrics:
+                    next_metrics += METRICS_INTERVAL
+                    self.send('metrics', self.metrics.snapshot())
+        except (EOFError, OSError):
+            pass  # The GUI process ended without closing us
+        finally:
+            self.session.close()
+            if closed and not keep_spill:
+                self.samples.discard_spill()
+            else:
+                self.samples.flush()
+            self.samples.close()
+
+    def _command(self, number, command, expect, timeout):
+        def done(future):
+            error = future.exception()
+            self.send('done', number, None if error is not None else future.result(), None if error is None else repr(error))
+        self.session.submit(command, expect=expect, timeout=timeout).add_done_callback(done)
+
+class RemoteBreakDetector():
+    ''' Stands in for the BreakDetector of a buffer whose breaks are detected in the acquisition process '''
+    def __init__(self, session):
+        self.session = session
+        self.event = None
+
+    @property
+    def triggered(self):
+        return self.event is not None
+
+    def reset(self):
+        self.event = None
+        self.session.reset_break()
+
+    # The samples are watched in the worker, there is nothing to do here
+    def feed(self, block):
+        return None
+
+class AcquisitionProcess():
+    ''' Runs a rig's DeviceSession in a worker process. Has the same interface as DeviceSession.
+
+    samples is the SharedRingBuffer the worker fills. A follower thread in this process
+    reads what is new every FOLLOW_INTERVAL and hands it to buffer.process(samples,
+    status); breaks found by the worker go to buffer.on_break(event) and set
+    buffer.break_detector.event. Set stop_on_break with set_stop_on_break(), so the
+    worker sends "stop" the moment it sees the break without waiting for this process.
+    '''
+    FOLLOW_INTERVAL = 0.02
+
+    def __init__(self, buffer, port, baudrate, capacity=200000, spill_dir=None, spill_max_bytes=None, keep_spill=False, read_timeout=0.05):
+        self.buffer = buffer
+        self.port = port
+        self.baudrate = baudrate
+        self.read_timeout = read_timeout
+        self.capacity = capacity
+        self.spill_dir = spill_dir
+        self.spill_max_bytes = spill_max_bytes
+        self.keep_spill = keep_spill
+        self.samples = SharedRingBuffer(capacity)
+        self.latencies = {}  # Command name -> deque of recent latencies in seconds, submit to the worker reporting it written
+        self.reconnects = 0
+        self.binary = False
+        self.remote_metrics = None  # The worker's latest Metrics snapshot (reader.* and commands.*)
+        self._connected = False
+        self._ever_connected = False
+        self._process = None
+        self._conn = None
+        self._thread = None
+        self._running = False
+        self._closing = False
+        self._send_lock = threading.Lock()
+        self._pending = {}  # Command number -> (name, submitted, Future)
+        self._numbers = itertools.count()
+        self._position = 0  # How far into the ring the follower has read
+
+    @property
+    def connected(self):
+        return self._connected
+
+    @property
+    def ever_connected(self):
+        return self._ever_connected
+
+    # Function to start the worker process and the follower thread.
+    def start(self):
+        context = multiprocessing.get_context('spawn')  # Never fork a process that has threads running
+        self._conn, child = context.Pipe()
+        self._process = context.Process(target=run_acquisition, name=f'acquisition {self.port}', daemon=True,
+                                        args=(child, self.port, self.baudrate, self.samples.name, self.capacity, self.spill_dir,
+                                              self.spill_max_bytes, self.keep_spill, self.read_timeout))
+        self._process.start()
+        child.close()
+        self._position = self.samples.total
+        self._running = True
+        self._thread = threading.Thread(target=self._follow, daemon=True, name=f'follow {self.port}')
+        self._thread.start()
+
+    # Function to stop the worker, which closes the port and deletes (or with keep_spill, completes) the spill, then release the ring.
+    def close(self, timeout=2.0):
+        self._closing = True
+        if self._process is not None:
+            self._send('close')
+            self._process.join(timeout)
+            if self._process.is_alive():
+                self._process.terminate()
+                self._process.join(timeout)
+        self._running = False
+        if self._thread is not None:
+            self._thread.join(timeout)
+        if self._conn is not None:
+            self._conn.close()
+        self._fail_pending(ConnectionError(f"Acquisition of {self.port} was closed"))
+        self.samples.close()
+
+    # Function to send a command from any thread. Returns a Future resolving to the latency in seconds.
+    def submit(self, command, expect=None, timeout=2.0):
+        future = Future()
+        number = next(self._numbers)
+        name = command.split()[0] if command.strip() else command
+        self._pending[number] = (name, time.perf_counter(), future)
+        if not self._send('command', number, command, expect, timeout):
+            self._pending.pop(number, None)
+            future.set_exception(ConnectionError(f"Acquisition of {self.port} is not running"))
+        return future
+
+    def set_stop_on_break(self, enabled):
+        self._send('stop_on_break', enabled)
+
+    def reset_break(self):
+        self._send('reset_break')
+
+    def _send(self, *message):
+        try:
+            with self._send_lock:
+                self._conn.send(message)
+            return True
+        except (OSError, EOFError, AttributeError):
+            return False
+
+    def _follow(self):
+        names = self.samples.dtype.names
+        while self._running:
+            status = []
+            try:
+                while self._conn.poll(self.FOLLOW_INTERVAL if not status else 0):
+                    self._handle(self._conn.recv(), status)
+            except (EOFError, OSError):
+                if not self._closing:
+                    logger.error(f"Acquisition process for {self.port} ended")
+                self._connected = False
+                self._fail_pending(ConnectionError(f"Acquisition process for {self.port} ended"))
+                self._running = False
+            block, self._position, lost = self.samples.read_since(self._position)
+            if lost:
+                logger.warning(f"{self.port}: the GUI fell {lost} samples behind the acquisition process")
+            if len(block) or status:
+                # Back to the (n, columns) float layout the session hands to ingest
+                samples = np.column_stack([block[name] for name in names]) if len(block) else np.empty((0, len(names)))
+                self.buffer.process(samples, status)
+
+    def _handle(self, message, status):
+        kind = message[0]
+        if kind == 'done':
+            number, latency, error = message[1:]
+            name, submitted, future = self._pending.pop(number, (None, None, None))
+            if future is None:
+                return
+            if error is not None:
+                future.set_exception(RuntimeError(error))
+                return
+            latency = time.perf_counter() - submitted
+            self.latencies.setdefault(name, deque(maxlen=1000)).append(latency)
+            future.set_result(latency)
+        elif kind == 'status':
+            status.extend(message[1])
+        elif kind == 'break':
+            event, stopped = BreakEvent(**message[1]), message[2]
+            if stopped:
+                self.buffer.stop_on_break = False  # The worker already sent "stop"
+            self.buffer.break_detector.event = event
+            self.buffer.on_break(event)
+        elif kind == 'state':
+            self._connected, self._ever_connected, self.reconnects, self.binary = message[1:]
+        elif kind == 'metrics':
+            self.remote_metrics = message[1]
+
+    def _fail_pending(self, error):
+        pending, self._pending = self._pending, {}
+        for name, submitted, future in pending.values():
+            if not future.done():
+                future.set_exception(error)
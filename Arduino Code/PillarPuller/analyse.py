@@ -0,0 +1,182 @@
+import argparse
+import concurrent.futures
+import csv
+import glob
+import hashlib
+import json
+import os
+import time
+import numpy as np
+from breakdetect import BreakDetector
+from session import load, time_units
+from timebase import detect_units
+
+# Batch post-processing of recorded pulls.
+#
+#   python analyse.py                          every pillar_puller_*.csv in this folder
+#   python analyse.py data/*.csv --out pulls.csv
+#
+# Sessions are analysed in a process pool. Results are cached in CACHE_FILE keyed on
+# each file's mtime, size and SHA-1, so re-running over a growing archive only analyses
+# new or changed files. Recordings that can't be read are reported and skipped.
+CACHE_FILE = '.analysis_cache.json'
+METRICS_VERSION = 2  # Bump when the metrics change, to invalidate the cache
+BASELINE_SAMPLES = 1000  # Samples at the start of a pull used for the force offset and noise floor
+
+FIELDS = ['file', 'rows', 'duration_s', 'baseline_force', 'noise_floor', 'peak_force', 'peak_position',
+          'break_detected', 'break_force', 'break_position', 'stiffness', 'energy_to_break']
+
+# Function to work out the pull metrics of one recording. Forces are in the firmware's units, positions in mm.
+# units is how many time units the recording counts per second (session.time_units), worked out from its time stamps if not given.
+def pull_metrics(samples, units=None):
+    force = np.asarray(samples['force'], dtype=np.float64)
+    position = np.asarray(samples['position'], dtype=np.float64)
+    t = np.asarray(samples['time'], dtype=np.float64)
+    n = len(force)
+    metrics = {name: float('nan') for name in FIELDS[1:]}
+    metrics['rows'] = n
+    metrics['break_detected'] = False
+    if n < 2:
+        return metrics
+
+    units = detect_units(t) if units is None else units
+    metrics['duration_s'] = float((t[-1] - t[0]) / units)
+    head = force[:min(BASELINE_SAMPLES, n)]
+    baseline = float(np.median(head))
+    metrics['baseline_force'] = baseline
+    metrics['noise_floor'] = float(np.std(head))
+
+    peak = int(np.argmax(force))
+    metrics['peak_force'] = float(force[peak])
+    metrics['peak_position'] = float(position[peak])
+
+    detector = BreakDetector(force_column=1, position_column=2, time_column=0)
+    event = detector.feed(np.column_stack((t, force, position)))
+    end = peak
+    if event is not None:
+        metrics['break_detected'] = True
+        metrics['break_force'] = event.peak_force
+        metrics['break_position'] = event.position
+        end = event.index
+
+    # Loading segment: from the start to the break (or peak). Only meaningful if the platform moved.
+    load_force = force[:end + 1] - baseline
+    load_position = position[:end + 1]
+    if np.ptp(load_position) > 0.01:
+        metrics['stiffness'] = float(np.polyfit(load_position, load_force, 1)[0])
+        metrics['energy_to_break'] = float(np.trapezoid(load_force, load_position) if hasattr(np, 'trapezoid')
+                                           else np.trapz(load_force, load_position))
+    return metrics
+
+def analyse_file(path):
+    samples = load(path)
+    metrics = pull_metrics(samples, time_units(path, samples['time']))
+    metrics['file'] = os.path.basename(path.rstrip(os.sep))
+    return metrics
+
+# Function returning the files a recording is made of: the file itself, or a session's meta.json and column files.
+# Anything else in a session directory (e.g. a pyramid left there by an older history.py) isn't part of the recording.
+def recording_files(path):
+    if not os.path.isdir(path):
+        return [path]
+    return sorted(os.path.join(path, name) for name in os.listdir(path) if name == 'meta.json' or name.endswith('.bin'))
+
+def file_hash(path):
+    sha = hashlib.sha1()
+    for p in recording_files(path):
+        with open(p, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                sha.update(chunk)
+    return sha.hexdigest()
+
+# Function returning what changes when a recording is written to: [mtime, size] of a file, or for a session
+# directory the latest mtime and total size of its meta.json and column files (the directory's own mtime stays
+# put as columns grow, and changes when anything else is put in it).
+def file_stamp(path):
+    if not os.path.isdir(path):
+        stat = os.stat(path)
+        return [stat.st_mtime, stat.st_size]
+    stats = [os.stat(p) for p in recording_files(path)]
+    return [max((stat.st_mtime for stat in stats), default=os.path.getmtime(path)), sum(stat.st_size for stat in stats)]
+
+def load_cache(path):
+    try:
+        with open(path) as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return cache if cache.get('version') == METRICS_VERSION else {}
+
+def save_cache(path, cache):
+    cache['version'] = METRICS_VERSION
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(cache, f)
+    os.replace(tmp, path)
+
+# Function to analyse many recordings. Returns a list of metric dicts in the order of paths, how many had to be
+# analysed, and {path: error} for recordings that couldn't be read, which are left out of the list.
+def analyse(paths, cache_path=CACHE_FILE, workers=None):
+    cache = load_cache(cache_path)
+    entries = cache.setdefault('files', {})
+    results = {}
+    skipped = {}
+    todo = {}
+    try:
+        for path in paths:
+            key = os.path.abspath(path)
+            try:
+                stamp = file_stamp(path)
+                entry = entries.get(key)
+                if entry is not None and entry.get('stamp') == stamp:
+                    results[path] = entry['metrics']
+                    continue
+                digest = file_hash(path)
+            except OSError as e:
+                skipped[path] = e
+                continue
+            if entry is not None and entry['sha1'] == digest:
+                entry['stamp'] = stamp  # Touched but not changed
+                results[path] = entry['metrics']
+                continue
+            todo[path] = (key, stamp, digest)
+
+        if todo:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+                futures = {pool.submit(analyse_file, path): path for path in todo}
+                for future in concurrent.futures.as_completed(futures):
+                    path = futures[future]
+                    key, stamp, digest = todo[path]
+                    try:
+                        results[path] = future.result()
+                    except Exception as e:  # One unreadable or malformed recording mustn't lose the rest
+                        skipped[path] = e
+                        continue
+                    entries[key] = {'stamp': stamp, 'sha1': digest, 'metrics': results[path]}
+    finally:
+        save_cache(cache_path, cache)
+    return [results[path] for path in paths if path in results], len(todo), skipped
+
+def write_summary(rows, path):
+    with open(path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=FIELDS)
+        writer.writeheader()
+        for row in rows:
+            writer.writerow({name: row[name] for name in FIELDS})
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Extract pull metrics from recorded sessions")
+    arg_parser.add_argument('files', nargs='*', help="CSV files or session directories (default: pillar_puller_*.csv here)")
+    arg_parser.add_argument('--out', default='summary.csv', help="summary table to write")
+    arg_parser.add_argument('--cache', default=CACHE_FILE)
+    arg_parser.add_argument('--workers', type=int, default=None)
+    args = arg_parser.parse_args()
+
+    files = args.files or sorted(glob.glob(os.path.join(os.path.dirname(__file__) or '.', 'pillar_puller_*.csv')))
+    start = time.perf_counter()
+    rows, analysed, skipped = analyse(files, args.cache, args.workers)
+    write_summary(rows, args.out)
+    print(f'{len(rows)} sessions ({analysed - len(skipped)} analysed, {len(rows) - analysed + len(skipped)} from cache) in '
+          f'{time.perf_counter() - start:.2f} s, summary written to {args.out}')
+    for path, error in skipped.items():
+        print(f'Skipped {path}: {error}')
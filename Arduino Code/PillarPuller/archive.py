@@ -0,0 +1,445 @@
+import argparse
+import glob
+import json
+import os
+import struct
+import time
+import zlib
+import numpy as np
+from timebase import MICROS, MILLIS, detect_units
+
+# Long-term archives: a recording in one compressed file that can still be read a piece at a time.
+#
+#   python archive.py pack pillar_puller_*.csv              one .pparc next to each recording
+#   python archive.py read pillar_puller_20240826-124612.pparc --start 40 --stop 45
+#   python archive.py bench                                 compression and read speed on the CSVs here
+#
+# Rows are stored in chunks of CHUNK_ROWS, each column of a chunk compressed on its own:
+#
+#   header    MAGIC, a uint32 length and JSON: columns, codec, quanta, chunk size, time_units, metadata
+#   chunk     CHUNK (row count, least and greatest time), then for each column COLUMN and its payload
+#   ...
+#   index     JSON list of [offset, rows, least time, greatest time] per chunk, then INDEX_TAIL
+#
+# Before compression integer columns (time) are stored as the difference from the sample
+# before, and float columns as whole numbers of their quantum (QUANTA), also differenced,
+# divided by the greatest common divisor of the differences and cut to the narrowest integer
+# type they fit. The bytes are then shuffled (all first bytes, then all second bytes...) so
+# the compressor sees long runs. A column with values that can't be quantized (NaN, huge)
+# is stored as it is. Quantizing to QUANTA is lossy by at most half a quantum, far below the
+# load cell's one count (1/600 of a unit) and the stepper's one step (1/1600 mm).
+#
+# The index gives the time range of every chunk, so reading a time range only decompresses
+# the chunks that overlap it, and only the columns asked for. If the writer never closed the
+# archive (a crash), the index is missing and the chunks are found by walking their headers.
+FORMAT_VERSION = 1
+MAGIC = b'PPARC\x00'
+INDEX_TAIL = struct.Struct('<Q6s')  # Offset of the index, MAGIC
+CHUNK = struct.Struct('<4sIqq')  # b'PPCK', rows, least and greatest time in the chunk
+COLUMN = struct.Struct('<BBqqI')  # Encoding, bytes per value, first value, scale, payload bytes
+CHUNK_MAGIC = b'PPCK'
+CHUNK_ROWS = 65536
+EXTENSION = '.pparc'
+RAW, DELTA = 0, 1  # Column encodings
+QUANTA = {  # Units per stored step of float columns
+    'force': 1e-4,
+    'filtered': 1e-4,
+    'position': 1e-5,
+    'received': 1e-6,  # Host seconds, to the microsecond
+}
+MAX_QUANTIZED = 2 ** 52  # Larger multiples of the quantum would lose precision as float64
+CODECS = ('zstd', 'lz4', 'zlib')
+
+# Function returning (compress, decompress) for a codec. zstd and lz4 are optional, zlib is always there.
+def get_codec(name):
+    if name == 'zstd':
+        try:
+            import zstandard
+        except ImportError:
+            raise ValueError("The zstd codec needs zstandard (pip install zstandard), or use zlib")
+        return zstandard.ZstdCompressor(level=3).compress, zstandard.ZstdDecompressor().decompress
+    if name == 'lz4':
+        try:
+            import lz4.frame
+        except ImportError:
+            raise ValueError("The lz4 codec needs lz4 (pip install lz4), or use zlib")
+        return lz4.frame.compress, lz4.frame.decompress
+    if name == 'zlib':
+        return (lambda data: zlib.compress(data, 6)), zlib.decompress
+    raise ValueError(f"codec must be one of {', '.join(CODECS)}, not {name}")
+
+# Function returning the best codec installed: zstd, then lz4, then zlib.
+def default_codec():
+    for name in CODECS:
+        try:
+            get_codec(name)
+            return name
+        except ValueError:
+            pass
+
+def _shuffle(values):
+    return np.ascontiguousarray(values.view(np.uint8).reshape(len(values), values.itemsize).T).tobytes()
+
+def _unshuffle(data, dtype, rows):
+    return np.frombuffer(data, dtype=np.uint8).reshape(dtype.itemsize, rows).T.copy().view(dtype).ravel()
+
+# Function to encode one column of a chunk. Returns (encoding, bytes per value, first value, scale, bytes before compression).
+def encode_column(values, quantum=None):
+    values = np.asarray(values)
+    if values.dtype.kind in 'iu':
+        steps = values.astype(np.int64)
+    elif quantum is not None and np.all(np.isfinite(values)) and np.max(np.abs(values), initial=0) / quantum < MAX_QUANTIZED:
+        steps = np.rint(values / quantum).astype(np.int64)
+    else:
+        values = values.astype(values.dtype.newbyteorder('<'))
+        return RAW, values.itemsize, 0, 0, _shuffle(values)
+    first = int(steps[0]) if len(steps) else 0
+    deltas = np.diff(steps, prepend=first)
+    scale = int(np.gcd.reduce(deltas)) or 1
+    if scale > 1:
+        deltas //= scale
+    low, high = (int(deltas.min()), int(deltas.max())) if len(deltas) else (0, 0)
+    dtype = next(np.dtype(t) for t in ('<i1', '<i2', '<i4', '<i8') if np.iinfo(t).min <= low and high <= np.iinfo(t).max)
+    return DELTA, dtype.itemsize, first, scale, _shuffle(deltas.astype(dtype))
+
+# Function to decode a column encoded by encode_column into dtype.
+def decode_column(encoding, itemsize, first, scale, data, rows, dtype, quantum=None):
+    dtype = np.dtype(dtype)
+    if encoding == RAW:
+        return _unshuffle(data, dtype.newbyteorder('<'), rows).astype(dtype)
+    deltas = _unshuffle(data, np.dtype(f'<i{itemsize}'), rows)
+    steps = np.cumsum(deltas, dtype=np.int64)
+    if scale != 1:
+        steps *= scale
+    steps += first
+    if dtype.kind in 'iu':
+        return steps.astype(dtype)
+    return (steps * quantum).astype(dtype)
+
+class ArchiveWriter():
+    ''' Appends blocks of samples to an archive file, a chunk at a time. Call close() to write the index '''
+    def __init__(self, path, dtype, codec=None, chunk_rows=CHUNK_ROWS, quanta=None, **metadata):
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self.codec = codec or default_codec()
+        self.chunk_rows = chunk_rows
+        self.quanta = {name: q for name, q in dict(QUANTA, **(quanta or {})).items() if name in self.dtype.names}
+        self.rows = 0
+        self.index = []  # [offset, rows, least time, greatest time] per chunk written
+        self._compress = get_codec(self.codec)[0]
+        self._pending = []
+        self._pending_rows = 0
+        self._file = open(path, 'xb')
+        header = {
+            'format': FORMAT_VERSION,
+            'created': time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            'columns': {name: self.dtype[name].newbyteorder('<').str for name in self.dtype.names},
+            'codec': self.codec,
+            'quanta': self.quanta,
+            'chunk_rows': chunk_rows,
+        }
+        header.update(metadata)
+        data = json.dumps(header).encode('utf-8')
+        self._file.write(MAGIC + struct.pack('<I', len(data)) + data)
+
+    # Function to append a structured array with (at least) this archive's columns.
+    def append(self, block):
+        self._pending.append(np.asarray(block)[list(self.dtype.names)])
+        self._pending_rows += len(block)
+        if self._pending_rows >= self.chunk_rows:
+            pending = np.concatenate(self._pending)
+            full = len(pending) - len(pending) % self.chunk_rows
+            for start in range(0, full, self.chunk_rows):
+                self._write_chunk(pending[start:start + self.chunk_rows])
+            self._pending = [pending[full:]]
+            self._pending_rows = len(pending) - full
+
+    def size(self):
+        return self._file.tell()
+
+    def close(self):
+        if self._file is None:
+            return
+        if self._pending_rows:
+            self._write_chunk(np.concatenate(self._pending))
+        offset = self._file.tell()
+        self._file.write(json.dumps({'rows': self.rows, 'chunks': self.index}).encode('utf-8'))
+        self._file.write(INDEX_TAIL.pack(offset, MAGIC))
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+        self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _write_chunk(self, chunk):
+        times = chunk['time'] if 'time' in self.dtype.names else np.zeros(1, dtype=np.int64)
+        offset = self._file.tell()
+        parts = [CHUNK.pack(CHUNK_MAGIC, len(chunk), int(times.min()), int(times.max()))]
+        for name in self.dtype.names:
+            encoding, itemsize, first, scale, data = encode_column(chunk[name], self.quanta.get(name))
+            data = self._compress(data)
+            parts.append(COLUMN.pack(encoding, itemsize, first, scale, len(data)))
+            parts.append(data)
+        self._file.write(b''.join(parts))
+        self.index.append([offset, len(chunk), int(times.min()), int(times.max())])
+        self.rows += len(chunk)
+
+class Archive():
+    ''' An archive opened for reading. Chunks are read and decompressed only when rows in them are asked for '''
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'rb')
+        if self._file.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not a pillar puller archive")
+        length, = struct.unpack('<I', self._file.read(4))
+        self.meta = json.loads(self._file.read(length))
+        self.dtype = np.dtype([(name, np.dtype(dt)) for name, dt in self.meta['columns'].items()])
+        self._decompress = get_codec(self.meta['codec'])[1]
+        self.chunks = self._read_index()
+        self.recovered = self.chunks is None  # True if the index was missing and the chunks had to be found
+        if self.recovered:
+            self.chunks = self._scan(len(MAGIC) + 4 + length)
+        self.rows = sum(rows for offset, rows, low, high in self.chunks)
+        self._starts = np.cumsum([0] + [rows for offset, rows, low, high in self.chunks])
+
+    @property
+    def names(self):
+        return list(self.dtype.names)
+
+    def __len__(self):
+        return self.rows
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    # Function to read rows start:stop of the given columns (default all) into one structured array.
+    def read(self, start=0, stop=None, columns=None):
+        stop = self.rows if stop is None else min(stop, self.rows)
+        names = self.names if columns is None else list(columns)
+        out = np.zeros(max(stop - start, 0), dtype=[(name, self.dtype[name]) for name in names])
+        first = max(int(np.searchsorted(self._starts, start, side='right')) - 1, 0)
+        for i in range(first, len(self.chunks)):
+            chunk_start = self._starts[i]
+            if chunk_start >= stop:
+                break
+            block = self.read_chunk(i, names)
+            low, high = max(start - chunk_start, 0), min(stop - chunk_start, len(block))
+            out[chunk_start + low - start:chunk_start + high - start] = block[low:high]
+        return out
+
+    # Function to read the rows with start <= time < stop (device time units), only decompressing the chunks that have some.
+    def read_time(self, start=None, stop=None, columns=None):
+        names = self.names if columns is None else list(columns)
+        wanted = [i for i, (offset, rows, low, high) in enumerate(self.chunks)
+                  if (start is None or high >= start) and (stop is None or low < stop)]
+        blocks = []
+        for i in wanted:
+            block = self.read_chunk(i, set(names) | {'time'})
+            keep = np.ones(len(block), dtype=bool)
+            if start is not None:
+                keep &= block['time'] >= start
+            if stop is not None:
+                keep &= block['time'] < stop
+            blocks.append(block[keep][names])
+        return np.concatenate(blocks) if blocks else np.zeros(0, dtype=[(name, self.dtype[name]) for name in names])
+
+    # Function to decompress chunk i. Columns not asked for are skipped over without being read.
+    def read_chunk(self, i, columns=None):
+        offset, rows, low, high = self.chunks[i]
+        names = self.names if columns is None else [name for name in self.names if name in columns]
+        out = np.zeros(rows, dtype=[(name, self.dtype[name]) for name in names])
+        self._file.seek(offset + CHUNK.size)
+        for name in self.names:
+            encoding, itemsize, first, scale, length = COLUMN.unpack(self._file.read(COLUMN.size))
+            if name not in names:
+                self._file.seek(length, os.SEEK_CUR)
+                continue
+            data = self._decompress(self._file.read(length))
+            out[name] = decode_column(encoding, itemsize, first, scale, data, rows, self.dtype[name], self.meta['quanta'].get(name))
+        return out
+
+    def _read_index(self):
+        end = self._file.seek(0, os.SEEK_END)
+        if end < INDEX_TAIL.size:
+            return None
+        self._file.seek(end - INDEX_TAIL.size)
+        offset, magic = INDEX_TAIL.unpack(self._file.read(INDEX_TAIL.size))
+        if magic != MAGIC:
+            return None
+        self._file.seek(offset)
+        return json.loads(self._file.read(end - INDEX_TAIL.size - offset))['chunks']
+
+    # Function to find the chunks of an archive without an index. A chunk cut short by the crash is left out.
+    def _scan(self, offset):
+        chunks = []
+        end = self._file.seek(0, os.SEEK_END)
+        while offset + CHUNK.size <= end:
+            self._file.seek(offset)
+            magic, rows, low, high = CHUNK.unpack(self._file.read(CHUNK.size))
+            if magic != CHUNK_MAGIC:
+                break
+            position = offset + CHUNK.size
+            for name in self.names:
+                if position + COLUMN.size > end:
+                    return chunks
+                self._file.seek(position)
+                position += COLUMN.size + COLUMN.unpack(self._file.read(COLUMN.size))[-1]
+            if position > end:
+                break
+            chunks.append([offset, rows, low, high])
+            offset = position
+        return chunks
+
+def open_archive(path):
+    return Archive(path)
+
+# Function to archive a recording (CSV file or session directory). Returns the archive path.
+def pack(path, archive_path=None, codec=None, chunk_rows=CHUNK_ROWS, quanta=None):
+    from session import Session, read_csv
+    if archive_path is None:
+        archive_path = os.path.splitext(path.rstrip(os.sep))[0] + EXTENSION
+    if os.path.isdir(path):
+        session = Session(path)
+        meta = {name: value for name, value in session.meta.items() if name not in ('format', 'columns', 'rows')}
+        units = session.meta.get('time_units') or detect_units(session['time'][:chunk_rows])
+        with ArchiveWriter(archive_path, session.read(0, 0).dtype, codec, chunk_rows, quanta, source=os.path.basename(path.rstrip(os.sep)),
+                           time_units=units, session=meta) as writer:
+            for start in range(0, len(session), chunk_rows):
+                writer.append(session.read(start, start + chunk_rows))
+    else:
+        samples = read_csv(path)
+        with ArchiveWriter(archive_path, samples.dtype, codec, chunk_rows, quanta, source=os.path.basename(path),
+                           time_units=detect_units(samples['time']), recorded=time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(os.path.getmtime(path)))) as writer:
+            writer.append(samples)
+    return archive_path
+
+# Function to pack recordings with each codec installed and time reading them back. Returns one dict per codec.
+def benchmark(paths, codecs=None, chunk_rows=CHUNK_ROWS, ranges=200, directory=None):
+    import tempfile
+    from session import load
+    recordings = [(path, load(path)) for path in paths]
+    source_bytes = sum(_size(path) for path, samples in recordings)
+    raw_bytes = sum(samples.nbytes for path, samples in recordings)
+    rows = sum(len(samples) for path, samples in recordings)
+    results = []
+    rng = np.random.default_rng(0)
+    with tempfile.TemporaryDirectory(dir=directory) as tmp:
+        for codec in codecs or [name for name in CODECS if _available(name)]:
+            archive_bytes, write_s, read_s, range_s, errors = 0, 0.0, 0.0, [], {}
+            for n, (path, samples) in enumerate(recordings):
+                target = os.path.join(tmp, f'{n}_{codec}{EXTENSION}')
+                start = time.perf_counter()
+                with ArchiveWriter(target, samples.dtype, codec, chunk_rows) as writer:
+                    writer.append(samples)
+                write_s += time.perf_counter() - start
+                archive_bytes += os.path.getsize(target)
+                with Archive(target) as archive:
+                    start = time.perf_counter()
+                    back = archive.read()
+                    read_s += time.perf_counter() - start
+                    for name in samples.dtype.names:
+                        error = float(np.max(np.abs(back[name] - samples[name]), initial=0))
+                        errors[name] = max(errors.get(name, 0.0), error)
+                    # Random one second windows, as a reviewer scrolling through a long recording would ask for
+                    times = samples['time']
+                    if len(times) > 1:
+                        units = detect_units(times)
+                        for low in rng.uniform(times.min(), times.max(), max(ranges // len(recordings), 1)):
+                            start = time.perf_counter()
+                            archive.read_time(int(low), int(low + units))
+                            range_s.append(time.perf_counter() - start)
+            results.append({
+                'codec': codec,
+                'rows': rows,
+                'source_mb': source_bytes / 1e6,
+                'archive_mb': archive_bytes / 1e6,
+                'ratio_vs_source': source_bytes / archive_bytes,
+                'ratio_vs_binary': raw_bytes / archive_bytes,
+                'write_mrows_s': rows / write_s / 1e6,
+                'read_mrows_s': rows / read_s / 1e6,
+                'read_mb_s': raw_bytes / read_s / 1e6,
+                'range_read_ms_p50': float(np.median(range_s)) * 1000 if range_s else None,
+                'max_error': errors,
+            })
+    return results
+
+def _available(codec):
+    try:
+        get_codec(codec)
+        return True
+    except ValueError:
+        return False
+
+def _size(path):
+    if os.path.isdir(path):
+        return sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+    return os.path.getsize(path)
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Pack recordings into compressed archives, read them back, or benchmark the format")
+    commands = arg_parser.add_subparsers(dest='command', required=True)
+    pack_parser = commands.add_parser('pack', help="archive CSV files or sessions (default: pillar_puller_*.csv in this folder)")
+    pack_parser.add_argument('files', nargs='*')
+    pack_parser.add_argument('--codec', choices=CODECS, default=None, help="default: zstd, lz4 or zlib, whichever is installed first")
+    pack_parser.add_argument('--chunk-rows', type=int, default=CHUNK_ROWS)
+    pack_parser.add_argument('--force', action='store_true', help="replace archives that already exist")
+    read_parser = commands.add_parser('read', help="print an archive's metadata, or write a time range of it as CSV")
+    read_parser.add_argument('archive')
+    read_parser.add_argument('--start', type=float, help="seconds of device time from the start of the archive")
+    read_parser.add_argument('--stop', type=float)
+    read_parser.add_argument('--units', choices=['ms', 'us'], help="what the time column counts: ms (main.cpp's millis()) or us (the older "
+                             "PillarPuller.ino's micros()). Default: as stored in the archive, or worked out from its time stamps")
+    read_parser.add_argument('--out', help="CSV file for the rows read (default: print how many there are)")
+    bench_parser = commands.add_parser('bench', help="compression ratio and read speed on recordings (default: the CSVs in this folder)")
+    bench_parser.add_argument('files', nargs='*')
+    bench_parser.add_argument('--codec', choices=CODECS, action='append')
+    bench_parser.add_argument('--chunk-rows', type=int, default=CHUNK_ROWS)
+    args = arg_parser.parse_args()
+
+    here = os.path.dirname(__file__) or '.'
+    if args.command == 'pack':
+        for path in args.files or sorted(glob.glob(os.path.join(here, 'pillar_puller_*.csv'))):
+            target = os.path.splitext(path.rstrip(os.sep))[0] + EXTENSION
+            if os.path.exists(target):
+                if not args.force:
+                    print(f'{target} exists, skipping')
+                    continue
+                os.remove(target)
+            start = time.perf_counter()
+            pack(path, target, args.codec, args.chunk_rows)
+            print(f'{path} -> {target}: {_size(path) / _size(target):.1f}x smaller in {time.perf_counter() - start:.2f} s')
+    elif args.command == 'read':
+        with Archive(args.archive) as archive:
+            if args.start is None and args.stop is None and not args.out:
+                print(json.dumps(dict(archive.meta, rows=archive.rows, chunks=len(archive.chunks), recovered=archive.recovered), indent=2))
+            else:
+                origin = min(low for offset, rows, low, high in archive.chunks) if archive.chunks else 0
+                if args.units:
+                    units = MILLIS if args.units == 'ms' else MICROS
+                else:
+                    units = archive.meta.get('time_units') or detect_units(archive.read_chunk(0, ['time'])['time'] if archive.chunks else [])
+                samples = archive.read_time(None if args.start is None else origin + int(args.start * units),
+                                            None if args.stop is None else origin + int(args.stop * units))
+                if args.out:
+                    np.savetxt(args.out, np.column_stack([samples[name] for name in samples.dtype.names]), delimiter=',',
+                               header=','.join(samples.dtype.names), comments='', fmt='%.10g')
+                print(f'{len(samples)} rows from {len(archive.chunks)} chunks')
+    elif args.command == 'bench':
+        files = args.files or sorted(glob.glob(os.path.join(here, '*.csv')))
+        for result in benchmark(files, args.codec, args.chunk_rows):
+            print(f"{result['codec']}: {result['rows']:,} rows, {result['source_mb']:.1f} MB -> {result['archive_mb']:.2f} MB "
+                  f"({result['ratio_vs_source']:.1f}x smaller than the recordings, {result['ratio_vs_binary']:.1f}x than raw binary)")
+            print(f"  write {result['write_mrows_s']:.1f} M rows/s, read {result['read_mrows_s']:.1f} M rows/s ({result['read_mb_s']:.0f} MB/s), "
+                  f"1 s range {result['range_read_ms_p50']:.2f} ms")
+            print(f"  largest error: {', '.join(f'{name} {error:.2g}' for name, error in result['max_error'].items())}")
@@ -0,0 +1,314 @@
+import argparse
+import json
+import os
+import platform
+import tempfile
+import time
+from collections import deque
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+import numpy as np
+from breakdetect import BreakDetector
+from device import DeviceSession
+from dsp import Channel, Decimate, LowPass, MedianDespike, Pipeline
+from liveplot import LivePlot
+from recorder import CsvRecorder
+from ringbuffer import RingBuffer
+from session import SessionRecorder
+from simulator import SAMPLE_INTERVAL_US, SimulatedTeensy
+from telemetry import StreamDecoder
+
+# End-to-end benchmark of the host stack, driven by simulator.py over a pty:
+#
+#   simulated Teensy -> DeviceSession -> StreamDecoder -> RingBuffer -> LivePlot (Agg canvas)
+#                                                                   -> recorder thread
+#
+# For each speed multiplier it reports the samples/s the host keeps up with, the
+# sample-to-pixel latency (from when the simulator sent a sample to when a frame showing
+# it was drawn), the frame rate of the render loop and the growth of the process' memory.
+# Then it measures the "stop" round trip. Results are written as JSON; pass --compare
+# with an earlier file to see what changed.
+#
+#   python bench.py
+#   python bench.py --binary --rates 1 10 50 --compare bench_results/bench_20240901-101500.json
+#
+# Linux only (the simulator needs a pty). Run from the PillarPuller folder.
+RESULTS_DIR = 'bench_results'
+REPLAY_FILE = 'pillar_puller_20240822-162339.csv'
+DEFAULT_RATES = [1, 5, 20, 50, 100, 200]  # Multiples of the real sample rate (one sample per 597 us)
+LOSS_LIMIT = 0.001  # A rate is sustained if less than this fraction of the samples is lost
+FRAME_INTERVAL = 0.01  # Same interval as the FuncAnimation in template.py
+PLOT_WINDOW = 2000
+
+class BenchBuffer():
+    ''' The parts of serialBuffer that DeviceSession drives, without the GUI '''
+    def __init__(self, spill_dir):
+        self.samples = RingBuffer(200000, spill_dir=spill_dir)
+        self.decoder = StreamDecoder(columns=4)
+        self.status_lines = deque(maxlen=1000)
+        self.break_detector = BreakDetector(force_column=3)
+        self.channels = [Channel(Pipeline(MedianDespike(5), LowPass(50))), Channel(Decimate(10), columns=('force', 'position', 'filtered'))]
+        self.stopped_at = None  # time.monotonic() when the position stopped changing, see watch_for_stop
+        self._watching = False
+        self._last_position = None
+
+    def ingest(self, samples, status):
+        if len(samples) > 0:
+            self.samples.extend(samples)
+            for channel in self.channels:
+                channel.feed(samples)
+            self.break_detector.feed(samples)
+            if self._watching:
+                self._check_stopped(samples[:, 2])
+        self.status_lines.extend(status)
+
+    # Function to note when the platform next stops moving, for the stop round trip.
+    def watch_for_stop(self):
+        self.stopped_at = None
+        self._last_position = None
+        self._watching = True
+
+    def _check_stopped(self, position):
+        if self._last_position is not None:
+            position = np.concatenate(([self._last_position], position))
+        if len(position) > 1 and np.any(np.diff(position) == 0):
+            self.stopped_at = time.monotonic()
+            self._watching = False
+        self._last_position = position[-1]
+
+# Function returning the resident memory of this process in bytes.
+def rss_bytes():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def percentiles(values, scale=1.0):
+    if len(values) == 0:
+        return {'p50': None, 'p95': None, 'p99': None, 'max': None}
+    values = np.asarray(values) * scale
+    p50, p95, p99 = np.percentile(values, [50, 95, 99])
+    return {'p50': float(p50), 'p95': float(p95), 'p99': float(p99), 'max': float(values.max())}
+
+class Renderer():
+    ''' Runs LivePlot on an off-screen canvas the way FuncAnimation runs it with blit=True '''
+    def __init__(self, buffer):
+        self.buffer = buffer
+        self.fig, self.ax = plt.subplots(figsize=(16, 8), dpi=100)
+        lines = [self.ax.plot([], [])[0] for _ in range(3)]
+        self.live_plot = LivePlot(self.ax, lines, self.get_columns, window=PLOT_WINDOW)
+        self.fig.canvas.draw()
+        self._redraws = self.live_plot.full_redraws
+        self._background = self.fig.canvas.copy_from_bbox(self.ax.bbox)
+
+    def get_columns(self, n):
+        micros, forces, platformDistances, filtered_forces = self.buffer.samples.columns(n, ('time', 'force', 'position', 'filtered'))
+        return platformDistances, forces, filtered_forces
+
+    # Function to draw one frame. Returns the time stamp of the newest sample drawn, or None.
+    def frame(self):
+        latest = self.buffer.samples.latest()
+        artists = self.live_plot.update()
+        canvas = self.fig.canvas
+        if self.live_plot.full_redraws != self._redraws:
+            self._redraws = self.live_plot.full_redraws
+            self._background = canvas.copy_from_bbox(self.ax.bbox)
+        canvas.restore_region(self._background)
+        for artist in artists:
+            self.ax.draw_artist(artist)
+        canvas.blit(self.ax.bbox)
+        return None if latest is None else float(latest['time'])
+
+    def close(self):
+        plt.close(self.fig)
+
+# Function to connect a host stack to a fresh simulator. Returns (simulator, buffer, session).
+def connect(workdir, binary, **simulator_args):
+    simulator = SimulatedTeensy(**simulator_args).start()
+    buffer = BenchBuffer(os.path.join(workdir, 'spill', time.strftime("%H%M%S") + f'-{id(simulator)}'))
+    session = DeviceSession(buffer, simulator.port, 115200)
+    session.start()
+    if binary:
+        session.submit("binary", expect="BINARY ON").result(5)
+    else:
+        session.submit("ascii").result(5)
+    return simulator, buffer, session
+
+def make_recorder(kind, buffer, workdir):
+    if kind == 'csv':
+        return CsvRecorder(buffer.samples), os.path.join(workdir, 'bench.csv')
+    if kind == 'session':
+        return SessionRecorder(buffer.samples), os.path.join(workdir, f'bench-{time.monotonic_ns()}.session')
+    return None, None
+
+# Function to run one speed multiplier for duration seconds. Returns a dict of results.
+def run_rate(rate, duration, binary, record, replay, workdir, warmup=0.5):
+    simulator, buffer, session = connect(workdir, binary, replay=replay, rate=rate)
+    renderer = Renderer(buffer)
+    recorder, filename = make_recorder(record, buffer, workdir)
+    try:
+        if recorder is not None:
+            recorder.start(filename)
+        time.sleep(warmup)
+
+        sent0, dropped0, skipped0, received0 = simulator.sent, simulator.dropped, simulator.skipped, buffer.samples.total
+        rss0 = rss_bytes()
+        start = time.monotonic()
+        frame_times, latencies, memory = [], [], [(0.0, rss0)]
+        next_frame = start
+        while True:
+            now = time.monotonic()
+            if now - start >= duration:
+                break
+            if now < next_frame:
+                time.sleep(next_frame - now)
+            next_frame = max(next_frame + FRAME_INTERVAL, time.monotonic())
+            t = time.perf_counter()
+            newest = renderer.frame()
+            drawn = time.monotonic()
+            frame_times.append(time.perf_counter() - t)
+            if newest is not None:
+                latencies.append(drawn - simulator.due_time(newest))
+            if drawn - start - memory[-1][0] >= 0.5:
+                memory.append((drawn - start, rss_bytes()))
+        elapsed = time.monotonic() - start
+        sent, dropped, skipped = simulator.sent - sent0, simulator.dropped - dropped0, simulator.skipped - skipped0
+        scheduled = sent + dropped + skipped  # Every sample that fell due in the simulator
+
+        # Give the host a moment to read what was already sent
+        for _ in range(50):
+            received = buffer.samples.total - received0
+            if received >= sent:
+                break
+            time.sleep(0.02)
+        received = buffer.samples.total - received0
+        memory.append((elapsed, rss_bytes()))
+    finally:
+        if recorder is not None:
+            recorder.stop()
+        session.close()
+        simulator.stop()
+        renderer.close()
+
+    seconds, rss = np.array(memory).T
+    growth = float(np.polyfit(seconds, rss, 1)[0]) if len(seconds) > 2 else 0.0
+    lost = dropped + skipped + max(sent - received, 0)
+    return {
+        'rate': rate,
+        'target_samples_per_s': rate * 1e6 / SAMPLE_INTERVAL_US,
+        'received_samples_per_s': received / elapsed,
+        'sent': sent,
+        'received': received,
+        'skipped_by_simulator': skipped,  # The host held up the pty
+        'loss_fraction': lost / scheduled if scheduled else 0.0,
+        'parse_errors': buffer.decoder.lines.errors,
+        'corrupt_frames': buffer.decoder.frames.corrupt,
+        'recorder_lost': recorder.lost if recorder is not None else 0,
+        'sample_to_pixel_ms': percentiles(latencies, 1000),
+        'frame_ms': percentiles(frame_times, 1000),
+        'fps': len(frame_times) / elapsed,
+        'full_redraws': renderer.live_plot.full_redraws,
+        'rss_start_mb': rss0 / 1e6,
+        'rss_end_mb': float(rss[-1]) / 1e6,
+        'rss_growth_mb_per_min': growth * 60 / 1e6,
+    }
+
+# Function to measure the stop command while the synthesized platform is opening.
+# write_ms is submit to written, device_ms submit to the simulator receiving it,
+# round_trip_ms submit to the host seeing the platform stop.
+def run_stop(repeats, binary, workdir):
+    simulator, buffer, session = connect(workdir, binary)
+    write, device, round_trip = [], [], []
+    try:
+        for _ in range(repeats):
+            session.submit("open").result(2)
+            time.sleep(0.1)
+            buffer.watch_for_stop()
+            received = len(simulator.commands)
+            submitted = time.monotonic()
+            write.append(session.submit("stop").result(2))
+            deadline = submitted + 1.0
+            while buffer.stopped_at is None and time.monotonic() < deadline:
+                time.sleep(0.0005)
+            if len(simulator.commands) > received:
+                device.append(simulator.commands[received][0] - submitted)
+            if buffer.stopped_at is not None:
+                round_trip.append(buffer.stopped_at - submitted)
+            session.submit("zero_position").result(2)
+    finally:
+        session.close()
+        simulator.stop()
+    return {
+        'repeats': repeats,
+        'write_ms': percentiles(write, 1000),
+        'device_ms': percentiles(device, 1000),
+        'round_trip_ms': percentiles(round_trip, 1000),
+        'missed': repeats - len(round_trip),
+    }
+
+def run(rates, duration, binary, record, replay, stop_repeats):
+    results = {
+        'created': time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        'host': {'platform': platform.platform(), 'python': platform.python_version(),
+                 'numpy': np.__version__, 'matplotlib': matplotlib.__version__, 'cpus': os.cpu_count()},
+        'settings': {'duration_s': duration, 'binary': binary, 'record': record, 'replay': replay},
+        'rates': [],
+    }
+    with tempfile.TemporaryDirectory() as workdir:
+        for rate in rates:
+            result = run_rate(rate, duration, binary, record, replay, workdir)
+            results['rates'].append(result)
+            print(f"x{rate:<5g} {result['received_samples_per_s']:9.0f} samples/s, loss {result['loss_fraction']:.2%}, "
+                  f"latency p50 {result['sample_to_pixel_ms']['p50'] or 0:.1f} ms p99 {result['sample_to_pixel_ms']['p99'] or 0:.1f} ms, "
+                  f"{result['fps']:.0f} fps, memory {result['rss_growth_mb_per_min']:+.1f} MB/min")
+        sustained = [r['received_samples_per_s'] for r in results['rates'] if r['loss_fraction'] < LOSS_LIMIT]
+        results['sustained_samples_per_s'] = max(sustained) if sustained else 0.0
+        results['stop'] = run_stop(stop_repeats, binary, workdir)
+    stop = results['stop']
+    print(f"sustained {results['sustained_samples_per_s']:.0f} samples/s; stop written p50 {stop['write_ms']['p50'] or 0:.2f} ms, "
+          f"round trip p50 {stop['round_trip_ms']['p50'] or 0:.2f} ms p99 {stop['round_trip_ms']['p99'] or 0:.2f} ms")
+    return results
+
+# Function to print how the headline numbers moved since an earlier results file.
+def compare(old, new):
+    def headline(results):
+        values = {'sustained samples/s': results['sustained_samples_per_s'],
+                  'stop round trip p50 ms': results['stop']['round_trip_ms']['p50']}
+        for r in results['rates']:
+            values[f"x{r['rate']:g} latency p99 ms"] = r['sample_to_pixel_ms']['p99']
+            values[f"x{r['rate']:g} fps"] = r['fps']
+            values[f"x{r['rate']:g} memory MB/min"] = r['rss_growth_mb_per_min']
+        return values
+    before, after = headline(old), headline(new)
+    for name, value in after.items():
+        previous = before.get(name)
+        if previous is None or value is None:
+            print(f'{name:32} {"n/a":>10} -> ' + (f'{value:10.2f}' if value is not None else f'{"n/a":>10}'))
+        else:
+            change = f' ({(value - previous) / abs(previous):+.0%})' if previous else ''
+            print(f'{name:32} {previous:10.2f} -> {value:10.2f}{change}')
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="End-to-end benchmark of the host stack against the simulator")
+    arg_parser.add_argument('--rates', type=float, nargs='+', default=DEFAULT_RATES, help="speed multipliers to run")
+    arg_parser.add_argument('--duration', type=float, default=5.0, help="seconds per rate")
+    arg_parser.add_argument('--binary', action='store_true', help="use binary telemetry frames instead of ASCII lines")
+    arg_parser.add_argument('--record', choices=['csv', 'session', 'none'], default='csv', help="recorder running during the benchmark")
+    arg_parser.add_argument('--replay', default=os.path.join(os.path.dirname(__file__) or '.', REPLAY_FILE))
+    arg_parser.add_argument('--stop-repeats', type=int, default=20)
+    arg_parser.add_argument('--out', help=f"results file (default: {RESULTS_DIR}/bench_<time>.json)")
+    arg_parser.add_argument('--compare', help="earlier results file to compare with")
+    args = arg_parser.parse_args()
+
+    results = run(args.rates, args.duration, args.binary, args.record, args.replay, args.stop_repeats)
+    out = args.out or os.path.join(RESULTS_DIR, f'bench_{time.strftime("%Y%m%d-%H%M%S")}.json')
+    os.makedirs(os.path.dirname(out) or '.', exist_ok=True)
+    with open(out, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f'Results written to {out}')
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), results)
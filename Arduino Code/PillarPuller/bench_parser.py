@@ -0,0 +1,80 @@
+import glob
+import io
+import os
+import time
+from lineparser import LineParser
+
+# Benchmark of LineParser against the old readline/split/float loop, using the recorded sessions
+# as the byte stream. Run from the PillarPuller folder: python bench_parser.py
+
+CHUNK_SIZE = 4096 # Bytes per read, roughly what ser.read(ser.in_waiting) returns under load
+STATUS_EVERY = 500 # Insert a status line every this many samples, as the firmware does
+
+# Function to turn the recorded CSV files into one serial byte stream
+def build_stream(pattern):
+    lines = []
+    for path in sorted(glob.glob(pattern)):
+        with open(path, 'rb') as f:
+            rows = f.read().splitlines()[1:]  # Skip the header
+        for i, row in enumerate(rows):
+            lines.append(row)
+            if i % STATUS_EVERY == 0:
+                lines.append(b'Opening till force 4')
+    return b'\r\n'.join(lines) + b'\r\n'
+
+class ReplayPort(io.RawIOBase):
+    ''' Stands in for serial.Serial. Like pyserial, readline() comes from io.RawIOBase and reads one byte at a time '''
+    def __init__(self, stream):
+        self._stream = io.BytesIO(stream)
+        self._size = len(stream)
+
+    @property
+    def in_waiting(self):
+        return min(CHUNK_SIZE, self._size - self._stream.tell())
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        return self._stream.readinto(b)
+
+# Function to parse the stream the way serialBuffer.populate used to
+def parse_readline(stream):
+    ser = ReplayPort(stream)
+    micros, forces, platformDistances = [], [], []
+    while ser.in_waiting:
+        line = ser.readline().decode('utf-8').strip()
+        if ',' in line:
+            sensorValues = line.split(',')
+            micros.append(float(sensorValues[0]))
+            forces.append(float(sensorValues[1]))
+            platformDistances.append(float(sensorValues[2]))
+    return len(micros)
+
+# Function to parse the stream with LineParser, reading whatever is waiting like serialBuffer.populate does now
+def parse_blocks(stream):
+    ser = ReplayPort(stream)
+    parser = LineParser(columns=3)
+    count = 0
+    while ser.in_waiting:
+        samples, status = parser.read(ser)
+        count += len(samples)
+    return count
+
+def bench(name, func, stream, repeats=3):
+    best = float('inf')
+    for _ in range(repeats):
+        start = time.perf_counter()
+        count = func(stream)
+        best = min(best, time.perf_counter() - start)
+    print(f'{name:>10}: {count} samples in {best:.3f} s, {count / best:,.0f} samples/s, {len(stream) / best / 1e6:.1f} MB/s')
+    return count / best
+
+if __name__ == "__main__":
+    stream = build_stream(os.path.join(os.path.dirname(__file__) or '.', 'pillar_puller_*.csv'))
+    print(f'Stream: {len(stream) / 1e6:.1f} MB')
+    old = bench('readline', parse_readline, stream)
+    new = bench('LineParser', parse_blocks, stream)
+    print(f'Speedup: {new / old:.1f}x')
+    # 115200 baud is ~11.5 kB/s, about 500 lines/s of "37774936,1.49,0.00,1.47"
+    print(f'Headroom over 115200 baud: {new / (11520 / 24):,.0f}x')
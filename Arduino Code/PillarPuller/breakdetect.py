@@ -0,0 +1,123 @@
+import glob
+import os
+import time
+import numpy as np
+
+class BreakEvent():
+    ''' A detected break '''
+    def __init__(self, index, time, peak_force, force, position):
+        self.index = index  # Sample number since the detector was reset
+        self.time = time  # Value of the time column at the break
+        self.peak_force = peak_force  # Highest force before the break
+        self.force = force  # Force at the sample that triggered the detection
+        self.position = position  # Platform position at the break
+
+class BreakDetector():
+    ''' Detects a pillar breaking from the stream of samples.
+
+    A break is a fast fall in force after the force has been loaded above min_peak.
+    Two tests must agree on the same sample:
+      - a one-sided CUSUM of the per-sample force drop (less a drift allowance) passes
+        cusum_threshold, so a fast fall triggers and slow relaxation or noise does not
+      - the force is at least drop_fraction below the highest force seen so far
+
+    feed() takes the (n, columns) blocks the parsers produce. Everything is done with
+    whole-block NumPy operations, carrying the CUSUM sum, the running peak and the last
+    force between blocks, so a break is reported in the block it arrives in.
+    After a break the detector stays latched until reset().
+    '''
+    def __init__(self, force_column=1, time_column=0, position_column=2, min_peak=3.0,
+                 drop_fraction=0.2, cusum_threshold=1.5, drift=0.05):
+        self.force_column = force_column
+        self.time_column = time_column
+        self.position_column = position_column
+        self.min_peak = min_peak
+        self.drop_fraction = drop_fraction
+        self.cusum_threshold = cusum_threshold
+        self.drift = drift
+        self.callbacks = []  # Functions called with each BreakEvent
+        self.reset()
+
+    # Function to re-arm the detector, e.g. at the start of a new pull.
+    def reset(self):
+        self.samples = 0
+        self.peak = -np.inf
+        self.event = None
+        self._cusum = 0.0
+        self._last_force = None
+
+    @property
+    def triggered(self):
+        return self.event is not None
+
+    # Function to process a block of samples. Returns a BreakEvent if the break is in this block, otherwise None.
+    def feed(self, block):
+        block = np.asarray(block)
+        n = len(block)
+        if n == 0 or self.triggered:
+            self.samples += n
+            return None
+
+        force = block[:, self.force_column]
+        previous = force[0] if self._last_force is None else self._last_force
+        drop = -np.diff(force, prepend=previous) - self.drift
+
+        # CUSUM s_k = max(0, s_(k-1) + x_k) has the closed form C_k - min(0, min_(j<=k) C_j), with C = s_0 + cumsum(x)
+        c = self._cusum + np.cumsum(drop)
+        cusum = c - np.minimum(np.minimum.accumulate(c), 0.0)
+
+        peak = np.maximum.accumulate(np.maximum(force, self.peak))
+        hit = (cusum >= self.cusum_threshold) & (peak >= self.min_peak) & (force <= (1 - self.drop_fraction) * peak)
+
+        if hit.any():
+            i = int(np.argmax(hit))
+            self.event = BreakEvent(
+                index=self.samples + i,
+                time=float(block[i, self.time_column]),
+                peak_force=float(peak[i]),
+                force=float(force[i]),
+                position=float(block[i, self.position_column]),
+            )
+            self.samples += n
+            for callback in self.callbacks:
+                callback(self.event)
+            return self.event
+
+        self._cusum = float(cusum[-1])
+        self.peak = float(peak[-1])
+        self._last_force = float(force[-1])
+        self.samples += n
+        return None
+
+# Function to replay a recorded CSV through a detector in blocks. Returns (event, per-block seconds).
+def replay(path, block_size=64, **kwargs):
+    data = np.loadtxt(path, delimiter=',', skiprows=1, ndmin=2)
+    detector = BreakDetector(**kwargs)
+    timings = []
+    event = None
+    for start in range(0, len(data), block_size):
+        t = time.perf_counter()
+        found = detector.feed(data[start:start + block_size])
+        timings.append(time.perf_counter() - t)
+        if found is not None:
+            event = found
+    return event, np.array(timings), len(data)
+
+if __name__ == "__main__":
+    # Replay benchmark over the recorded sessions. Block size 64 is about 40 ms of samples at 600 us spacing.
+    block_size = 64
+    folder = os.path.dirname(__file__) or '.'
+    all_timings = []
+    for path in sorted(glob.glob(os.path.join(folder, '*.csv'))):
+        if os.path.getsize(path) < 100:
+            continue
+        event, timings, rows = replay(path, block_size)
+        all_timings.append(timings)
+        if event is not None:
+            print(f'{os.path.basename(path)}: break at sample {event.index} of {rows}, peak {event.peak_force:.2f}, '
+                  f'force {event.force:.2f}, position {event.position:.2f}')
+        else:
+            print(f'{os.path.basename(path)}: no break in {rows} samples')
+    timings = np.concatenate(all_timings)
+    print(f'{len(timings)} blocks of {block_size} samples: mean {timings.mean() * 1e6:.1f} us, '
+          f'p99 {np.percentile(timings, 99) * 1e6:.1f} us, max {timings.max() * 1e6:.1f} us per block')
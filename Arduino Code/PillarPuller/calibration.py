@@ -0,0 +1,278 @@
+import argparse
+import copy
+import glob
+import hashlib
+import json
+import os
+import re
+import time
+import numpy as np
+from session import DEFAULT_CALIBRATION, load, open_session, write_meta
+
+# Host side calibration: the rig's readings turned into real units, live and after the fact.
+#
+#   python calibration.py new COM3 --tare 0.02 --point 1.65:1.0 --point 3.31:2.0 --unit kg
+#   python calibration.py show COM3
+#   python calibration.py apply COM3 recordings/*.session
+#
+# The Teensy already converts its readings (see DEFAULT_CALIBRATION), so the samples are kept
+# exactly as it sends them and a Calibration undoes the firmware's conversion to get back the
+# load cell counts and motor steps, then applies:
+#
+#   tare          counts at no load, subtracted first (the Tare button sets it)
+#   points        (counts above tare, load) pairs of the load cell's curve, interpolated and
+#                 extended in straight lines beyond the end points. (0, 0) is always one
+#   temperature   gain change per degree away from reference_temperature, for a session run at
+#                 `temperature` (the rig has no sensor, so it is one number for the session)
+#   creep         fraction of a held load the cell creeps by, with time constant creep_tau
+#   steps_per_mm  and position_offset, for the platform
+#
+# The version of a calibration is a hash of its contents, so it names exactly one set. New
+# sets are saved in CALIBRATION_DIR/<rig>/, and a recording keeps the set it was made with in
+# its meta.json. Applying another set to recorded sessions only rewrites their meta.json (the
+# set it replaces goes to calibration_history), and load_calibrated works out the calibrated
+# values from the untouched samples in one vectorised pass.
+CALIBRATION_DIR = 'calibrations'
+FORCE_COLUMNS = ('force', 'filtered')
+POSITION_COLUMNS = ('position',)
+
+class Calibration():
+    ''' A calibration set for one rig. The defaults give back exactly what the firmware sends '''
+    def __init__(self, rig=None, unit='device', tare=None, points=None, temperature_coefficient=0.0, reference_temperature=20.0,
+                 temperature=None, creep=0.0, creep_tau=30.0, steps_per_mm=None, position_offset=0.0, firmware=None, created=None):
+        self.firmware = dict(DEFAULT_CALIBRATION if firmware is None else firmware)  # How the firmware converted the readings
+        self.rig = rig
+        self.unit = unit  # Unit of the calibrated force
+        self.tare = self.firmware['force_offset'] if tare is None else float(tare)
+        self.points = sorted([float(c), float(load)] for c, load in (points or [[0.0, 0.0], [self.firmware['force_scale'], 1.0]]))
+        if not any(c == 0 for c, load in self.points):
+            self.points = sorted(self.points + [[0.0, 0.0]])  # The tare is the reading with no load
+        self.temperature_coefficient = temperature_coefficient
+        self.reference_temperature = reference_temperature
+        self.temperature = temperature
+        self.creep = creep
+        self.creep_tau = creep_tau
+        self.steps_per_mm = self.firmware['steps_per_mm'] if steps_per_mm is None else float(steps_per_mm)
+        self.position_offset = position_offset
+        self.created = time.strftime("%Y-%m-%dT%H:%M:%S%z") if created is None else created
+
+    def _content(self):
+        return {'rig': self.rig, 'unit': self.unit, 'tare': self.tare, 'points': self.points,
+                'temperature_coefficient': self.temperature_coefficient, 'reference_temperature': self.reference_temperature,
+                'temperature': self.temperature, 'creep': self.creep, 'creep_tau': self.creep_tau,
+                'steps_per_mm': self.steps_per_mm, 'position_offset': self.position_offset, 'firmware': self.firmware}
+
+    @property
+    def version(self):
+        return hashlib.sha1(json.dumps(self._content(), sort_keys=True).encode()).hexdigest()[:12]
+
+    def to_dict(self):
+        return dict(self._content(), version=self.version, created=self.created)
+
+    @classmethod
+    def from_dict(cls, d):
+        if 'version' not in d:
+            return cls(firmware=d)  # Sessions from before host calibration only have the firmware's constants
+        return cls(**{name: value for name, value in d.items() if name != 'version'})
+
+    # Function returning a copy with some settings changed, as a new set.
+    def replace(self, **changes):
+        return Calibration(**dict(copy.deepcopy(self._content()), **changes))
+
+    # Function returning a copy tared at a force reading, e.g. the mean of the last half second with nothing loaded.
+    def with_tare(self, reading):
+        return self.replace(tare=float(self.counts(reading)))
+
+    # Function to undo the firmware's conversion of the load cell counts.
+    def counts(self, force):
+        return np.asarray(force, dtype=np.float64) * self.firmware['force_scale'] + self.firmware['force_offset']
+
+    # Function to convert force readings to calibrated load, without creep (see Calibrate for that).
+    def force(self, force):
+        temperature = 1.0
+        if self.temperature is not None and self.temperature_coefficient:
+            temperature = 1 + self.temperature_coefficient * (self.temperature - self.reference_temperature)
+        if len(self.points) == 2:
+            # A straight line: the firmware's conversion, tare and curve fold into one multiply and add
+            (x0, y0), (x1, y1) = self.points
+            slope = (y1 - y0) / (x1 - x0) / temperature
+            gain = self.firmware['force_scale'] * slope
+            offset = y0 / temperature + (self.firmware['force_offset'] - self.tare - x0) * slope
+            return np.asarray(force, dtype=np.float64) * gain + offset
+        x = np.atleast_1d(self.counts(force) - self.tare)
+        (x0, y0), (x1, y1) = self.points[0], self.points[1]
+        (xa, ya), (xb, yb) = self.points[-2], self.points[-1]
+        xp, yp = np.array(self.points).T
+        y = np.interp(x, xp, yp)
+        # Straight on from the end segments
+        below, above = x < x0, x > xb
+        y[below] = y0 + (x[below] - x0) * (y1 - y0) / (x1 - x0)
+        y[above] = yb + (x[above] - xb) * (yb - ya) / (xb - xa)
+        return (y / temperature).reshape(np.shape(force))
+
+    # Function to convert position readings to calibrated mm.
+    def position(self, position):
+        steps = np.asarray(position, dtype=np.float64) * self.firmware['steps_per_mm']
+        return steps / self.steps_per_mm - self.position_offset
+
+class Calibrate():
+    ''' A streaming stage (see dsp.py) applying a Calibration to the value columns named in columns.
+
+    Creep depends on the load history, so it is a first order filter carried between
+    blocks: the creep follows creep * load with time constant creep_tau, and is taken off.
+    '''
+    def __init__(self, calibration, columns=('force', 'position', 'filtered'), sample_rate=None):
+        self.calibration = calibration
+        self.columns = list(columns)
+        self._forces = [i for i, name in enumerate(columns) if name in FORCE_COLUMNS]
+        self._positions = [i for i, name in enumerate(columns) if name in POSITION_COLUMNS]
+        self._creep = None
+        if calibration.creep and self._forces:
+            from dsp import SAMPLE_RATE, LinearFilter
+            a = np.exp(-1.0 / (calibration.creep_tau * (sample_rate or SAMPLE_RATE)))
+            self._creep = LinearFilter([calibration.creep * (1 - a)], [1.0, -a])
+
+    def reset(self):
+        if self._creep is not None:
+            self._creep.reset()
+
+    def process(self, times, values):
+        if len(values) == 0:
+            return times, values
+        out = np.array(values, dtype=np.float64)
+        if self._forces:
+            forces = self.calibration.force(out[:, self._forces])
+            if self._creep is not None:
+                times, creep = self._creep.process(times, forces)
+                forces = forces - creep
+            out[:, self._forces] = forces
+        if self._positions:
+            out[:, self._positions] = self.calibration.position(out[:, self._positions])
+        return times, out
+
+# Function returning a copy of a structured array of samples with its force and position columns calibrated.
+def calibrate(samples, calibration):
+    out = samples.copy()
+    forces = [name for name in samples.dtype.names if name in FORCE_COLUMNS]
+    if calibration.creep and forces and len(samples):
+        times, values = Calibrate(calibration, forces).process(samples['time'], np.column_stack([samples[name] for name in forces]))
+        for i, name in enumerate(forces):
+            out[name] = values[:, i]
+    else:
+        for name in forces:
+            out[name] = calibration.force(samples[name])
+    for name in POSITION_COLUMNS:
+        if name in samples.dtype.names:
+            out[name] = calibration.position(samples[name])
+    return out
+
+# Function returning the Calibration a recording was made with (the firmware's own for CSV files).
+def recording_calibration(path):
+    if os.path.isdir(path):
+        return Calibration.from_dict(open_session(path).meta.get('calibration') or DEFAULT_CALIBRATION)
+    return Calibration()
+
+# Function to load a recording with its samples calibrated, by the set it was made with unless one is given.
+def load_calibrated(path, calibration=None):
+    return calibrate(load(path), calibration or recording_calibration(path))
+
+# Function to switch recorded sessions to another calibration. Only meta.json changes, the samples are
+# raw, so this is quick however long they are. Returns the sessions changed.
+def recalibrate(paths, calibration):
+    changed = []
+    new = calibration.to_dict()
+    for path in paths:
+        session = open_session(path)
+        meta = session.meta
+        old = meta.get('calibration')
+        if old is not None and old.get('version') == new['version']:
+            continue
+        meta.setdefault('calibration_history', []).append(dict(old or DEFAULT_CALIBRATION, replaced=time.strftime("%Y-%m-%dT%H:%M:%S%z")))
+        meta['calibration'] = new
+        write_meta(path, meta)
+        changed.append(path)
+    return changed
+
+class CalibrationStore():
+    ''' The calibration sets of every rig, one JSON file per set in path/<rig>/ '''
+    def __init__(self, path=CALIBRATION_DIR):
+        self.path = path
+
+    def _dir(self, rig):
+        return os.path.join(self.path, re.sub(r'[^A-Za-z0-9]+', '_', rig).strip('_'))
+
+    # Function to save a set. Returns its version.
+    def save(self, calibration):
+        if calibration.rig is None:
+            raise ValueError("Only a rig's calibration can be saved, this one has no rig")
+        os.makedirs(self._dir(calibration.rig), exist_ok=True)
+        path = os.path.join(self._dir(calibration.rig), f'{calibration.version}.json')
+        with open(path, 'w') as f:
+            json.dump(calibration.to_dict(), f, indent=2)
+        return calibration.version
+
+    # Function returning every set of a rig, oldest first.
+    def versions(self, rig):
+        sets = []
+        for path in glob.glob(os.path.join(self._dir(rig), '*.json')):
+            with open(path) as f:
+                sets.append(Calibration.from_dict(json.load(f)))
+        return sorted(sets, key=lambda calibration: (calibration.created, os.path.getmtime(os.path.join(self._dir(rig), f'{calibration.version}.json'))))
+
+    # Function returning a rig's newest set, or None if it has none.
+    def latest(self, rig):
+        sets = self.versions(rig)
+        return sets[-1] if sets else None
+
+    def get(self, rig, version):
+        path = os.path.join(self._dir(rig), f'{version}.json')
+        with open(path) as f:
+            return Calibration.from_dict(json.load(f))
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Make rig calibrations and apply them to recorded sessions")
+    arg_parser.add_argument('--dir', default=CALIBRATION_DIR, help="where the calibration sets are kept")
+    commands = arg_parser.add_subparsers(dest='command', required=True)
+    new = commands.add_parser('new', help="save a new calibration set for a rig, from force readings shown by the GUI")
+    new.add_argument('rig')
+    new.add_argument('--tare', type=float, help="force reading with nothing loaded")
+    new.add_argument('--point', action='append', default=[], metavar='READING:LOAD', help="force reading with a known load, repeat for more")
+    new.add_argument('--unit', default='device')
+    new.add_argument('--temperature-coefficient', type=float, default=0.0, help="gain change per degree C")
+    new.add_argument('--reference-temperature', type=float, default=20.0)
+    new.add_argument('--temperature', type=float, help="temperature the sessions are run at")
+    new.add_argument('--creep', type=float, default=0.0, help="fraction of a held load the cell creeps by")
+    new.add_argument('--creep-tau', type=float, default=30.0, help="time constant of the creep in seconds")
+    new.add_argument('--steps-per-mm', type=float)
+    new.add_argument('--position-offset', type=float, default=0.0)
+    show = commands.add_parser('show', help="list a rig's calibration sets")
+    show.add_argument('rig')
+    apply = commands.add_parser('apply', help="switch sessions to a rig's newest calibration set (or RIG:VERSION)")
+    apply.add_argument('calibration')
+    apply.add_argument('sessions', nargs='+')
+    args = arg_parser.parse_args()
+
+    store = CalibrationStore(args.dir)
+    if args.command == 'new':
+        base = Calibration(rig=args.rig)
+        tare = base.tare if args.tare is None else float(base.counts(args.tare))
+        points = [(float(base.counts(float(reading))) - tare, float(load)) for reading, load in (p.split(':') for p in args.point)] or None
+        calibration = Calibration(rig=args.rig, unit=args.unit, tare=tare, points=points, temperature_coefficient=args.temperature_coefficient,
+                                  reference_temperature=args.reference_temperature, temperature=args.temperature, creep=args.creep,
+                                  creep_tau=args.creep_tau, steps_per_mm=args.steps_per_mm, position_offset=args.position_offset)
+        print(f'Saved {args.rig} calibration {store.save(calibration)}')
+    elif args.command == 'show':
+        for calibration in store.versions(args.rig):
+            print(f'{calibration.version}  {calibration.created}  {calibration.unit}, tare {calibration.tare:g}, '
+                  f'{len(calibration.points)} points, creep {calibration.creep:g}')
+    elif args.command == 'apply':
+        rig, _, version = args.calibration.partition(':')
+        calibration = store.get(rig, version) if version else store.latest(rig)
+        if calibration is None:
+            arg_parser.error(f'No calibration sets for {rig} in {args.dir}')
+        sessions = [path for path in args.sessions if os.path.isdir(path)]
+        start = time.perf_counter()
+        changed = recalibrate(sessions, calibration)
+        print(f'{len(changed)} of {len(sessions)} sessions switched to {calibration.version} in {time.perf_counter() - start:.2f} s')
+        if len(sessions) < len(args.sessions):
+            print('CSV files keep no metadata, convert them to sessions first (python session.py convert)')
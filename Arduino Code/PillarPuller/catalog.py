@@ -0,0 +1,327 @@
+import argparse
+import concurrent.futures
+import datetime
+import glob
+import json
+import os
+import re
+import sqlite3
+import time
+import numpy as np
+from analyse import FIELDS, METRICS_VERSION, file_hash, file_stamp, pull_metrics
+from session import load, time_units
+from timebase import detect_units
+
+# A SQLite catalogue of recorded pulls, so finding sessions is a query instead of re-reading
+# every file:
+#
+#   python catalog.py index                      every pillar_puller_*.csv and *.session here
+#   python catalog.py index data/*.csv --rig COM10 --operator sam
+#   python catalog.py find --min-peak 3 --since 7d
+#   python catalog.py find --rig COM10 --broke --plot
+#
+# Each session has a row in `sessions` with its wall clock time range, rig, profile and
+# operator, and the pull metrics from analyse.py. `previews` holds a min/max envelope of
+# force and position in PREVIEW_BUCKETS buckets, enough to draw or overlay a pull without
+# opening its file. Re-indexing only reads files whose mtime and SHA-1 changed.
+CATALOG_FILE = 'catalog.sqlite'
+SCHEMA_VERSION = 1
+PREVIEW_BUCKETS = 1000
+PREVIEW_COLUMNS = ['time', 'force_min', 'force_max', 'position_min', 'position_max']
+TAGS = ['rig', 'profile', 'operator']  # Set when recording, or by hand with index --rig etc.
+
+METRIC_COLUMNS = FIELDS[1:]  # Everything analyse.py works out except the file name
+
+SCHEMA = f'''
+CREATE TABLE IF NOT EXISTS sessions (
+    id INTEGER PRIMARY KEY,
+    path TEXT NOT NULL UNIQUE,
+    name TEXT NOT NULL,
+    format TEXT NOT NULL,
+    started REAL,
+    ended REAL,
+    rig TEXT,
+    profile TEXT,
+    operator TEXT,
+    {', '.join(f'{name} REAL' for name in METRIC_COLUMNS)},
+    mtime REAL NOT NULL,
+    sha1 TEXT NOT NULL,
+    metrics_version INTEGER NOT NULL,
+    indexed REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS previews (
+    session_id INTEGER PRIMARY KEY REFERENCES sessions(id) ON DELETE CASCADE,
+    buckets INTEGER NOT NULL,
+    data BLOB NOT NULL
+);
+CREATE INDEX IF NOT EXISTS sessions_started ON sessions(started);
+CREATE INDEX IF NOT EXISTS sessions_peak_force ON sessions(peak_force);
+CREATE INDEX IF NOT EXISTS sessions_rig ON sessions(rig, started);
+CREATE INDEX IF NOT EXISTS sessions_profile ON sessions(profile, started);
+CREATE INDEX IF NOT EXISTS sessions_operator ON sessions(operator, started);
+'''
+
+# Function returning a (buckets, 5) float32 envelope of a recording: bucket start time in s, force min/max, position min/max.
+# units is the recording's time units per second (session.time_units), worked out from its time stamps if not given.
+def preview_envelope(samples, buckets=PREVIEW_BUCKETS, units=None):
+    n = len(samples)
+    if n == 0:
+        return np.zeros((0, len(PREVIEW_COLUMNS)), dtype=np.float32)
+    t = np.asarray(samples['time'], dtype=np.float64)
+    force = np.asarray(samples['force'], dtype=np.float64)
+    position = np.asarray(samples['position'], dtype=np.float64)
+    # Buckets of equal sample counts; reduceat handles the last one being short
+    starts = np.unique(np.linspace(0, n, min(buckets, n), endpoint=False).astype(np.int64))
+    out = np.empty((len(starts), len(PREVIEW_COLUMNS)), dtype=np.float32)
+    out[:, 0] = (t[starts] - t[0]) / (detect_units(t) if units is None else units)
+    out[:, 1] = np.minimum.reduceat(force, starts)
+    out[:, 2] = np.maximum.reduceat(force, starts)
+    out[:, 3] = np.minimum.reduceat(position, starts)
+    out[:, 4] = np.maximum.reduceat(position, starts)
+    return out
+
+# Function returning the wall clock start of a recording in Unix seconds, and any tags in its metadata.
+def recording_info(path, duration):
+    meta = {}
+    if os.path.isdir(path):
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+    started = None
+    if meta.get('created'):
+        try:
+            started = datetime.datetime.fromisoformat(meta['created']).timestamp()  # Local time if it has no offset
+        except ValueError:
+            pass
+    if started is None:
+        # Recordings are named pillar_puller_<%Y%m%d-%H%M%S>, when the recording started
+        match = re.search(r'(\d{8}-\d{6})', os.path.basename(path.rstrip(os.sep)))
+        if match:
+            started = time.mktime(time.strptime(match.group(1), "%Y%m%d-%H%M%S"))
+    if started is None:
+        # Otherwise the file was last written when the recording stopped
+        started = os.path.getmtime(path) - (duration if np.isfinite(duration) else 0)
+    return started, {tag: meta[tag] for tag in TAGS if meta.get(tag)}
+
+# Function to read one recording and work out everything the catalogue stores about it. Runs in a worker process.
+def index_file(path):
+    samples = load(path)
+    units = time_units(path, samples['time'])
+    metrics = pull_metrics(samples, units)
+    started, tags = recording_info(path, metrics['duration_s'])
+    preview = preview_envelope(samples, units=units)
+    return metrics, started, tags, preview.shape[0], preview.tobytes()
+
+class Catalog():
+    ''' The session catalogue in a SQLite file.
+
+    One Catalog per thread (sqlite3 connections can't be shared between threads). The
+    database is in WAL mode, so the GUI can query it while another thread is indexing.
+    '''
+    def __init__(self, path=CATALOG_FILE):
+        self.path = path
+        self.db = sqlite3.connect(path, timeout=10)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA foreign_keys=ON')
+        version = self.db.execute('PRAGMA user_version').fetchone()[0]
+        if version not in (0, SCHEMA_VERSION):
+            raise RuntimeError(f"{path} has catalogue schema {version}, this version reads {SCHEMA_VERSION}")
+        with self.db:
+            self.db.executescript(SCHEMA)
+            self.db.execute(f'PRAGMA user_version={SCHEMA_VERSION}')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.db.close()
+
+    def __len__(self):
+        return self.db.execute('SELECT COUNT(*) FROM sessions').fetchone()[0]
+
+    # Function to add or update recordings. Tags (rig, profile, operator) given here override the stored ones.
+    # Returns the number of recordings that had to be read.
+    def index(self, paths, workers=None, **tags):
+        tags = {tag: value for tag, value in tags.items() if value is not None}
+        todo = {}
+        for path in paths:
+            key = os.path.abspath(path).rstrip(os.sep)
+            mtime = file_stamp(path)[0]  # A session directory's own mtime doesn't change as its columns grow
+            row = self.db.execute('SELECT id, mtime, sha1, metrics_version FROM sessions WHERE path = ?', (key,)).fetchone()
+            if row is not None and row['metrics_version'] == METRICS_VERSION:
+                if row['mtime'] == mtime:
+                    self.tag(key, **tags)
+                    continue
+                digest = file_hash(path)
+                if row['sha1'] == digest:
+                    with self.db:  # Touched but not changed
+                        self.db.execute('UPDATE sessions SET mtime = ? WHERE id = ?', (mtime, row['id']))
+                    self.tag(key, **tags)
+                    continue
+            else:
+                digest = file_hash(path)
+            todo[path] = (key, mtime, digest)
+
+        if len(todo) == 1 or workers == 1:
+            for path in todo:
+                self._store(*todo[path], index_file(path), tags)
+        elif todo:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+                futures = {pool.submit(index_file, path): path for path in todo}
+                for future in concurrent.futures.as_completed(futures):
+                    path = futures[future]
+                    self._store(*todo[path], future.result(), tags)
+        return len(todo)
+
+    def _store(self, key, mtime, digest, result, tags):
+        metrics, started, file_tags, buckets, preview = result
+        tags = dict(file_tags, **tags)
+        duration = metrics['duration_s']
+        values = {
+            'path': key,
+            'name': os.path.basename(key),
+            'format': 'session' if os.path.isdir(key) else 'csv',
+            'started': started,
+            'ended': started + duration if np.isfinite(duration) else started,
+            **{tag: tags.get(tag) for tag in TAGS},
+            **{name: _sql_value(metrics[name]) for name in METRIC_COLUMNS},
+            'mtime': mtime,
+            'sha1': digest,
+            'metrics_version': METRICS_VERSION,
+            'indexed': time.time(),
+        }
+        names = list(values)
+        # Re-indexing keeps tags that were set before, unless new ones are given
+        updates = ', '.join(f'{name} = COALESCE(excluded.{name}, {name})' if name in TAGS else f'{name} = excluded.{name}'
+                            for name in names if name != 'path')
+        with self.db:
+            self.db.execute(f'INSERT INTO sessions ({", ".join(names)}) VALUES ({", ".join("?" * len(names))}) '
+                            f'ON CONFLICT(path) DO UPDATE SET {updates}', [values[name] for name in names])
+            session_id = self.db.execute('SELECT id FROM sessions WHERE path = ?', (key,)).fetchone()[0]
+            self.db.execute('INSERT OR REPLACE INTO previews (session_id, buckets, data) VALUES (?, ?, ?)',
+                            (session_id, buckets, preview))
+
+    # Function to set tags of a recording that is already indexed.
+    def tag(self, path, **tags):
+        tags = {tag: value for tag, value in tags.items() if value is not None}
+        unknown = set(tags) - set(TAGS)
+        if unknown:
+            raise ValueError(f"Unknown tags {', '.join(sorted(unknown))}, the catalogue has {', '.join(TAGS)}")
+        if tags:
+            with self.db:
+                self.db.execute(f'UPDATE sessions SET {", ".join(f"{tag} = ?" for tag in tags)} WHERE path = ?',
+                                [*tags.values(), os.path.abspath(path).rstrip(os.sep)])
+
+    # Function to drop recordings whose files are gone. Returns how many were dropped.
+    def prune(self):
+        gone = [(row['id'],) for row in self.db.execute('SELECT id, path FROM sessions') if not os.path.exists(row['path'])]
+        with self.db:
+            self.db.executemany('DELETE FROM sessions WHERE id = ?', gone)
+        return len(gone)
+
+    # Function returning the recordings that match, as dicts, newest first. since/until are Unix seconds.
+    def find(self, min_peak=None, max_peak=None, since=None, until=None, rig=None, profile=None, operator=None,
+             broke=None, name=None, limit=None):
+        where, params = [], []
+        for clause, value in (('peak_force >= ?', min_peak), ('peak_force <= ?', max_peak),
+                              ('started >= ?', since), ('started < ?', until),
+                              ('rig = ?', rig), ('profile = ?', profile), ('operator = ?', operator),
+                              ('name LIKE ?', name)):
+            if value is not None:
+                where.append(clause)
+                params.append(value)
+        if broke is not None:
+            where.append('break_detected = ?')
+            params.append(1 if broke else 0)
+        sql = 'SELECT * FROM sessions'
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        sql += ' ORDER BY started DESC'
+        if limit is not None:
+            sql += ' LIMIT ?'
+            params.append(int(limit))
+        return [dict(row) for row in self.db.execute(sql, params)]
+
+    # Function returning the stored envelope of a recording as a (buckets, 5) array, see PREVIEW_COLUMNS.
+    def preview(self, session_id):
+        row = self.db.execute('SELECT buckets, data FROM previews WHERE session_id = ?', (session_id,)).fetchone()
+        if row is None:
+            return None
+        return np.frombuffer(row['data'], dtype=np.float32).reshape(row['buckets'], len(PREVIEW_COLUMNS))
+
+def _sql_value(value):
+    if isinstance(value, (bool, np.bool_)):
+        return int(value)
+    if isinstance(value, float) and not np.isfinite(value):
+        return None  # NaN can't be compared in SQL, NULL never matches a filter
+    return value
+
+# Function to turn "7d", "12h", "30m" or a date ("2024-08-22", "2024-08-22T14:00") into Unix seconds.
+def parse_time(text):
+    match = re.fullmatch(r'(\d+(?:\.\d+)?)([dhm])', text)
+    if match:
+        return time.time() - float(match.group(1)) * {'d': 86400, 'h': 3600, 'm': 60}[match.group(2)]
+    for fmt in ("%Y-%m-%d", "%Y-%m-%dT%H:%M", "%Y-%m-%dT%H:%M:%S"):
+        try:
+            return time.mktime(time.strptime(text, fmt))
+        except ValueError:
+            pass
+    raise argparse.ArgumentTypeError(f"not a time: {text} (use e.g. 7d, 12h or 2024-08-22)")
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Index recorded pulls in a SQLite catalogue and query it")
+    arg_parser.add_argument('--catalog', default=CATALOG_FILE)
+    commands = arg_parser.add_subparsers(dest='command', required=True)
+    index = commands.add_parser('index', help="add or update recordings (default: pillar_puller_*.csv and *.session here)")
+    index.add_argument('files', nargs='*')
+    index.add_argument('--workers', type=int, default=None)
+    index.add_argument('--prune', action='store_true', help="drop recordings whose files are gone")
+    for tag in TAGS:
+        index.add_argument(f'--{tag}')
+    find = commands.add_parser('find', help="list recordings, newest first")
+    find.add_argument('--min-peak', type=float)
+    find.add_argument('--max-peak', type=float)
+    find.add_argument('--since', type=parse_time, help="e.g. 7d, 12h or 2024-08-22")
+    find.add_argument('--until', type=parse_time)
+    find.add_argument('--name', help="SQL LIKE pattern, e.g. pillar_puller_202408%%")
+    find.add_argument('--broke', action='store_true', default=None, help="only pulls where a break was detected")
+    find.add_argument('--limit', type=int)
+    find.add_argument('--plot', action='store_true', help="overlay the previews of what was found")
+    for tag in TAGS:
+        find.add_argument(f'--{tag}')
+    args = arg_parser.parse_args()
+
+    with Catalog(args.catalog) as catalog:
+        if args.command == 'index':
+            here = os.path.dirname(__file__) or '.'
+            files = args.files or sorted(glob.glob(os.path.join(here, 'pillar_puller_*.csv')) + glob.glob(os.path.join(here, '*.session')))
+            start = time.perf_counter()
+            read = catalog.index(files, args.workers, **{tag: getattr(args, tag) for tag in TAGS})
+            print(f'{len(files)} recordings ({read} read, {len(files) - read} unchanged) in {time.perf_counter() - start:.2f} s, '
+                  f'{len(catalog)} in {args.catalog}')
+            if args.prune:
+                print(f'{catalog.prune()} recordings whose files are gone were dropped')
+        elif args.command == 'find':
+            start = time.perf_counter()
+            rows = catalog.find(args.min_peak, args.max_peak, args.since, args.until, args.rig, args.profile,
+                                args.operator, args.broke, args.name, args.limit)
+            elapsed = time.perf_counter() - start
+            for row in rows:
+                started = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(row['started'])) if row['started'] else '?'
+                print(f"{row['id']:6}  {started}  {row['name']:40} peak {row['peak_force'] if row['peak_force'] is not None else float('nan'):7.2f}"
+                      f"  {row['duration_s'] or 0:8.1f} s  {row['rig'] or '-':8} {row['profile'] or '-':12} {row['operator'] or '-'}")
+            print(f'{len(rows)} of {len(catalog)} recordings in {elapsed * 1000:.1f} ms')
+            if args.plot and rows:
+                import matplotlib.pyplot as plt
+                fig, ax = plt.subplots()
+                for row in rows:
+                    preview = catalog.preview(row['id'])
+                    ax.fill_between(preview[:, 0], preview[:, 1], preview[:, 2], alpha=0.4, label=row['name'])
+                ax.set_xlabel('Time (s)')
+                ax.set_ylabel('Force')
+                if len(rows) <= 10:
+                    ax.legend(loc='upper left')
+                plt.show()
@@ -0,0 +1,201 @@
+import argparse
+import concurrent.futures
+import csv
+import glob
+import hashlib
+import json
+import os
+import time
+import numpy as np
+from analyse import BASELINE_SAMPLES, file_hash, file_stamp
+from breakdetect import BreakDetector
+from session import load, time_units
+from timebase import detect_units
+
+# Comparing many pulls on one graph.
+#
+#   python compare.py pillar_puller_20240822-*.csv --plot
+#   python compare.py *.csv --align break --axis position --start -3 --stop 0.5 --out break_envelope.csv
+#
+# Each pull's time stamps count from whenever its Teensy booted, so pulls are lined up on an
+# event instead: the first contact (force leaving its noise band), the break the host
+# detector finds, or simply the first sample. Force is then resampled onto a common grid of
+# seconds, or of mm of platform travel, from that event, which gives one row per pull, and
+# the mean and standard deviation are taken down the columns.
+#
+# Aligned rows are cached in CACHE_DIR per file content and alignment settings, so adding a
+# pull to a comparison only reads and aligns that one.
+CACHE_DIR = '.compare_cache'
+ALIGN_VERSION = 2  # Bump when the alignment changes, to invalidate the cache
+ALIGN_EVENTS = ('contact', 'break', 'start')
+AXES = ('time', 'position')
+CONTACT_SIGMAS = 5.0  # Contact is the first sample this many noise floors above the baseline force...
+CONTACT_MIN_FORCE = 0.05  # ...and at least this far above it...
+CONTACT_SAMPLES = 20  # ...and stays there for this many samples, so a single spike isn't taken for contact
+DEFAULT_GRIDS = {'time': (-2.0, 30.0, 0.01), 'position': (-0.5, 5.0, 0.005)}  # (start, stop, step) in s or mm
+
+# Function returning the index of the alignment event in a pull, or None if it doesn't have one.
+def find_event(samples, align):
+    force = np.asarray(samples['force'], dtype=np.float64)
+    if align == 'start' or len(force) == 0:
+        return 0 if len(force) else None
+    if align == 'contact':
+        head = force[:min(BASELINE_SAMPLES, len(force))]
+        threshold = np.median(head) + max(CONTACT_SIGMAS * np.std(head), CONTACT_MIN_FORCE)
+        # Runs of CONTACT_SAMPLES samples all above the threshold, from a running count of samples above it
+        above = np.concatenate(([0], np.cumsum(force > threshold)))
+        sustained = np.flatnonzero(above[CONTACT_SAMPLES:] - above[:-CONTACT_SAMPLES] == CONTACT_SAMPLES)
+        return int(sustained[0]) if len(sustained) else None
+    if align == 'break':
+        detector = BreakDetector(force_column=1, position_column=2, time_column=0)
+        event = detector.feed(np.column_stack((samples['time'], force, samples['position'])))
+        return None if event is None else event.index
+    raise ValueError(f"align must be one of {', '.join(ALIGN_EVENTS)}, not {align}")
+
+# Function to resample a pull's force onto grid (seconds or mm from the event). NaN where the pull has no data.
+# units is the pull's time units per second (session.time_units), worked out from its time stamps if not given.
+def align_pull(samples, grid, align='contact', axis='time', units=None):
+    index = find_event(samples, align)
+    if index is None:
+        return None
+    force = np.asarray(samples['force'], dtype=np.float64)
+    if axis == 'time':
+        t = np.asarray(samples['time'], dtype=np.float64)
+        units = detect_units(t) if units is None else units
+        return np.interp(grid, (t - t[index]) / units, force, left=np.nan, right=np.nan)
+    if axis == 'position':
+        x = np.asarray(samples['position'], dtype=np.float64) - samples['position'][index]
+        # Only the loading stroke: the platform's furthest travel so far, at the samples where it moved on
+        furthest = np.maximum.accumulate(x)
+        moved = np.concatenate(([True], np.diff(furthest) > 0))
+        if np.count_nonzero(moved) < 2:
+            return None
+        return np.interp(grid, furthest[moved], force[moved], left=np.nan, right=np.nan)
+    raise ValueError(f"axis must be one of {', '.join(AXES)}, not {axis}")
+
+def make_grid(axis, start=None, stop=None, step=None):
+    default = DEFAULT_GRIDS[axis]
+    start, stop, step = (default[0] if start is None else start, default[1] if stop is None else stop, default[2] if step is None else step)
+    return np.arange(int(round((stop - start) / step)) + 1) * step + start
+
+# Function to align one recording. Runs in a worker process.
+def align_file(path, grid, align, axis):
+    samples = load(path)
+    return align_pull(samples, grid, align, axis, time_units(path, samples['time']))
+
+class Comparison():
+    ''' Pulls aligned on a common grid. curves has one row per pull (NaN where it has no data) '''
+    def __init__(self, grid, align, axis, paths, curves, skipped):
+        self.grid = grid
+        self.align = align
+        self.axis = axis
+        self.paths = paths  # The pulls in curves, in order
+        self.curves = curves
+        self.skipped = skipped  # Pulls without the alignment event
+
+    # Function returning the mean, standard deviation and number of pulls at every grid point.
+    def envelope(self):
+        count = np.count_nonzero(~np.isnan(self.curves), axis=0)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = np.nansum(self.curves, axis=0) / count
+            std = np.sqrt(np.nansum((self.curves - mean) ** 2, axis=0) / count)
+        return mean, std, count
+
+    def write(self, path):
+        mean, std, count = self.envelope()
+        with open(path, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow([self.axis, 'mean', 'std', 'pulls'])
+            writer.writerows(zip(self.grid.tolist(), mean.tolist(), std.tolist(), count.tolist()))
+
+    # Function to draw every pull faintly, and the mean with a band of one standard deviation either side.
+    def plot(self, ax, traces=True, min_pulls=2):
+        mean, std, count = self.envelope()
+        enough = count >= min_pulls
+        if traces:
+            for curve in self.curves:
+                ax.plot(self.grid, curve, color='grey', alpha=0.3, linewidth=0.8)
+        ax.fill_between(self.grid, mean - std, mean + std, where=enough, alpha=0.3, label='mean ± std')
+        ax.plot(self.grid, np.where(enough, mean, np.nan), linewidth=2, label=f'mean of {len(self.curves)} pulls')
+        ax.set_xlabel(f"{'Time (s)' if self.axis == 'time' else 'Platform travel (mm)'} from {self.align}")
+        ax.set_ylabel('Force')
+        ax.legend(loc='upper left')
+
+# Function to align many recordings, reusing cached rows. Returns a Comparison and how many recordings had to be read.
+def compare(paths, align='contact', axis='time', start=None, stop=None, step=None, cache_dir=CACHE_DIR, workers=None):
+    grid = make_grid(axis, start, stop, step)
+    settings = json.dumps([ALIGN_VERSION, align, axis, grid[0], len(grid), float(grid[1] - grid[0]) if len(grid) > 1 else 0,
+                           BASELINE_SAMPLES, CONTACT_SIGMAS, CONTACT_MIN_FORCE, CONTACT_SAMPLES])
+    settings_key = hashlib.sha1(settings.encode()).hexdigest()[:12]
+    os.makedirs(cache_dir, exist_ok=True)
+    index_path = os.path.join(cache_dir, 'index.json')
+    try:
+        with open(index_path) as f:
+            digests = json.load(f)  # Absolute path -> {'stamp', 'sha1'}, so unchanged files aren't hashed again
+    except (OSError, ValueError):
+        digests = {}
+
+    rows = {}
+    todo = {}
+    for path in paths:
+        key = os.path.abspath(path).rstrip(os.sep)
+        stamp = file_stamp(path)
+        entry = digests.get(key)
+        if entry is None or entry.get('stamp') != stamp:
+            entry = digests[key] = {'stamp': stamp, 'sha1': file_hash(path)}
+        cached = os.path.join(cache_dir, f"{entry['sha1']}_{settings_key}.npy")
+        if os.path.exists(cached):
+            rows[path] = np.load(cached)
+        else:
+            todo[path] = cached
+
+    def store(path, curve):
+        # Pulls without the event are cached as an empty row, so they aren't read again either
+        rows[path] = np.zeros(0) if curve is None else curve
+        np.save(todo[path], rows[path])
+
+    if len(todo) == 1 or workers == 1:
+        for path in todo:
+            store(path, align_file(path, grid, align, axis))
+    elif todo:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = {pool.submit(align_file, path, grid, align, axis): path for path in todo}
+            for future in concurrent.futures.as_completed(futures):
+                store(futures[future], future.result())
+
+    tmp = index_path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(digests, f)
+    os.replace(tmp, index_path)
+
+    kept = [path for path in paths if len(rows[path])]
+    curves = np.array([rows[path] for path in kept]).reshape(len(kept), len(grid))
+    return Comparison(grid, align, axis, kept, curves, [path for path in paths if not len(rows[path])]), len(todo)
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Overlay pulls aligned on contact or break, with their mean and spread")
+    arg_parser.add_argument('files', nargs='*', help="CSV files or session directories (default: pillar_puller_*.csv here)")
+    arg_parser.add_argument('--align', choices=ALIGN_EVENTS, default='contact')
+    arg_parser.add_argument('--axis', choices=AXES, default='time', help="resample on seconds or on mm of travel from the event")
+    arg_parser.add_argument('--start', type=float, help="start of the grid, s or mm from the event")
+    arg_parser.add_argument('--stop', type=float)
+    arg_parser.add_argument('--step', type=float)
+    arg_parser.add_argument('--out', help="write the grid, mean, std and number of pulls to this CSV file")
+    arg_parser.add_argument('--plot', action='store_true')
+    arg_parser.add_argument('--cache', default=CACHE_DIR)
+    arg_parser.add_argument('--workers', type=int, default=None)
+    args = arg_parser.parse_args()
+
+    files = args.files or sorted(glob.glob(os.path.join(os.path.dirname(__file__) or '.', 'pillar_puller_*.csv')))
+    start = time.perf_counter()
+    comparison, aligned = compare(files, args.align, args.axis, args.start, args.stop, args.step, args.cache, args.workers)
+    print(f'{len(comparison.paths)} pulls compared ({aligned} aligned, {len(files) - aligned} from cache) in {time.perf_counter() - start:.2f} s')
+    if comparison.skipped:
+        print(f'No {args.align} found in: {", ".join(os.path.basename(path) for path in comparison.skipped)}')
+    if args.out:
+        comparison.write(args.out)
+    if args.plot and len(comparison.paths):
+        import matplotlib.pyplot as plt
+        fig, ax = plt.subplots()
+        comparison.plot(ax)
+        plt.show()
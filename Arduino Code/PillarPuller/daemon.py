@@ -0,0 +1,456 @@
+import argparse
+import getpass
+import json
+import logging
+import re
+import signal
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, quote, unquote, urlparse
+from urllib.request import Request, urlopen
+from calibration import CalibrationStore
+from metrics import log_snapshots
+from profiles import ProfileRunner, load_profile
+from recorder import CsvRecorder
+from rigs import DeviceManager, discover
+from serialbuffer import serialBuffer
+from session import SessionRecorder
+
+logger = logging.getLogger(__name__)
+
+# Running the rigs without the GUI.
+#
+#   python daemon.py --port COM3 --api-port 8766
+#   curl localhost:8766/rigs
+#   curl -X POST localhost:8766/rigs/0/command -d '{"command": "move_to_position", "position": 5}'
+#   curl -X POST localhost:8766/rigs/0/record -d '{"format": "Session"}'
+#   curl -N 'localhost:8766/rigs/0/stream?rate=20'
+#   curl -X POST localhost:8766/rigs/0/record/stop
+#
+# The daemon runs the same host stack as the GUI (serialbuffer.py, the recorders, profiles
+# and the session catalogue) behind a local HTTP API instead of a window. Tk, matplotlib and
+# scipy are never imported, so a small lab PC only spends its CPU reading, recording and
+# answering requests. It listens on 127.0.0.1 only: anyone who can reach it can move the rig.
+#
+#   GET  /rigs                      every rig: connected, binary, samples, recording, latest sample
+#   GET  /rigs/<rig>                one rig
+#   POST /rigs/<rig>/command        {"command": "open" | "close" | "stop" | "home" | "zero_position" | "break"
+#                                    | "binary" | "ascii" | "move_to_position", "position": whole mm}
+#   POST /rigs/<rig>/record         {"format": "CSV" | "Session", "filename": optional}
+#   POST /rigs/<rig>/record/stop
+#   POST /rigs/<rig>/profile        {"profile": path of a test profile}, stop aborts it
+#   GET  /rigs/<rig>/stream?rate=N  newline-delimited JSON, see Subscription
+#   GET  /metrics                   the latest metrics snapshot of every rig
+#
+# <rig> is the rig's index in GET /rigs or its port, URL-quoted. Errors come back as
+# {"error": message} with status 400 (bad request), 404 (no such rig), 409 (not now, or the
+# recorder couldn't write its file) or 500 (a bug, logged with its traceback).
+API_PORT = 8766
+STATUS_INTERVAL = 0.1  # Seconds between draining the rigs' status lines into the log
+METRICS_INTERVAL = 1.0
+METRICS_LOG = 'metrics.jsonl'  # Every METRICS_LOG_INTERVAL snapshots are appended here, as the GUI does
+METRICS_LOG_INTERVAL = 10
+MAX_STREAM_RATE = 200  # Lines per second a subscriber can ask for
+
+class ApiError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+class Subscription():
+    ''' Follows a rig's ring buffer for one client, a line every 1 / rate seconds.
+
+    Each line sums up the samples that arrived since the last: their number, the last time
+    stamp, host receive time and position, and the min, mean and max of the force columns,
+    calibrated with the rig's calibration (without creep, which needs the whole history).
+    '''
+    def __init__(self, buffer, rate=20.0):
+        self.buffer = buffer
+        self.interval = 1.0 / min(max(rate, 0.1), MAX_STREAM_RATE)
+        self._position = buffer.samples.total
+
+    # Function returning the next line as a dict, or None if nothing arrived. lost counts samples the ring overwrote first.
+    def next(self):
+        block, self._position, lost = self.buffer.samples.read_since(self._position)
+        if len(block) == 0:
+            return None
+        calibration = self.buffer.calibration
+        line = {'n': len(block), 'lost': lost, 'time': int(block['time'][-1]), 'received': float(block['received'][-1]),
+                'position': float(calibration.position(block['position'][-1]))}
+        for name in ('force', 'filtered'):
+            values = calibration.force(block[name])
+            line[name] = [float(values.min()), float(values.mean()), float(values.max())]
+        return line
+
+class Daemon():
+    ''' The rigs, their recorders and profile runners, without a GUI. All methods are safe to call from the API's threads '''
+    RECORDING_MAX_BYTES = 500 * 1024 * 1024
+    CATALOG = 'catalog.sqlite'
+
+    def __init__(self, manager, calibrations=None, catalog=CATALOG):
+        self.manager = manager
+        self.calibrations = calibrations or CalibrationStore()
+        self.catalog = catalog
+        self.recorders = {}  # Port -> {"CSV": CsvRecorder, "Session": SessionRecorder}
+        self.active = {}  # Port -> the recorder recording on that rig
+        self.failed = {}  # Port -> the last recorder on that rig that stopped because it couldn't write
+        self.profile_runners = {}  # Port -> the ProfileRunner last started on that rig
+        self.latest_metrics = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        for port, buffer in manager.items():
+            self.add_rig(port, buffer)
+
+    def add_rig(self, port, buffer):
+        calibration = self.calibrations.latest(port)
+        if calibration is not None:
+            buffer.set_calibration(calibration)
+        csv_recorder = CsvRecorder(buffer.samples, max_bytes=self.RECORDING_MAX_BYTES, metrics=buffer.metrics)
+        session_recorder = SessionRecorder(buffer.samples, max_bytes=self.RECORDING_MAX_BYTES, metrics=buffer.metrics)
+        buffer.command_listeners.append(session_recorder.log_command)
+        self.recorders[port] = {"CSV": csv_recorder, "Session": session_recorder}
+
+    # Function returning the port of a rig given by index or port.
+    def rig(self, name):
+        ports = list(self.manager)
+        if name.isdigit() and int(name) < len(ports):
+            return ports[int(name)]
+        if name in self.manager.rigs:
+            return name
+        raise ApiError(404, f"No rig {name}")
+
+    def status(self, port):
+        buffer = self.manager[port]
+        latest = buffer.samples.latest()
+        recorder = self.active.get(port)
+        runner = self.profile_runners.get(port)
+        return {
+            'port': port,
+            'connected': buffer.session.connected,
+            'ever_connected': buffer.session.ever_connected,
+            'binary': buffer.session.binary,
+            'samples': buffer.samples.total,
+            'latest': None if latest is None else {name: latest[name].item() for name in latest.dtype.names},
+            'recording': recorder.files if recorder is not None and recorder.recording else None,
+            'recording_error': str(self.failed[port].error) if port in self.failed else None,
+            'profile': runner.profile['name'] if runner is not None and runner.running else None,
+            'calibration': buffer.calibration.version,
+            'break': None if not buffer.break_detector.triggered else vars(buffer.break_detector.event),
+        }
+
+    # Function to send one of the GUI's commands. Returns the latency in seconds once it has been written.
+    def command(self, port, command, position=None, timeout=2.0):
+        buffer = self.manager[port]
+        if command == 'stop':
+            runner = self.profile_runners.get(port)
+            if runner is not None and runner.running:
+                runner.abort()
+            future = buffer.send_command("stop")
+        elif command in ('open', 'close', 'home', 'zero_position'):
+            if command == 'open':
+                buffer.break_detector.reset()
+            future = buffer.send_command(command)
+        elif command == 'break':
+            # Open until the pillar breaks, the host watches for the break and sends stop
+            buffer.break_detector.reset()
+            buffer.stop_on_break = True
+            future = buffer.send_command("break")
+        elif command in ('binary', 'ascii'):
+            future = buffer.set_binary_mode(command == 'binary')
+        elif command == 'move_to_position':
+            if not isinstance(position, int) or isinstance(position, bool):
+                raise ApiError(400, "move_to_position needs a whole number of mm as position")
+            future = buffer.send_command(f"move_to_position{position}")
+        else:
+            raise ApiError(400, f"Unknown command {command!r}")
+        try:
+            return future.result(timeout + 1.0)
+        except Exception as e:
+            raise ApiError(409, f"{command} was not sent to {port}: {e!r}")
+
+    def start_recording(self, port, format='Session', filename=None):
+        if format not in ('CSV', 'Session'):
+            raise ApiError(400, "format must be CSV or Session")
+        if filename is not None and not isinstance(filename, str):
+            raise ApiError(400, "filename must be a string")
+        with self._lock:
+            recorder = self.active.get(port)
+            if recorder is not None and recorder.recording:
+                raise ApiError(409, f"{port} is already recording to {recorder.filename}")
+            recorder = self.recorders[port][format]
+            extension = '.session' if format == 'Session' else '.csv'
+            rig = '_' + re.sub(r'[^A-Za-z0-9]+', '_', port).strip('_') if len(self.manager) > 1 else ''
+            filename = f'{filename}{rig}{extension}' if filename else f'pillar_puller_{time.strftime("%Y%m%d-%H%M%S")}{rig}{extension}'
+            tags = self.tags(port)
+            if isinstance(recorder, SessionRecorder):
+                recorder.metadata = tags
+                recorder.calibration = self.manager[port].calibration.to_dict()
+            recorder.start(filename)
+            recorder.tags = tags
+            self.active[port] = recorder
+            self.failed.pop(port, None)
+        logger.info(f"[{port}] Recording to {recorder.filename}")
+        return recorder.filename
+
+    def stop_recording(self, port):
+        self.check_recordings()
+        with self._lock:
+            recorder = self.active.pop(port, None)
+        if recorder is None:
+            failed = self.failed.get(port)
+            raise ApiError(409, f"{port} is not recording" + (f", it stopped: {failed.error}" if failed is not None else ""))
+        recorder.stop()
+        logger.info(f"[{port}] Recorded {recorder.rows} samples to {', '.join(recorder.files)}")
+        threading.Thread(target=self.catalog_recording, args=(recorder.files, recorder.tags), daemon=True).start()
+        return recorder.files
+
+    # Function to close recordings that stopped by themselves because they couldn't be written.
+    # They move to self.failed, so GET /rigs shows the error until the next recording starts.
+    def check_recordings(self):
+        with self._lock:
+            failed = [(port, recorder) for port, recorder in self.active.items() if not recorder.recording]
+            for port, recorder in failed:
+                self.failed[port] = self.active.pop(port)
+        for port, recorder in failed:
+            recorder.stop()
+            logger.error(f"[{port}] Recording stopped: {recorder.error}. {recorder.rows} samples were written to {', '.join(recorder.files)}")
+            if recorder.rows:
+                threading.Thread(target=self.catalog_recording, args=(recorder.files, recorder.tags), daemon=True).start()
+
+    def run_profile(self, port, path):
+        runner = self.profile_runners.get(port)
+        if runner is not None and runner.running:
+            raise ApiError(409, f"{port} is already running {runner.profile['name']}")
+        if not isinstance(path, str) or not path:
+            raise ApiError(400, "profile must be the path of a test profile")  # open() takes a number as a file descriptor
+        try:
+            profile = load_profile(path)
+        except (OSError, ValueError) as e:
+            raise ApiError(400, f"Can't run {path}: {e}")
+        rig = '_' + re.sub(r'[^A-Za-z0-9]+', '_', port).strip('_') if len(self.manager) > 1 else ''
+        log_path = f'profile_{profile["name"]}_{time.strftime("%Y%m%d-%H%M%S")}{rig}.csv'
+        self.profile_runners[port] = ProfileRunner(self.manager[port], profile, log_path=log_path).start()
+        return log_path
+
+    # Tags stored with a recording in the session catalogue
+    def tags(self, port):
+        runner = self.profile_runners.get(port)
+        return {'rig': port, 'operator': getpass.getuser(), 'profile': runner.profile['name'] if runner is not None and runner.running else None}
+
+    def catalog_recording(self, files, tags):
+        try:
+            from catalog import Catalog
+            with Catalog(self.catalog) as catalog:
+                catalog.index(files, workers=1, **tags)
+            logger.info(f"Added {', '.join(files)} to {self.catalog}")
+        except Exception as e:
+            logger.error(f"Couldn't add {', '.join(files)} to {self.catalog}: {e}")
+
+    # Function to log the rigs' status lines and take their metrics until close(). Runs on the main thread.
+    def run(self):
+        next_metrics = time.monotonic()
+        updates = 0
+        missing = {}
+        while not self._stop.wait(STATUS_INTERVAL):
+            for port, buffer in self.manager.items():
+                while buffer.status_lines:
+                    logger.info(f"[{port}] Device: {buffer.status_lines.popleft()}")
+            self.check_recordings()
+            if time.monotonic() >= next_metrics:
+                next_metrics += METRICS_INTERVAL
+                self.latest_metrics = {port: buffer.metrics_snapshot() for port, buffer in self.manager.items()}
+                updates += 1
+                if updates % METRICS_LOG_INTERVAL == 0:
+                    log_snapshots(METRICS_LOG, self.latest_metrics)
+                for port, snapshot in self.latest_metrics.items():
+                    total = snapshot['counters'].get('reader.missing_samples', 0)
+                    if total > missing.get(port, total):
+                        logger.warning(f"[{port}] {total - missing[port]} samples missing from the Teensy's time stamps")
+                    missing[port] = total
+
+    def close(self):
+        self._stop.set()
+        for runner in self.profile_runners.values():
+            runner.abort()
+            runner.join(2.0)
+        for recorder in self.active.values():
+            recorder.stop()  # Finish writing the current recordings
+        self.manager.close()
+
+class ControlServer():
+    ''' The daemon's HTTP API on host:port, served from background threads '''
+    def __init__(self, daemon, port=API_PORT, host='127.0.0.1'):
+        self.daemon = daemon
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                self._handle('GET')
+
+            def do_POST(self):
+                self._handle('POST')
+
+            def _handle(self, method):
+                url = urlparse(self.path)
+                parts = [unquote(part) for part in url.path.strip('/').split('/') if part]
+                self.streaming = False
+                try:
+                    length = int(self.headers.get('Content-Length') or 0)
+                    try:
+                        body = json.loads(self.rfile.read(length) or b'{}')
+                    except ValueError:
+                        raise ApiError(400, "The body must be JSON")
+                    if not isinstance(body, dict):
+                        raise ApiError(400, "The body must be a JSON object")
+                    if method == 'GET' and parts[-1:] == ['stream'] and len(parts) == 3:
+                        self._stream(daemon.rig(parts[1]), parse_qs(url.query))
+                        return
+                    self._reply(200, route(method, parts, body))
+                except ApiError as e:
+                    self._reply(e.status, {'error': str(e)})
+                except OSError as e:
+                    # The recorders' files: a name already taken, a full disk...
+                    logger.error(f"{method} {url.path}: {e}")
+                    self._reply(409, {'error': str(e)})
+                except Exception as e:
+                    logger.exception(f"{method} {url.path} failed")
+                    self._reply(500, {'error': repr(e)})
+
+            def _reply(self, status, data):
+                if self.streaming:
+                    return  # The stream's headers have gone, there is no way to answer any more
+                body = json.dumps(data).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _stream(self, port, query):
+                try:
+                    rate = float(query.get('rate', ['20'])[0])
+                except ValueError:
+                    raise ApiError(400, "rate must be a number of lines per second")
+                subscription = Subscription(daemon.manager[port], rate)
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/x-ndjson')
+                self.end_headers()
+                self.streaming = True
+                calibration = daemon.manager[port].calibration
+                head = {'rig': port, 'interval': subscription.interval, 'unit': calibration.unit, 'calibration': calibration.version}
+                try:
+                    self.wfile.write((json.dumps(head) + '\n').encode('utf-8'))
+                    deadline = time.monotonic()
+                    while not daemon._stop.is_set():
+                        deadline += subscription.interval
+                        time.sleep(max(deadline - time.monotonic(), 0))
+                        line = subscription.next()
+                        if line is not None:
+                            self.wfile.write((json.dumps(line) + '\n').encode('utf-8'))
+                            self.wfile.flush()
+                except (BrokenPipeError, ConnectionResetError):
+                    pass  # The client unsubscribed
+
+            def log_message(self, format, *args):
+                pass  # The daemon logs what the requests do
+
+        def route(method, parts, body):
+            if parts == ['metrics'] and method == 'GET':
+                return daemon.latest_metrics
+            if parts[:1] != ['rigs']:
+                raise ApiError(404, "Not found")
+            if len(parts) == 1 and method == 'GET':
+                return [daemon.status(port) for port in daemon.manager]
+            if len(parts) == 1:
+                raise ApiError(404, "Not found")
+            port = daemon.rig(parts[1])
+            action = parts[2:]
+            if not action and method == 'GET':
+                return daemon.status(port)
+            if method != 'POST':
+                raise ApiError(404, "Not found")
+            if action == ['command']:
+                latency = daemon.command(port, body.get('command'), body.get('position'))
+                return {'command': body.get('command'), 'latency': latency}
+            if action == ['record']:
+                return {'filename': daemon.start_recording(port, body.get('format', 'Session'), body.get('filename'))}
+            if action == ['record', 'stop']:
+                return {'files': daemon.stop_recording(port)}
+            if action == ['profile']:
+                return {'log': daemon.run_profile(port, body.get('profile', ''))}
+            raise ApiError(404, "Not found")
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True  # Streams end with the daemon
+        self.port = self.httpd.server_address[1]
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+class DaemonClient():
+    ''' Talks to a running daemon, for scripts (and a GUI that doesn't own the rigs) '''
+    def __init__(self, url=f'http://127.0.0.1:{API_PORT}', timeout=5.0):
+        self.url = url.rstrip('/')
+        self.timeout = timeout
+
+    def _request(self, path, body=None):
+        data = None if body is None else json.dumps(body).encode('utf-8')
+        request = Request(self.url + path, data=data, method='GET' if body is None else 'POST')
+        with urlopen(request, timeout=self.timeout) as response:
+            return json.load(response)
+
+    def rigs(self):
+        return self._request('/rigs')
+
+    def command(self, rig, command, position=None):
+        return self._request(f'/rigs/{quote(str(rig), safe="")}/command', {'command': command, 'position': position})
+
+    def start_recording(self, rig, format='Session', filename=None):
+        return self._request(f'/rigs/{quote(str(rig), safe="")}/record', {'format': format, 'filename': filename})
+
+    def stop_recording(self, rig):
+        return self._request(f'/rigs/{quote(str(rig), safe="")}/record/stop', {})
+
+    # Generator of the lines of a rig's live stream, the first one its header.
+    def stream(self, rig, rate=20):
+        with urlopen(f'{self.url}/rigs/{quote(str(rig), safe="")}/stream?rate={rate}', timeout=self.timeout) as response:
+            for line in response:
+                yield json.loads(line)
+
+if __name__ == "__main__":
+    logging.basicConfig(format="%(asctime)s %(levelname)s %(message)s", datefmt="%Y-%m-%d %I:%M:%S%p", level=logging.INFO)
+    arg_parser = argparse.ArgumentParser(description="Run pillar puller rigs without the GUI, controlled over a local HTTP API")
+    arg_parser.add_argument('--port', action='append', help="serial port of a rig (or of simulator.py), repeat for several rigs. "
+                            "Default: every Teensy plugged in, found by USB id")
+    arg_parser.add_argument('--api-port', type=int, default=API_PORT)
+    arg_parser.add_argument('--in-process', action='store_true', help="read the serial ports on threads of this process "
+                            "instead of a worker process per rig")
+    arg_parser.add_argument('--spill-dir', default=serialBuffer.SPILL_DIR, help="where samples that no longer fit in memory are "
+                            "kept while running, to recover them after a crash (default: %(default)s)")
+    arg_parser.add_argument('--keep-spill', action='store_true', help="keep the spill when closing cleanly instead of deleting it")
+    args = arg_parser.parse_args()
+
+    manager = DeviceManager(lambda port: serialBuffer(port, in_process=args.in_process, spill_dir=args.spill_dir, keep_spill=args.keep_spill))
+    ports = args.port or discover()
+    if not ports:
+        arg_parser.error("No rigs found by USB id, give their ports with --port")
+    for port in ports:
+        manager.add(port)
+    manager.start()
+    daemon = Daemon(manager)
+    server = ControlServer(daemon, args.api_port).start()
+    logger.info(f"Serving {', '.join(ports)} on http://127.0.0.1:{server.port}")
+    signal.signal(signal.SIGTERM, lambda signum, frame: daemon._stop.set())
+    try:
+        daemon.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        daemon.close()
@@ -0,0 +1,236 @@
+import asyncio
+import itertools
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import serial
+from timebase import DeviceClock
+
+logger = logging.getLogger(__name__)
+
+# Commands that jump the write queue. Lower runs first.
+PRIORITY = {'stop': 0}
+DEFAULT_PRIORITY = 10
+
+class DeviceSession():
+    ''' Owns the serial port and runs all I/O on an asyncio loop in a background thread.
+
+    A reader task hands every block it reads to buffer.ingest(), with the time column
+    unwrapped and the host receive time as an extra column (see timebase.DeviceClock). Commands go through
+    one writer task, in a priority queue so "stop" never waits behind other commands,
+    and are written on their own thread so they never wait for a blocking read. If
+    the port disappears the session keeps trying to reopen it.
+
+    If metrics (a metrics.Metrics) is given, the reader and writer record reader.* and
+    commands.* metrics into it.
+
+    The Tk thread (or any other) calls submit(), which returns a concurrent.futures.Future
+    resolving to the command's latency in seconds from submit to written.
+    '''
+    def __init__(self, buffer, port, baudrate, read_timeout=0.05, reconnect_interval=1.0, metrics=None):
+        self.buffer = buffer  # Anything with decoder.read(ser) and ingest(samples, status)
+        self.port = port
+        self.baudrate = baudrate
+        self.read_timeout = read_timeout
+        self.reconnect_interval = reconnect_interval
+        self.metrics = metrics
+        self.clock = DeviceClock()  # Unwraps the Teensy's time stamps, works out their units and adds the host receive time, see timebase.py
+        self._decoder_totals = {}
+        self.ser = None
+        self.latencies = {}  # Command name -> deque of recent submit-to-written latencies in seconds
+        self.reconnects = 0
+        self._ever_connected = False
+        self._loop = None
+        self._thread = None
+        self._queue = None
+        self._connected = None
+        self._waiters = []  # (text, future) pairs resolved when a status line containing text arrives
+        self._order = itertools.count()  # Keeps commands of equal priority in order
+        self._read_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='serial-read')
+        self._write_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='serial-write')
+
+    @property
+    def connected(self):
+        return self._connected is not None and self._connected.is_set()
+
+    # Whether the port has been open at some point, i.e. not connected means lost rather than still connecting
+    @property
+    def ever_connected(self):
+        return self._ever_connected
+
+    # Whether the decoder has switched to binary frames
+    @property
+    def binary(self):
+        return self.buffer.decoder.binary
+
+    # Function to start the session thread. Returns once the event loop is running.
+    def start(self):
+        started = threading.Event()
+        self._thread = threading.Thread(target=self._run, args=(started,), daemon=True)
+        self._thread.start()
+        started.wait()
+
+    # Function to stop the session and close the port.
+    def close(self, timeout=2.0):
+        if self._loop is not None and self._loop.is_running():
+            self._loop.call_soon_threadsafe(self._main_task.cancel)
+            self._thread.join(timeout)
+        self._close_port()
+        self._read_executor.shutdown(wait=False)
+        self._write_executor.shutdown(wait=False)
+
+    # Function to send a command from any thread. If expect is given, the future only resolves
+    # once a status line containing it arrives (e.g. "BINARY ON"), or fails after timeout seconds.
+    def submit(self, command, expect=None, timeout=2.0):
+        return asyncio.run_coroutine_threadsafe(self.send(command, expect, timeout), self._loop)
+
+    # Coroutine version of submit, for code already running on the session loop.
+    async def send(self, command, expect=None, timeout=2.0):
+        loop = asyncio.get_running_loop()
+        submitted = time.perf_counter()
+        written = loop.create_future()
+        acknowledged = None
+        if expect is not None:
+            acknowledged = loop.create_future()
+            self._waiters.append((expect, acknowledged))
+        name = command.split()[0] if command.strip() else command
+        await self._queue.put((PRIORITY.get(name, DEFAULT_PRIORITY), next(self._order), command, written))
+        try:
+            await asyncio.wait_for(written, timeout)
+            if acknowledged is not None:
+                await asyncio.wait_for(acknowledged, max(timeout - (time.perf_counter() - submitted), 0))
+        finally:
+            if acknowledged is not None:
+                self._waiters = [(text, fut) for text, fut in self._waiters if fut is not acknowledged]
+        latency = time.perf_counter() - submitted
+        self.latencies.setdefault(name, deque(maxlen=1000)).append(latency)
+        if self.metrics is not None:
+            self.metrics.observe('commands.latency', latency)
+        return latency
+
+    def _run(self, started):
+        self._loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self._loop)
+        self._queue = asyncio.PriorityQueue()
+        self._connected = asyncio.Event()
+        self._main_task = self._loop.create_task(self._main())
+        self._loop.call_soon(started.set)
+        try:
+            self._loop.run_until_complete(self._main_task)
+        except asyncio.CancelledError:
+            pass
+        finally:
+            self._loop.close()
+
+    async def _main(self):
+        writer = asyncio.create_task(self._writer())
+        try:
+            await self._reader()
+        finally:
+            writer.cancel()
+
+    async def _reader(self):
+        loop = asyncio.get_running_loop()
+        decoder = self.buffer.decoder
+        while True:
+            if not self.connected:
+                await self._connect()
+            received = decoder.bytes
+            try:
+                samples, status = await loop.run_in_executor(self._read_executor, decoder.read, self.ser)
+            except (serial.SerialException, OSError) as e:
+                logger.warning(f"Lost {self.port}: {e}")
+                self._close_port()
+                continue
+            start = time.perf_counter()
+            samples = self.clock.feed(samples, time.time())
+            self.buffer.ingest(samples, status)
+            if self.metrics is not None:
+                self._record_read(decoder.bytes - received, samples, status, time.perf_counter() - start)
+            if status and self._waiters:
+                for text, fut in self._waiters:
+                    if not fut.done() and any(text in line for line in status):
+                        fut.set_result(True)
+
+    async def _writer(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            priority, order, command, written = await self._queue.get()
+            if self.metrics is not None:
+                self.metrics.gauge('commands.queued', self._queue.qsize())
+            if written.done():  # The caller timed out while it was queued
+                continue
+            await self._connected.wait()
+            try:
+                await loop.run_in_executor(self._write_executor, self._write, command)
+            except (serial.SerialException, OSError) as e:
+                if not written.done():
+                    written.set_exception(e)
+                continue
+            if not written.done():
+                written.set_result(True)
+
+    def _record_read(self, nbytes, samples, status, ingest_time):
+        metrics = self.metrics
+        decoder = self.buffer.decoder
+        metrics.count('reader.reads')
+        metrics.count('reader.bytes', nbytes)
+        metrics.count('reader.samples', len(samples))
+        metrics.count('reader.status_lines', len(status))
+        metrics.gauge('reader.backlog_bytes', nbytes)  # Everything waiting in the OS buffer is read at once
+        # The decoders keep running totals, count what changed since the last read
+        totals = {
+            'reader.lines': decoder.lines.lines,
+            'reader.parse_errors': decoder.lines.errors + decoder.frames.corrupt,
+            'reader.frames': decoder.frames.frames,
+            'reader.dropped_frames': decoder.frames.dropped,
+            'reader.missing_samples': self.clock.missing,
+            'reader.duplicate_samples': self.clock.duplicates,
+            'reader.clock_wraps': self.clock.wraps,
+            'reader.device_restarts': self.clock.restarts,
+        }
+        for name, total in totals.items():
+            if total != self._decoder_totals.get(name, 0):
+                metrics.count(name, total - self._decoder_totals.get(name, 0))
+        self._decoder_totals = totals
+        metrics.observe('reader.ingest', ingest_time)
+        if self.clock.gaps.interval and self.clock.units_per_second:
+            metrics.gauge('reader.sample_interval_us', self.clock.gaps.interval / self.clock.units_per_second * 1e6)
+        if self.clock.drift is not None:
+            metrics.gauge('reader.clock_drift_ppm', self.clock.drift)
+        if len(samples) > 0 and self.clock.latency is not None:
+            metrics.observe('reader.latency', self.clock.latency)
+
+    def _write(self, command):
+        self.ser.write((command + '\n').encode('utf-8'))
+        self.ser.flush()
+
+    async def _connect(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                self.ser = await loop.run_in_executor(self._read_executor, self._open_port)
+            except (serial.SerialException, OSError) as e:
+                logger.debug(f"Could not open {self.port}: {e}")
+                await asyncio.sleep(self.reconnect_interval)
+                continue
+            if self._ever_connected:
+                self.reconnects += 1
+                logger.info(f"Reconnected to {self.port}")
+            self._ever_connected = True
+            self._connected.set()
+            return
+
+    def _open_port(self):
+        return serial.Serial(self.port, self.baudrate, timeout=self.read_timeout, write_timeout=1.0)
+
+    def _close_port(self):
+        if self._connected is not None:
+            self._connected.clear()
+        if self.ser is not None:
+            try:
+                self.ser.close()
+            except (serial.SerialException, OSError):
+                pass
@@ -0,0 +1,169 @@
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from scipy import signal
+from ringbuffer import RingBuffer
+
+# Streaming filters for the sample stream. Every stage keeps its state between blocks, so
+# feeding a recording block by block gives the same output as filtering it all at once,
+# and nothing is ever filtered twice.
+#
+# A stage's process(times, values) takes the time stamps (n,) and one or more value
+# columns (n, k) of a block and returns the same for its output. Filters return one
+# output per input; Decimate returns every factor-th. Filters are causal, so their output
+# lags the input by their group delay.
+#
+#   smooth = Pipeline(MedianDespike(5), LowPass(50, SAMPLE_RATE))
+#   slow = Pipeline(LowPass(50, SAMPLE_RATE), Decimate(10))
+SAMPLE_RATE = 1e6 / 597  # Hz, the Teensy's sample spacing in the recorded sessions
+
+class Stage():
+    ''' Base class of the streaming stages '''
+    def process(self, times, values):
+        raise NotImplementedError
+
+    # Function to forget the stream so far, e.g. at the start of a new pull.
+    def reset(self):
+        pass
+
+class LinearFilter(Stage):
+    ''' Filters every column with b/a coefficients using scipy.signal.lfilter, carrying its state.
+
+    The state starts as if the first sample had been there forever, so there is no
+    settling transient at the start of the stream.
+    '''
+    def __init__(self, b, a=1.0):
+        self.b = np.atleast_1d(np.asarray(b, dtype=np.float64))
+        self.a = np.atleast_1d(np.asarray(a, dtype=np.float64))
+        self._zi_unit = signal.lfilter_zi(self.b, self.a)
+        self._zi = None
+
+    def reset(self):
+        self._zi = None
+
+    def process(self, times, values):
+        if len(values) == 0:
+            return times, values
+        if self._zi is None:
+            self._zi = self._zi_unit[:, np.newaxis] * values[0]
+        out, self._zi = signal.lfilter(self.b, self.a, values, axis=0, zi=self._zi)
+        return times, out
+
+class LowPass(LinearFilter):
+    ''' Butterworth IIR low pass. cutoff and sample_rate in Hz '''
+    def __init__(self, cutoff, sample_rate=SAMPLE_RATE, order=2):
+        b, a = signal.butter(order, cutoff, fs=sample_rate)
+        super().__init__(b, a)
+
+class FIRLowPass(LinearFilter):
+    ''' Windowed-sinc FIR low pass, linear phase with a delay of (taps - 1) / 2 samples '''
+    def __init__(self, cutoff, sample_rate=SAMPLE_RATE, taps=63):
+        super().__init__(signal.firwin(taps, cutoff, fs=sample_rate))
+
+class MovingAverage(LinearFilter):
+    ''' Mean of the last n samples '''
+    def __init__(self, n):
+        super().__init__(np.full(n, 1.0 / n))
+
+class MedianDespike(Stage):
+    ''' Running median of the last window samples (window odd).
+
+    With threshold set, a sample is only replaced by the median when it is more than
+    threshold away from it, so the signal passes through untouched apart from spikes.
+    '''
+    def __init__(self, window=5, threshold=None):
+        if window % 2 == 0:
+            raise ValueError("window must be odd")
+        self.window = window
+        self.threshold = threshold
+        self._history = None  # The last window - 1 input samples
+
+    def reset(self):
+        self._history = None
+
+    def process(self, times, values):
+        if len(values) == 0:
+            return times, values
+        if self._history is None:
+            self._history = np.repeat(values[:1], self.window - 1, axis=0)
+        padded = np.concatenate((self._history, values))
+        self._history = padded[len(padded) - (self.window - 1):]
+        middle = self.window // 2
+        median = np.partition(sliding_window_view(padded, self.window, axis=0), middle, axis=-1)[..., middle]
+        if self.threshold is None:
+            return times, median
+        return times, np.where(np.abs(values - median) > self.threshold, median, values)
+
+class Decimate(Stage):
+    ''' Anti-aliased decimation: a FIR low pass at 0.8 of the new Nyquist frequency, then every factor-th sample.
+
+    Only the samples that are kept are filtered. Which ones are kept carries over
+    between blocks, so any block size gives the same output.
+    '''
+    def __init__(self, factor, taps=None):
+        self.factor = factor
+        taps = taps or 8 * factor + 1
+        self._kernel = signal.firwin(taps, 0.8 / factor)[::-1]  # Reversed, to dot with windows oldest first
+        self._history = None  # The last taps - 1 input samples
+        self._phase = 0  # Index in the next block of the next sample to keep
+
+    def reset(self):
+        self._history = None
+        self._phase = 0
+
+    def process(self, times, values):
+        n = len(values)
+        if n == 0:
+            return times, values
+        taps = len(self._kernel)
+        if self._history is None:
+            self._history = np.repeat(values[:1], taps - 1, axis=0)
+        padded = np.concatenate((self._history, values))
+        self._history = padded[len(padded) - (taps - 1):]
+        keep = np.arange(self._phase, n, self.factor)
+        self._phase = (self._phase - n) % self.factor
+        # Window i of padded ends at values[i]
+        return times[keep], sliding_window_view(padded, taps, axis=0)[keep] @ self._kernel
+
+class Pipeline(Stage):
+    ''' Stages run one after the other '''
+    def __init__(self, *stages):
+        self.stages = list(stages)
+
+    def reset(self):
+        for stage in self.stages:
+            stage.reset()
+
+    def process(self, times, values):
+        for stage in self.stages:
+            times, values = stage.process(times, values)
+        return times, values
+
+class Channel():
+    ''' A filtered copy of some columns of the sample stream, kept in its own RingBuffer.
+
+    The raw samples stay untouched in serialBuffer.samples (and are what gets recorded);
+    each channel sees every block once as it arrives, so reading a channel is as cheap as
+    reading the raw buffer.
+    '''
+    def __init__(self, pipeline, columns=('force', 'filtered'), capacity=200000, source_columns=('time', 'force', 'position', 'filtered')):
+        self.pipeline = pipeline
+        self.names = list(columns)
+        self._index = [source_columns.index(name) for name in columns]
+        self._time_index = source_columns.index('time')
+        self.samples = RingBuffer(capacity, dtype=[('time', 'f8')] + [(name, 'f8') for name in columns])
+
+    # Function to filter a block of (n, columns) samples from the parser and store the result.
+    def feed(self, block):
+        block = np.asarray(block, dtype=np.float64)
+        if len(block) == 0:
+            return
+        times, values = self.pipeline.process(block[:, self._time_index], block[:, self._index])
+        if len(times):
+            self.samples.extend(np.column_stack((times, values)))
+
+    def reset(self):
+        self.pipeline.reset()
+
+    # Function to return the last n output samples of the channel as (time, column, ...) arrays.
+    def columns(self, n=None):
+        return self.samples.columns(n)
@@ -0,0 +1,260 @@
+import argparse
+import hashlib
+import json
+import os
+import time
+import numpy as np
+from liveplot import minmax_decimate
+from session import convert_csv, open_session
+from timebase import FIRMWARE_UNITS, detect_units, unwrap
+
+# Viewing whole recordings, however long, at interactive speed.
+#
+#   python history.py pillar_puller_20240826-124612.csv
+#
+# Every column of a session gets a min/max pyramid, kept in PYRAMID_CACHE (one directory per
+# session, never inside the session, which holds only its columns and meta.json): level 1 holds the min and max of every FACTOR samples, level 2 of every FACTOR**2 and so
+# on. Drawing a range reads the level that has between `points` and FACTOR * `points`
+# buckets in it, from memory-mapped files, so the cost of a redraw depends on the width of
+# the graph and not on the length of the recording. CSV files are converted to a session
+# the first time they are opened (session.convert_csv).
+#
+# The x axis needs time stamps that only go up. Sessions recorded since timebase.py are
+# unwrapped already, but converted CSV files keep the Teensy's raw stamps, which start again
+# from zero when it restarts. The build notes whether the time column is sorted, and if it
+# isn't, the viewer unwraps it in memory (timebase.unwrap) before drawing.
+FACTOR = 8
+MIN_LEVEL_SIZE = 1024  # Stop adding levels once one has fewer buckets than this
+CHUNK = FACTOR ** 6  # Samples read at a time while building, a multiple of FACTOR
+PYRAMID_CACHE = '.history_cache'
+PYRAMID_VERSION = 2
+
+class Pyramid():
+    ''' Min/max pyramids of the columns of a session. Built (or rebuilt, if the session has grown) when opened '''
+    def __init__(self, session, columns=None, cache_dir=PYRAMID_CACHE):
+        self.session = session
+        self.columns = [name for name in (columns or session.names) if name not in ('time', 'received')]
+        self.path = pyramid_path(session.path, cache_dir)
+        self.levels = {}  # Column -> list of (n, 2) float32 memmaps of [min, max], levels[column][0] is level 1
+        self.time_sorted = True  # False if the time column goes backwards anywhere (a Teensy restart or wrap)
+        # Time units per second, from meta.json or, for sessions written before it had them, the first time stamps
+        self.units = session.meta.get('time_units') or (detect_units(session['time'][:CHUNK]) if 'time' in session.names else FIRMWARE_UNITS)
+        self._times = None
+        if not self._load():
+            self.build()
+
+    def _level_path(self, column, level):
+        return os.path.join(self.path, f'{column}_{level}.bin')
+
+    def _load(self):
+        try:
+            with open(os.path.join(self.path, 'pyramid.json')) as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return False
+        if meta.get('version') != PYRAMID_VERSION or meta.get('rows') != len(self.session) or meta.get('factor') != FACTOR \
+                or not set(self.columns) <= set(meta.get('columns', [])):
+            return False
+        self.time_sorted = meta.get('time_sorted', True)
+        for column in self.columns:
+            self.levels[column] = [np.memmap(self._level_path(column, level), dtype=np.float32, mode='r', shape=(n, 2))
+                                   for level, n in enumerate(meta['sizes'], start=1)]
+        return True
+
+    # Function to work out every level of every column from the session, reading it CHUNK samples at a time.
+    def build(self):
+        os.makedirs(self.path, exist_ok=True)
+        rows = len(self.session)
+        sizes = []
+        n = rows
+        while n > MIN_LEVEL_SIZE:
+            n = -(-n // FACTOR)
+            sizes.append(n)
+        for column in self.columns:
+            data = self.session[column]
+            # Level 1 from the samples
+            with open(self._level_path(column, 1), 'wb') as f:
+                for start in range(0, rows if sizes else 0, CHUNK):
+                    block = np.asarray(data[start:start + CHUNK], dtype=np.float64)
+                    _reduce(block, block).astype(np.float32).tofile(f)
+            # Every other level from the one below it
+            for level in range(2, len(sizes) + 1):
+                below = np.memmap(self._level_path(column, level - 1), dtype=np.float32, mode='r', shape=(sizes[level - 2], 2))
+                with open(self._level_path(column, level), 'wb') as f:
+                    for start in range(0, len(below), CHUNK):
+                        block = below[start:start + CHUNK]
+                        _reduce(block[:, 0], block[:, 1]).tofile(f)
+                del below
+        time_sorted = True
+        if 'time' in self.session.names:
+            times = self.session['time']
+            for start in range(0, rows, CHUNK):
+                # One sample of overlap, so a step back between two chunks is seen too
+                if np.any(np.diff(np.asarray(times[max(start - 1, 0):start + CHUNK], dtype=np.int64)) < 0):
+                    time_sorted = False
+                    break
+        # Written last, so an interrupted build is simply redone
+        tmp = os.path.join(self.path, 'pyramid.json.tmp')
+        with open(tmp, 'w') as f:
+            json.dump({'version': PYRAMID_VERSION, 'rows': rows, 'factor': FACTOR, 'columns': self.columns, 'sizes': sizes,
+                       'time_sorted': time_sorted}, f)
+        os.replace(tmp, os.path.join(self.path, 'pyramid.json'))
+        self._load()
+
+    # Function returning a time column that only goes up: the session's own, or if that isn't sorted, unwrapped in memory.
+    def times(self):
+        if self.time_sorted:
+            return self.session['time']
+        if self._times is None:
+            self._times, clock = unwrap(self.session['time'], self.units)
+        return self._times
+
+    # Function returning the (min, max) of a whole column.
+    def extent(self, column):
+        levels = self.levels[column]
+        data = levels[-1] if levels else np.column_stack((self.session[column], self.session[column]))
+        if len(data) == 0:
+            return 0.0, 0.0
+        return float(np.min(data[:, 0])), float(np.max(data[:, 1]))
+
+    # Function returning the sample indices and values of about 2 * points points that draw samples start:stop
+    # of column without hiding any peaks, read from the coarsest level that still has enough detail.
+    def view(self, column, start, stop, points):
+        start = max(int(start), 0)
+        stop = min(int(stop), len(self.session))
+        if stop <= start:
+            return np.zeros(0, dtype=np.int64), np.zeros(0)
+        levels = self.levels[column]
+        level, size = 0, 1
+        while level < len(levels) and (stop - start) // (size * FACTOR) >= points:
+            level += 1
+            size *= FACTOR
+        if level == 0:
+            index, y = minmax_decimate(self.session[column][start:stop], points)
+            return index + start, np.asarray(y, dtype=np.float64)
+
+        first, last = start // size, -(-stop // size)
+        data = np.asarray(levels[level - 1][first:last], dtype=np.float64)
+        # Merge neighbouring buckets down to `points`
+        group = -(-len(data) // points)
+        starts = np.arange(0, len(data), group)
+        lo = np.minimum.reduceat(data[:, 0], starts)
+        hi = np.maximum.reduceat(data[:, 1], starts)
+        index = np.repeat((first + starts) * size, 2)
+        y = np.empty(2 * len(starts))
+        y[0::2] = lo
+        y[1::2] = hi
+        return np.minimum(index, len(self.session) - 1), y
+
+# Function returning the directory of a session's pyramid: its name and a hash of its full path, in cache_dir.
+def pyramid_path(session_path, cache_dir=PYRAMID_CACHE):
+    path = os.path.abspath(session_path.rstrip(os.sep))
+    return os.path.join(cache_dir, f'{os.path.basename(path)}-{hashlib.sha1(path.encode("utf-8")).hexdigest()[:12]}')
+
+# Function to reduce min and max arrays to the min and max of every FACTOR of them.
+def _reduce(lo, hi):
+    full = len(lo) // FACTOR * FACTOR
+    out = np.empty((-(-len(lo) // FACTOR), 2), dtype=lo.dtype)
+    out[:full // FACTOR, 0] = lo[:full].reshape(-1, FACTOR).min(axis=1)
+    out[:full // FACTOR, 1] = hi[:full].reshape(-1, FACTOR).max(axis=1)
+    if full < len(lo):  # The last bucket of the recording is short
+        out[-1, 0] = lo[full:].min()
+        out[-1, 1] = hi[full:].max()
+    return out
+
+# Function to open a recording for viewing: a session directory, or a CSV file which is converted first.
+# Builds the pyramid if needed, so it can take a while for a long recording the first time.
+def load_history(path, cache_dir=PYRAMID_CACHE):
+    path = path.rstrip(os.sep)
+    if not os.path.isdir(path):
+        session_path = os.path.splitext(path)[0] + '.session'
+        if not os.path.isdir(session_path):
+            convert_csv(path, session_path)
+        path = session_path
+    session = open_session(path)
+    return session, Pyramid(session, cache_dir=cache_dir)
+
+class HistoryViewer():
+    ''' Draws a recorded session on a matplotlib axes and redraws the visible range whenever it is zoomed or panned.
+
+    The x axis is seconds from the start of the recording. The scroll wheel zooms around
+    the cursor; the navigation toolbar's pan, zoom and home work as usual.
+    '''
+    COLUMNS = {'force': 'Forces', 'position': 'Platform Distances', 'filtered': 'Filtered Forces'}
+
+    def __init__(self, ax, points=1500, zoom_step=1.25):
+        self.ax = ax
+        self.points = points  # Buckets drawn across the axes, about one per pixel column
+        self.zoom_step = zoom_step
+        self.session = None
+        self.pyramid = None
+        self.lines = {}
+        self.redraw_time = 0.0  # Seconds the last redraw took to read the data
+        self._t0 = 0.0
+        self._times = None  # The session's time column, unwrapped if it had to be
+        self._units = FIRMWARE_UNITS  # Its units per second
+        ax.set_xlabel('Time (s)')
+        ax.set_title('Session')
+        ax.callbacks.connect('xlim_changed', self._on_xlim)
+        ax.figure.canvas.mpl_connect('scroll_event', self._on_scroll)
+
+    # Function to show a session opened with load_history.
+    def show(self, session, pyramid):
+        self.session, self.pyramid = session, pyramid
+        for line in self.lines.values():
+            line.remove()
+        self.lines = {}
+        self._times = times = pyramid.times()
+        self._units = pyramid.units
+        if len(session) == 0:
+            self.ax.set_title(f'{os.path.basename(session.path)} (empty)')
+            self.ax.figure.canvas.draw_idle()
+            return
+        self._t0 = float(times[0])
+        for column in pyramid.columns:
+            self.lines[column], = self.ax.plot([], [], label=self.COLUMNS.get(column, column))
+        self.ax.legend(loc='upper left')
+        self.ax.set_title(f'{os.path.basename(session.path)}: {len(session):,} samples')
+        extents = [pyramid.extent(column) for column in pyramid.columns]
+        ymin, ymax = min(lo for lo, hi in extents), max(hi for lo, hi in extents)
+        margin = 0.05 * (ymax - ymin) or 1.0
+        self.ax.set_ylim(ymin - margin, ymax + margin)
+        self.ax.set_xlim(0.0, max((float(times[-1]) - self._t0) / self._units, 1e-6))  # Redraws through _on_xlim
+
+    # Function to convert seconds from the start into a sample index.
+    def _index(self, seconds):
+        return int(np.searchsorted(self._times, self._t0 + seconds * self._units))
+
+    def _on_xlim(self, ax):
+        if self.session is None or not self.lines:
+            return
+        start = time.perf_counter()
+        left, right = ax.get_xlim()
+        first, last = max(self._index(left) - 1, 0), self._index(right) + 1
+        times = self._times
+        for column, line in self.lines.items():
+            index, y = self.pyramid.view(column, first, last, self.points)
+            line.set_data((times[index] - self._t0) / self._units, y)
+        self.redraw_time = time.perf_counter() - start
+        ax.figure.canvas.draw_idle()
+
+    def _on_scroll(self, event):
+        if event.inaxes is not self.ax or self.session is None:
+            return
+        scale = 1 / self.zoom_step if event.button == 'up' else self.zoom_step
+        left, right = self.ax.get_xlim()
+        self.ax.set_xlim(event.xdata - (event.xdata - left) * scale, event.xdata + (right - event.xdata) * scale)
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="View a recorded session (CSV file or session directory)")
+    arg_parser.add_argument('recording')
+    args = arg_parser.parse_args()
+
+    import matplotlib.pyplot as plt
+    start = time.perf_counter()
+    session, pyramid = load_history(args.recording)
+    print(f'Opened {session.path}: {len(session):,} samples in {time.perf_counter() - start:.2f} s')
+    fig, ax = plt.subplots()
+    viewer = HistoryViewer(ax)
+    viewer.show(session, pyramid)
+    plt.show()
@@ -0,0 +1,97 @@
+import re
+import warnings
+import numpy as np
+
+# A data line is a comma separated list of numbers, e.g. "37774936,1.49,0.00,1.47"
+NUMBER = rb'[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?'
+NEWLINE = ord('\n')
+COMMA = ord(',')
+DATA_CHARS = np.zeros(256, dtype=bool)
+DATA_CHARS[list(b'0123456789.,+-\n')] = True
+
+class LineParser():
+    ''' Turns the raw byte stream from the Teensy into blocks of samples.
+
+    Bytes are fed in whatever chunks the serial port returns. Complete lines are
+    split off (a trailing partial line is kept for the next call), data lines are
+    converted to an (n, columns) float array in one call, and anything else
+    (e.g. "DIAG0 error", "Opening till force 4") is returned as a status line.
+    '''
+    def __init__(self, columns=4, max_partial=4096):
+        self.columns = columns
+        self.max_partial = max_partial  # Drop a partial line that grows past this, the stream is garbage
+        self._partial = b''
+        self._data_line = re.compile(NUMBER + rb'(?:,' + NUMBER + rb'){%d}' % (columns - 1))
+        self.lines = 0
+        self.samples = 0
+        self.status_lines = 0
+        self.errors = 0
+
+    # Function to read everything the serial port has buffered and parse it.
+    def read(self, ser):
+        waiting = ser.in_waiting
+        data = ser.read(waiting if waiting > 0 else 1)  # Block for at least one byte so callers don't spin
+        return self.feed(data)
+
+    # Function to parse a chunk of bytes. Returns (samples, status_lines).
+    def feed(self, data):
+        data = self._partial + data
+        end = data.rfind(b'\n')
+        if end < 0:
+            self._partial = data if len(data) <= self.max_partial else b''
+            return np.empty((0, self.columns)), []
+        self._partial = data[end + 1:]
+
+        block = data[:end].replace(b'\r', b'')
+        lines = block.split(b'\n')
+        self.lines += len(lines)
+
+        # Classify every line at once: a data line has only digits, signs, dots and commas,
+        # and exactly columns - 1 commas. Lines that are fine cost no Python work.
+        chars = np.frombuffer(block, dtype=np.uint8)
+        line_of_char = np.cumsum(chars == NEWLINE)
+        commas = np.bincount(line_of_char, weights=(chars == COMMA), minlength=len(lines))
+        is_data = commas == self.columns - 1
+        is_data[line_of_char[~DATA_CHARS[chars]]] = False
+
+        status = []
+        if is_data.all():
+            samples = _fromstring(block.replace(b'\n', b','))
+        else:
+            for i in np.flatnonzero(~is_data):
+                if lines[i]:
+                    status.append(lines[i].decode('utf-8', errors='replace').strip())
+            samples = _fromstring(b','.join([lines[i] for i in np.flatnonzero(is_data)]))
+
+        rows = int(is_data.sum())
+        if samples is None or samples.size != rows * self.columns:
+            # A line looked like data but did not parse, e.g. "1.2.3,4,5,6". Check them one at a time.
+            samples = self._convert_slow([lines[i] for i in np.flatnonzero(is_data)], status)
+        samples = samples.reshape(-1, self.columns)
+
+        self.samples += len(samples)
+        self.status_lines += len(status)
+        return samples, status
+
+    # Converts data lines one at a time, reporting the ones that are not valid numbers as status lines.
+    def _convert_slow(self, data_lines, status):
+        good = []
+        for line in data_lines:
+            if self._data_line.fullmatch(line):
+                good.append(line)
+            else:
+                self.errors += 1
+                status.append(line.decode('utf-8', errors='replace').strip())
+        if not good:
+            return np.empty((0, self.columns))
+        return _fromstring(b','.join(good))
+
+# Parses comma separated numbers in C. Returns None if the text has anything else in it.
+def _fromstring(text):
+    with warnings.catch_warnings():
+        # Older numpy warns and returns what it managed to parse, newer numpy raises.
+        warnings.simplefilter('ignore', DeprecationWarning)
+        try:
+            return np.fromstring(text.decode('ascii', errors='replace'), sep=',')
+        except ValueError:
+            return None
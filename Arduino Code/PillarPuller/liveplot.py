@@ -0,0 +1,111 @@
+import time
+import numpy as np
+
+# Function to reduce y to the min and max of each of `buckets` equal slices, keeping their order.
+# Unlike keeping every nth sample this never hides a spike, and the result is at most 2 * buckets points.
+def minmax_decimate(y, buckets):
+    y = np.asarray(y)
+    n = len(y)
+    if buckets <= 0 or n <= 2 * buckets:
+        return np.arange(n), y
+    size = -(-n // buckets)  # Samples per bucket, rounded up
+    full = n // size
+    rows = y[:full * size].reshape(full, size)
+    base = np.arange(full) * size
+    lo = base + np.argmin(rows, axis=1)
+    hi = base + np.argmax(rows, axis=1)
+    index = np.empty(2 * full, dtype=np.int64)
+    index[0::2] = np.minimum(lo, hi)
+    index[1::2] = np.maximum(lo, hi)
+    if full * size < n:
+        # The last partial bucket
+        tail = np.arange(full * size, n)
+        index = np.concatenate((index, np.sort([tail[np.argmin(y[tail])], tail[np.argmax(y[tail])]])))
+    return index, y[index]
+
+class LivePlot():
+    ''' Draws the most recent window of samples with blitting.
+
+    Each line shows every sample in the window, min/max decimated to about one point
+    per pixel column. The x axis is "samples ago", so it never moves. The y axis only
+    changes when the data leaves it or shrinks to a small part of it, and only then is
+    the whole figure redrawn; every other frame just blits the lines.
+
+    If metrics (a metrics.Metrics) is given, frame times and decimation are recorded as render.*.
+    '''
+    def __init__(self, ax, lines, get_columns, window=2000, margin=0.2, metrics=None):
+        self.ax = ax
+        self.lines = lines  # One line per column returned by get_columns
+        self.get_columns = get_columns  # Function returning a tuple of arrays for the last n samples
+        self.window = window
+        self.margin = margin
+        self.metrics = metrics
+        self.fps = 0.0
+        self.decimation = 1.0  # Samples per plotted point
+        self.full_redraws = 0
+        self._frames = 0
+        self._fps_start = time.perf_counter()
+        self._last_frame = None
+        self.ax.set_xlim(-window + 1, 0)
+
+    # Function to use as the FuncAnimation callback. Returns the artists to blit.
+    def update(self, frame=None):
+        start = time.perf_counter()
+        columns = self.get_columns(self.window)
+        n = len(columns[0]) if columns else 0
+        if n > 0:
+            buckets = max(int(self.ax.get_window_extent().width), 1)
+            ymin = float("inf")
+            ymax = float("-inf")
+            plotted = 0
+            for line, values in zip(self.lines, columns):
+                if len(values) == 0:  # e.g. a filtered channel that hasn't started yet
+                    line.set_data([], [])
+                    continue
+                index, y = minmax_decimate(values, buckets)
+                line.set_data(index - (n - 1), y)
+                plotted = max(plotted, len(y))
+                a = line.get_alpha()
+                if line.get_visible() and (a is None or a > 0):
+                    ymin = min(ymin, np.min(y))
+                    ymax = max(ymax, np.max(y))
+            self.decimation = n / max(plotted, 1)
+            if ymin <= ymax and self._rescale(ymin, ymax):
+                self.full_redraws += 1
+                self.ax.figure.canvas.draw()
+
+        self._count_frame()
+        if self.metrics is not None:
+            self._record_frame(start)
+        return self.lines
+
+    def _record_frame(self, start):
+        now = time.perf_counter()
+        self.metrics.observe('render.update', now - start)
+        if self._last_frame is not None:
+            # Time between frames, including drawing the last one and everything else the Tk loop did
+            self.metrics.observe('render.frame_interval', start - self._last_frame)
+        self._last_frame = start
+        self.metrics.count('render.frames')
+        self.metrics.gauge('render.fps', self.fps)
+        self.metrics.gauge('render.decimation', self.decimation)
+        self.metrics.gauge('render.full_redraws', self.full_redraws)
+
+    # Function to move the y limits if the data no longer fits them well. Returns True if they changed.
+    def _rescale(self, ymin, ymax):
+        low, high = self.ax.get_ylim()
+        span = high - low
+        data_span = max(ymax - ymin, 1e-6)
+        if ymin >= low and ymax <= high and data_span > 0.25 * span:
+            return False
+        pad = self.margin * data_span
+        self.ax.set_ylim(ymin - pad, ymax + pad)
+        return True
+
+    def _count_frame(self):
+        self._frames += 1
+        now = time.perf_counter()
+        if now - self._fps_start >= 1.0:
+            self.fps = self._frames / (now - self._fps_start)
+            self._frames = 0
+            self._fps_start = now
@@ -0,0 +1,211 @@
+import bisect
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+
+# Counters, gauges and timing histograms for the hot paths (serial reader, render loop,
+# recorder), cheap enough to leave on all the time. Each part of the host stack takes an
+# optional Metrics and records into it:
+#
+#   reader.*    DeviceSession: bytes, lines, samples, parse errors, bytes waiting per read,
+#               command queue depth, samples missing from or repeated in the Teensy's micros()
+#               timestamps, wraps and restarts of its clock, its drift and the read latency
+#   render.*    LivePlot: frame time, samples per plotted point
+#   writer.*    Recorder: rows written, time per block, samples lost before they were written
+#
+# snapshot() gives everything as a dict with per-second rates since the previous snapshot.
+# The GUI shows it in the Metrics tab and appends it to a JSON lines file, and MetricsServer
+# serves it over HTTP for scripts.
+
+# Histogram bucket upper bounds in seconds, 10 us to 10 s
+BUCKETS = [b * 10.0 ** e for e in range(-5, 1) for b in (1, 2, 5)] + [10.0]
+
+class Histogram():
+    ''' Counts observations into fixed buckets. Percentiles are the upper bound of the bucket they fall in '''
+    def __init__(self, bounds=BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, q):
+        if self.count == 0:
+            return None
+        rank = q / 100 * self.count
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'mean': self.total / self.count if self.count else None,
+            'p50': self.percentile(50),
+            'p99': self.percentile(99),
+            'max': self.max if self.count else None,
+        }
+
+class SampleClock():
+    ''' Counts samples missing from the stream, from gaps in the Teensy's micros() time stamps.
+
+    The sample interval is learned from the data (the median spacing, smoothed), and a
+    step of more than 1.5 intervals counts as round(step / interval) - 1 missing samples.
+    '''
+    def __init__(self, smoothing=0.05):
+        self.smoothing = smoothing
+        self.interval = None  # Typical spacing of the time stamps
+        self.gaps = 0
+        self.missing = 0
+        self._last = None
+
+    # Function to check a block of time stamps. Returns the number of samples missing from it.
+    def feed(self, times):
+        times = np.asarray(times, dtype=np.float64)
+        if len(times) == 0:
+            return 0
+        steps = np.diff(times, prepend=times[0] if self._last is None else self._last)
+        self._last = times[-1]
+        positive = steps[steps > 0]
+        if len(positive) == 0:
+            return 0
+        median = float(np.median(positive))
+        if self.interval is None:
+            self.interval = median
+        elif median < 4 * self.interval:
+            self.interval += self.smoothing * (median - self.interval)
+        # A step backwards is micros() wrapping or the Teensy restarting, not a loss
+        gaps = steps[steps > 1.5 * self.interval]
+        missing = int(np.sum(np.rint(gaps / self.interval) - 1))
+        self.gaps += len(gaps)
+        self.missing += missing
+        return missing
+
+class Metrics():
+    ''' Thread-safe registry of counters, gauges and histograms '''
+    def __init__(self):
+        self.started = time.time()
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._gauges = {}
+        self._histograms = {}
+        self._last_counters = {}
+        self._last_time = time.monotonic()
+
+    def count(self, name, n=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + n
+
+    def gauge(self, name, value):
+        self._gauges[name] = value
+
+    def observe(self, name, seconds):
+        with self._lock:
+            histogram = self._histograms.get(name)
+            if histogram is None:
+                histogram = self._histograms[name] = Histogram()
+            histogram.observe(seconds)
+
+    def value(self, name, default=0):
+        return self._counters.get(name, self._gauges.get(name, default))
+
+    # Function returning every metric as a plain dict. Rates are per second since the previous snapshot.
+    def snapshot(self):
+        with self._lock:
+            now = time.monotonic()
+            elapsed = max(now - self._last_time, 1e-9)
+            counters = dict(self._counters)
+            rates = {name: (value - self._last_counters.get(name, 0)) / elapsed for name, value in counters.items()}
+            histograms = {name: histogram.summary() for name, histogram in self._histograms.items()}
+            self._last_counters = counters
+            self._last_time = now
+        return {
+            'time': time.time(),
+            'uptime': time.time() - self.started,
+            'counters': counters,
+            'rates': rates,
+            'gauges': dict(self._gauges),
+            'histograms': histograms,
+        }
+
+# Function to append snapshots of several rigs ({port: snapshot}) to a JSON lines file, one line per rig.
+def log_snapshots(path, snapshots):
+    with open(path, 'a') as f:
+        for port, snapshot in snapshots.items():
+            f.write(json.dumps(dict(snapshot, rig=port)) + '\n')
+
+# Function to combine snapshots of different parts of the host stack, e.g. the acquisition process'
+# reader.* and the GUI's render.* and writer.*. Later snapshots win where both have a metric.
+def merge_snapshots(*snapshots):
+    merged = {'time': max(s['time'] for s in snapshots), 'uptime': max(s['uptime'] for s in snapshots)}
+    for key in ('counters', 'rates', 'gauges', 'histograms'):
+        merged[key] = {}
+        for snapshot in snapshots:
+            merged[key].update(snapshot[key])
+    return merged
+
+# Function to format a snapshot as text for the Metrics tab.
+def format_snapshot(snapshot):
+    lines = []
+    rates = snapshot['rates']
+    for name, value in sorted(snapshot['counters'].items()):
+        lines.append(f'{name:28} {value:>14,}   {rates.get(name, 0):>12,.1f}/s')
+    for name, value in sorted(snapshot['gauges'].items()):
+        lines.append(f'{name:28} {value:>14,.2f}' if isinstance(value, float) else f'{name:28} {value!s:>14}')
+    for name, h in sorted(snapshot['histograms'].items()):
+        if h['count']:
+            lines.append(f'{name:28} {h["count"]:>14,}   mean {h["mean"] * 1000:.2f} ms, p50 < {h["p50"] * 1000:.2f} ms, '
+                         f'p99 < {h["p99"] * 1000:.2f} ms, max {h["max"] * 1000:.2f} ms')
+    return '\n'.join(lines)
+
+class MetricsServer():
+    ''' Serves the latest published snapshots as JSON on http://host:port/metrics, from a background thread.
+
+    The GUI publishes what it shows (a snapshot per rig, keyed by port), so HTTP clients
+    never reset the rates the Metrics tab shows.
+    '''
+    def __init__(self, port=8765, host='127.0.0.1'):
+        self.latest = {}  # Nothing until the first publish()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.rstrip('/') not in ('', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = json.dumps(server.latest).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass  # Keep polling out of the console
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.port = self.httpd.server_address[1]
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def publish(self, snapshots):
+        self.latest = snapshots
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
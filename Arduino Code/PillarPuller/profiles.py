@@ -0,0 +1,328 @@
+import argparse
+import csv
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Test profiles: a sequence of steps run against one rig on their own thread.
+#
+#   {
+#     "name": "fatigue",
+#     "steps": [
+#       {"command": "zero_position"},
+#       {"repeat": 1000, "steps": [
+#         {"open": 1.5},                        open for 1.5 s, then stop
+#         {"hold": 2.0},                        do nothing for 2 s
+#         {"close": 1.5},
+#         {"hold": 2.0}
+#       ]},
+#       {"ramp": {"from": 0, "to": 10, "step": 2, "dwell": 5}},   move_to_position 0, 2, ... 10, 5 s apart
+#       {"move": 0, "duration": 10},         move_to_position0, next step 10 s later
+#       {"break_until": {"timeout": 120}}    open until the host detects a break (then stop), or timeout
+#     ]
+#   }
+#
+# Profiles are JSON, or YAML with the same structure if PyYAML is installed.
+#
+# Every step has a planned start time: the planned end of the step before it, counted
+# from the start of the run on the monotonic clock. Commands are sent at their planned
+# time whatever happened before, so lateness never adds up over a long cyclic run. Only
+# break_until has no planned length; the plan continues from when it actually ends.
+# Every command is logged with its planned and actual send and write times.
+
+STEP_KINDS = ('command', 'move', 'open', 'close', 'hold', 'ramp', 'repeat', 'break_until')
+SPIN_TIME = 0.002  # Seconds before a deadline to stop sleeping and spin, sleep() alone can be several ms late
+LOG_FIELDS = ['step', 'cycle', 'command', 'planned_s', 'sent_s', 'written_s', 'late_ms', 'note']
+
+class ProfileError(ValueError):
+    pass
+
+# Function to read a profile from a .json, .yaml or .yml file. Anything wrong with it raises ProfileError.
+def load_profile(path):
+    with open(path) as f:
+        if os.path.splitext(path)[1].lower() in ('.yaml', '.yml'):
+            try:
+                import yaml
+            except ImportError:
+                raise ProfileError("YAML profiles need PyYAML (pip install pyyaml), or write the profile as JSON")
+            try:
+                profile = yaml.safe_load(f)
+            except yaml.YAMLError as e:
+                raise ProfileError(f"{path} is not valid YAML: {e}")
+        else:
+            profile = json.load(f)
+    if isinstance(profile, list):
+        profile = {'steps': profile}
+    if not isinstance(profile, dict) or 'steps' not in profile:
+        raise ProfileError(f"{path} must hold a profile with a list of steps, or just the list")
+    profile.setdefault('name', os.path.splitext(os.path.basename(path))[0])
+    if not isinstance(profile['name'], str):
+        raise ProfileError(f"The name of {path} must be text, not {profile['name']!r}")
+    validate(profile['steps'])
+    # Turn every step into its commands now, so a bad one stops the profile before anything is sent
+    try:
+        planned_duration(profile)
+    except ProfileError:
+        raise
+    except (TypeError, ValueError, KeyError, AttributeError) as e:
+        raise ProfileError(f"Can't plan {profile['name']}: {e!r}")
+    return profile
+
+def validate(steps, where='steps'):
+    if not isinstance(steps, list) or not steps:
+        raise ProfileError(f"{where} must be a non-empty list")
+    for i, step in enumerate(steps):
+        kinds = [kind for kind in STEP_KINDS if kind in step] if isinstance(step, dict) else []
+        if len(kinds) != 1:
+            raise ProfileError(f"{where}[{i}] must have exactly one of {', '.join(STEP_KINDS)}: {step}")
+        kind = kinds[0]
+        if kind == 'repeat':
+            if isinstance(step['repeat'], bool) or not isinstance(step['repeat'], int) or step['repeat'] < 1:
+                raise ProfileError(f"{where}[{i}].repeat must be a positive whole number")
+            validate(step.get('steps'), f"{where}[{i}].steps")
+            continue
+        if 'duration' in step:
+            seconds(step['duration'], f"{where}[{i}].duration")
+        if kind == 'command':
+            if not isinstance(step['command'], str):
+                raise ProfileError(f"{where}[{i}].command must be text, not {step['command']!r}")
+        elif kind == 'ramp':
+            ramp = step['ramp']
+            if not isinstance(ramp, dict) or not all(key in ramp for key in ('from', 'to', 'step', 'dwell')):
+                raise ProfileError(f"{where}[{i}].ramp needs from, to, a non-zero step and dwell")
+            try:
+                move_command(ramp['from'])
+                move_command(ramp['step'])
+                move_command(ramp['to'])
+            except ProfileError as e:
+                raise ProfileError(f"{where}[{i}].ramp from, to and step: {e}")
+            if ramp['step'] == 0:
+                raise ProfileError(f"{where}[{i}].ramp needs from, to, a non-zero step and dwell")
+            seconds(ramp['dwell'], f"{where}[{i}].ramp.dwell")
+        elif kind in ('open', 'close', 'hold'):
+            seconds(step[kind], f"{where}[{i}].{kind}")
+        elif kind == 'move':
+            try:
+                move_command(step['move'])
+            except ProfileError as e:
+                raise ProfileError(f"{where}[{i}].move: {e}")
+        elif kind == 'break_until':
+            options = step['break_until'] or {}
+            if not isinstance(options, dict):
+                raise ProfileError(f"{where}[{i}].break_until takes timeout and direction, not {options!r}")
+            if options.get('direction', 'open') not in ('open', 'close'):
+                raise ProfileError(f"{where}[{i}].break_until.direction must be open or close")
+            seconds(options.get('timeout', 120), f"{where}[{i}].break_until.timeout")
+
+# Function to check a number of seconds in a profile. Returns it as a float.
+def seconds(value, where):
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or not value >= 0:
+        raise ProfileError(f"{where} must be a number of seconds, not {value!r}")
+    return float(value)
+
+# Function to turn a position in mm into the command the firmware takes. It only understands whole millimetres.
+def move_command(position):
+    if isinstance(position, bool) or not isinstance(position, (int, float)):
+        raise ProfileError(f"move_to_position takes a number of millimetres, not {position!r}")
+    if float(position) != int(float(position)):
+        raise ProfileError(f"move_to_position only takes whole millimetres, not {position}")
+    return f"move_to_position{int(float(position))}"
+
+# Generator of (kind, command, duration, label) actions for a list of steps. kind is 'send', 'wait'
+# or 'break'; duration is the planned time from this action to the next (or the timeout, for 'break').
+def expand(steps, label=''):
+    for i, step in enumerate(steps):
+        name = f'{label}{i}'
+        if 'command' in step:
+            yield 'send', step['command'], float(step.get('duration', 0)), name
+        elif 'move' in step:
+            yield 'send', move_command(step['move']), float(step.get('duration', 0)), name
+        elif 'open' in step or 'close' in step:
+            direction = 'open' if 'open' in step else 'close'
+            yield 'send', direction, float(step[direction]), name
+            yield 'send', 'stop', 0.0, name
+        elif 'hold' in step:
+            yield 'wait', None, float(step['hold']), name
+        elif 'ramp' in step:
+            ramp = step['ramp']
+            count = int(round((ramp['to'] - ramp['from']) / ramp['step'])) + 1
+            for k in range(max(count, 0)):
+                yield 'send', move_command(ramp['from'] + k * ramp['step']), float(ramp['dwell']), name
+        elif 'break_until' in step:
+            options = step['break_until'] or {}
+            yield 'break', options.get('direction', 'open'), float(options.get('timeout', 120)), name
+        elif 'repeat' in step:
+            for cycle in range(step['repeat']):
+                yield from expand(step['steps'], f'{name}.{cycle}.')
+
+class ProfileRunner():
+    ''' Runs a profile against one rig (a serialBuffer) on a dedicated thread.
+
+    The log (also written to log_path as CSV while running, so an unattended run keeps its
+    record) has one row per command with its planned and actual times. abort() stops the
+    run and the motor. If the rig disconnects for longer than max_disconnect seconds the
+    run is aborted as well.
+    '''
+    def __init__(self, buffer, profile, log_path=None, max_disconnect=5.0, clock=time.monotonic):
+        self.buffer = buffer
+        self.profile = profile
+        self.log_path = log_path
+        self.max_disconnect = max_disconnect
+        self.clock = clock
+        self.log = []
+        self.error = None
+        self.breaks = 0  # break_until steps that ended in a break
+        self.step = None  # Label of the step being run
+        self._abort = threading.Event()
+        self._thread = None
+        self._start = None
+        self._disconnected_since = None
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    @property
+    def aborted(self):
+        return self._abort.is_set()
+
+    def start(self):
+        self._abort.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True, name='profile')
+        self._thread.start()
+        return self
+
+    # Function to stop the run and the motor. Safe to call from any thread.
+    def abort(self):
+        self._abort.set()
+
+    def join(self, timeout=None):
+        self._thread.join(timeout)
+
+    def _run(self):
+        log_file = open(self.log_path, 'w', newline='', buffering=1) if self.log_path else None
+        writer = csv.DictWriter(log_file, fieldnames=LOG_FIELDS) if log_file else None
+        if writer:
+            writer.writeheader()
+        try:
+            self._start = self.clock()
+            planned = 0.0  # Seconds from the start of the run
+            for kind, command, duration, label in expand(self.profile['steps']):
+                self.step = label
+                if not self._wait_until(self._start + planned):
+                    break
+                if kind == 'send':
+                    self._send(command, planned, label, writer)
+                    planned += duration
+                elif kind == 'wait':
+                    planned += duration
+                elif kind == 'break':
+                    planned = self._break_until(command, duration, planned, label, writer)
+                if planned is None:
+                    break
+            else:
+                self._wait_until(self._start + planned)
+        except Exception as e:
+            self.error = e
+            logger.exception(f"Profile {self.profile.get('name')} failed at step {self.step}")
+        finally:
+            if self._abort.is_set() or self.error is not None:
+                self.buffer.stop_on_break = False
+                self.buffer.send_command("stop")
+                logger.warning(f"Profile {self.profile.get('name')} stopped at step {self.step}")
+            if log_file:
+                log_file.close()
+
+    def _send(self, command, planned, label, writer, note=''):
+        sent = self.clock() - self._start
+        future = self.buffer.send_command(command)
+        try:
+            latency = future.result(timeout=2.0)
+        except Exception as e:
+            latency = None
+            note = f'{note} not written: {e}'.strip()
+        parts = label.split('.')  # Top level step, then the cycle of each repeat it is in
+        row = {
+            'step': parts[0],
+            'cycle': parts[1] if len(parts) > 1 else '',
+            'command': command,
+            'planned_s': round(planned, 6),
+            'sent_s': round(sent, 6),
+            'written_s': round(sent + latency, 6) if latency is not None else '',
+            'late_ms': round((sent - planned) * 1000, 3),
+            'note': note,
+        }
+        self.log.append(row)
+        if writer:
+            writer.writerow(row)
+
+    # Opens (or closes) until the host detects a break, or timeout. Returns the planned time to continue from.
+    def _break_until(self, direction, timeout, planned, label, writer):
+        detector = self.buffer.break_detector
+        detector.reset()
+        self.buffer.stop_on_break = True  # The reader sends "stop" the moment it sees the break
+        self._send(direction, planned, label, writer, note='until break')
+        started = self.clock()
+        while not detector.triggered and self.clock() - started < timeout:
+            if self._abort.wait(0.005) or not self._still_connected():
+                return None
+        if detector.triggered:
+            self.breaks += 1
+            event = detector.event
+            logger.info(f"Profile step {label}: break at peak force {event.peak_force:.2f}, position {event.position:.2f}")
+        else:
+            self.buffer.stop_on_break = False
+            self._send("stop", self.clock() - self._start, label, writer, note=f'no break after {timeout} s')
+        # There is no planned end for a break, the plan carries on from now
+        return self.clock() - self._start
+
+    # Sleeps until the deadline on the monotonic clock. Returns False if the run was aborted.
+    def _wait_until(self, deadline):
+        while True:
+            remaining = deadline - self.clock()
+            if remaining <= 0:
+                return not self._abort.is_set()
+            if remaining > SPIN_TIME:
+                if self._abort.wait(min(remaining - SPIN_TIME, 0.5)) or not self._still_connected():
+                    return False
+            elif self._abort.is_set():
+                return False
+            else:
+                time.sleep(0)  # Spin, but let the reader thread run
+
+    def _still_connected(self):
+        session = self.buffer.session
+        if session.connected:
+            self._disconnected_since = None
+            return True
+        if self._disconnected_since is None:
+            self._disconnected_since = self.clock()
+            return True
+        if self.clock() - self._disconnected_since > self.max_disconnect:
+            self.error = ConnectionError(f"{session.port} disconnected for more than {self.max_disconnect} s")
+            logger.error(f"Profile {self.profile.get('name')}: {self.error}")
+            return False
+        return True
+
+# Function returning the planned length of a profile in seconds, not counting break_until steps.
+def planned_duration(profile):
+    return sum(duration for kind, command, duration, label in expand(profile['steps']) if kind != 'break')
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Check a test profile and print its plan")
+    arg_parser.add_argument('profile')
+    arg_parser.add_argument('--limit', type=int, default=50, help="actions to print")
+    args = arg_parser.parse_args()
+
+    profile = load_profile(args.profile)
+    planned = 0.0
+    for n, (kind, command, duration, label) in enumerate(expand(profile['steps'])):
+        if n < args.limit:
+            print(f'{planned:10.3f} s  {label:12} {kind:6} {command or "":24} {duration:g} s')
+        if kind != 'break':
+            planned += duration
+    print(f'{profile["name"]}: {n + 1} actions, {planned_duration(profile):.1f} s planned (plus any break_until steps)')
@@ -0,0 +1,170 @@
+import logging
+import os
+import threading
+import time
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Function returning filename, or if something by that name exists, the first free one of name-2, name-3, ...
+def free_name(filename):
+    root, ext = os.path.splitext(filename.rstrip(os.sep))
+    n = 1
+    while os.path.exists(filename):
+        n += 1
+        filename = f'{root}-{n}{ext}'
+    return filename
+
+class Recorder():
+    ''' Writes samples to disk as they arrive, on its own thread.
+
+    The recorder follows a RingBuffer with read_since, so it never blocks the
+    serial reader or the GUI. Subclasses say how a block is written. Output is
+    synced every fsync_interval seconds, and when a file passes max_bytes it is
+    closed and recording continues in name_001, name_002, ... A name that is already
+    taken is never overwritten: the recording goes to name-2 (name-3...) instead, and
+    filename says where it went. If writing fails (disk full, permissions) the
+    recording stops by itself: recording turns False and error holds the exception.
+    Call stop() to close what was written.
+    If metrics (a metrics.Metrics) is given, writes are recorded as writer.*.
+    '''
+    def __init__(self, samples, poll_interval=0.2, fsync_interval=2.0, max_bytes=None, metrics=None):
+        self.samples = samples  # RingBuffer to record from
+        self.poll_interval = poll_interval
+        self.fsync_interval = fsync_interval
+        self.max_bytes = max_bytes
+        self.metrics = metrics
+        self.filename = None
+        self.files = []  # Every file written by the current recording
+        self.rows = 0
+        self.lost = 0  # Samples overwritten in the ring buffer before the recorder reached them
+        self.error = None  # The exception that stopped the last recording, None if it is fine
+        self._thread = None
+        self._stop = threading.Event()
+
+    @property
+    def recording(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    # Function to start recording to filename, beginning with the next sample that arrives.
+    def start(self, filename):
+        if self.recording:
+            raise RuntimeError(f"Already recording to {self.filename}")
+        self.stop()  # Close what a recording that failed left open
+        self.error = None
+        filename = free_name(filename)
+        self.filename = filename
+        self.files = []
+        self.rows = 0
+        self.lost = 0
+        self._position = self.samples.total
+        self._open(filename)
+        self.files.append(filename)
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    # Function to stop recording. Writes whatever has arrived so far and closes the file.
+    def stop(self):
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+        try:
+            self._close()
+        except OSError as e:
+            logger.error(f"Couldn't close {self.files[-1]}: {e}")
+            self.error = self.error or e
+
+    # Function to close the current file and continue in the next one.
+    def rotate(self):
+        self._close()
+        root, ext = os.path.splitext(self.filename)
+        filename = free_name(f'{root}_{len(self.files):03d}{ext}')
+        self._open(filename)
+        self.files.append(filename)
+
+    def _run(self):
+        last_sync = time.monotonic()
+        try:
+            while not self._stop.is_set():
+                self._stop.wait(self.poll_interval)
+                self._write_new()
+                if time.monotonic() - last_sync >= self.fsync_interval:
+                    self._sync()
+                    last_sync = time.monotonic()
+                if self.max_bytes is not None and self._size() >= self.max_bytes:
+                    self.rotate()
+            self._write_new()
+        except Exception as e:
+            self.error = e
+            logger.exception(f"Recording to {self.files[-1]} failed after {self.rows} samples")
+            if self.metrics is not None:
+                self.metrics.count('writer.errors')
+
+    def _write_new(self):
+        backlog = self.samples.total - self._position
+        block, self._position, lost = self.samples.read_since(self._position)
+        if lost:
+            self.lost += lost
+            logger.warning(f"Recorder fell behind, {lost} samples were not written to {self.files[-1]}")
+        if self.metrics is not None:
+            self.metrics.gauge('writer.backlog', backlog)
+            if lost:
+                self.metrics.count('writer.lost', lost)
+        if len(block) == 0:
+            return
+        start = time.perf_counter()
+        self._write(block)
+        self.rows += len(block)
+        if self.metrics is not None:
+            self.metrics.observe('writer.block', time.perf_counter() - start)
+            self.metrics.count('writer.rows', len(block))
+
+    # Subclasses implement these
+    def _open(self, filename):
+        raise NotImplementedError
+
+    def _write(self, block):
+        raise NotImplementedError
+
+    def _size(self):
+        raise NotImplementedError
+
+    def _sync(self):
+        raise NotImplementedError
+
+    def _close(self):
+        raise NotImplementedError
+
+class CsvRecorder(Recorder):
+    ''' Records to CSV with the same columns as the older pillar_puller_*.csv files, plus filtered force '''
+    HEADER = 'Time,Forces,Platform Position,Filtered Forces'
+    COLUMNS = ('time', 'force', 'position', 'filtered')  # The host receive time is only kept in sessions
+    FORMAT = ['%.1f', '%.6g', '%.6g', '%.6g']
+
+    def __init__(self, samples, **kwargs):
+        super().__init__(samples, **kwargs)
+        self._file = None
+
+    def _open(self, filename):
+        self._file = open(filename, 'w', newline='', buffering=1 << 20)
+        self._file.write(self.HEADER + '\n')
+
+    def _write(self, block):
+        columns = np.column_stack([block[name] for name in self.COLUMNS])
+        np.savetxt(self._file, columns, fmt=self.FORMAT, delimiter=',')
+
+    def _size(self):
+        return self._file.tell()
+
+    def _sync(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def _close(self):
+        if self._file is not None:
+            self._sync()
+            self._file.close()
+            self._file = None
@@ -0,0 +1,85 @@
+import logging
+from serial.tools import list_ports
+
+logger = logging.getLogger(__name__)
+
+# USB (vendor id, product id) pairs of the Teensy's serial port
+TEENSY_USB_IDS = [
+    (0x16C0, 0x0483),  # Teensyduino USB serial
+    (0x16C0, 0x0489),  # Serial + keyboard/mouse/joystick
+    (0x16C0, 0x048B),  # Dual serial
+    (0x16C0, 0x048C),  # Triple serial
+]
+
+# Function returning the serial ports of every connected rig, found by USB vendor and product id.
+# A Teensy built with more than one serial port (platformio.ini's teensy40_DUAL_SERIAL) shows up as
+# several ports with the same serial number. Only its first, Serial, carries samples and takes commands;
+# the others are debug output (SerialUSB1 in main.cpp), so each Teensy gives one rig.
+def discover(usb_ids=TEENSY_USB_IDS):
+    rigs = {}  # Serial number (or port, if there is none) -> port
+    for port in sorted((port for port in list_ports.comports() if (port.vid, port.pid) in usb_ids), key=_interface_order):
+        rigs.setdefault(port.serial_number or port.device, port.device)
+    return sorted(rigs.values())
+
+# Function returning the order of a Teensy's serial ports: their USB interface number (the end of the
+# location, e.g. 1-1.2:1.0), then their name. Serial has the lowest, then SerialUSB1 and SerialUSB2.
+def _interface_order(port):
+    try:
+        interface = int(port.location.rsplit(':', 1)[1].rsplit('.', 1)[1])
+    except (AttributeError, IndexError, ValueError):
+        interface = 0
+    return interface, port.device
+
+class DeviceManager():
+    ''' Runs several pillar pullers from one process.
+
+    Each rig gets its own buffer from factory(port): its own DeviceSession (reader and
+    command queue), ring buffer, channels and break detector, so one rig falling behind
+    or unplugged never holds up another. Rigs can be added while running, e.g. when
+    discover_new() finds one that was just plugged in.
+    '''
+    def __init__(self, factory, usb_ids=TEENSY_USB_IDS):
+        self.factory = factory  # Function returning a buffer (see serialBuffer) for a port
+        self.usb_ids = usb_ids
+        self.rigs = {}  # Port -> buffer, in the order they were added
+        self.started = False
+
+    def __len__(self):
+        return len(self.rigs)
+
+    def __iter__(self):
+        return iter(self.rigs)
+
+    def __getitem__(self, port):
+        return self.rigs[port]
+
+    def items(self):
+        return self.rigs.items()
+
+    # Function to add a rig. Its session starts straight away if the manager is running.
+    def add(self, port):
+        if port in self.rigs:
+            return self.rigs[port]
+        buffer = self.factory(port)
+        self.rigs[port] = buffer
+        if self.started:
+            buffer.session.start()
+        logger.info(f"Added rig on {port}")
+        return buffer
+
+    # Function to add every rig that is plugged in but not added yet. Returns their ports.
+    def discover_new(self):
+        ports = [port for port in discover(self.usb_ids) if port not in self.rigs]
+        for port in ports:
+            self.add(port)
+        return ports
+
+    def start(self):
+        self.started = True
+        for buffer in self.rigs.values():
+            buffer.session.start()
+
+    def close(self):
+        for buffer in self.rigs.values():
+            buffer.close()
+        self.started = False
@@ -0,0 +1,258 @@
+import os
+import shutil
+import time
+import numpy as np
+
+# One record per sample, all the columns stored side by side in one contiguous array.
+# time is the Teensy's time stamp unwrapped into one count (timebase.DeviceClock), received
+# the host's time.time() when the block holding the sample was read.
+SAMPLE_DTYPE = np.dtype([
+    ('time', 'i8'),
+    ('force', 'f8'),
+    ('position', 'f8'),
+    ('filtered', 'f8'),
+    ('received', 'f8'),
+])
+
+class RingBuffer():
+    ''' Fixed-capacity ring buffer of samples.
+
+    One thread appends (the serial reader), any number of threads take
+    snapshots. Samples that are about to be overwritten are written to
+    spill_dir as .npy chunks, so memory use stays flat however long the session runs.
+    Past spill_max_bytes the oldest chunks are deleted, so disk use stays flat too and
+    the spill holds the most recent part of the session. discard_spill() deletes it all.
+    '''
+    def __init__(self, capacity=200000, spill_dir=None, chunk_size=None, dtype=SAMPLE_DTYPE, spill_max_bytes=None):
+        chunk_size = min(20000, capacity) if chunk_size is None else chunk_size
+        if chunk_size > capacity:
+            raise ValueError("chunk_size must not be larger than capacity")
+        self.capacity = capacity
+        self.chunk_size = chunk_size
+        self.spill_dir = spill_dir
+        self.dtype = np.dtype(dtype)
+        self._data = np.zeros(capacity, dtype=self.dtype)
+        self._head = 0  # Total number of samples ever written. Only the producer changes this.
+        self._reserved = 0  # Samples the producer has started writing, always >= _head.
+        self._spilled = 0  # Number of samples already written to disk (or discarded).
+        self.spill_max_bytes = spill_max_bytes
+        self.spill_files = []  # The spilled chunks still on disk, oldest first
+        self.spill_bytes = 0
+
+        if self.spill_dir is not None:
+            os.makedirs(self.spill_dir, exist_ok=True)
+
+    def __len__(self):
+        ''' Number of samples currently held in memory '''
+        return min(self._head, self.capacity)
+
+    @property
+    def total(self):
+        ''' Number of samples appended since the buffer was created '''
+        return self._head
+
+    # Function to append a single sample. Only call this from the producer thread.
+    def append(self, *values):
+        self.extend(np.array([tuple(values)], dtype=self.dtype))
+
+    # Function to append a block of samples. Accepts a structured array or an (n, columns) float array,
+    # whose columns are the first of the dtype's (the rest are left zero).
+    def extend(self, block):
+        block = self._as_records(block)
+        n = len(block)
+        if n == 0:
+            return
+        if n > self.capacity:
+            # Only the newest capacity samples can be held; everything before goes straight to disk.
+            self.flush()
+            self._reserved = self._head + n
+            self._spill_block(block[:n - self.capacity])
+            self._head += n - self.capacity
+            self._spilled = self._head
+            block = block[n - self.capacity:]
+            n = len(block)
+
+        # Spill the oldest chunks before they are overwritten.
+        while self._head + n - self._spilled > self.capacity:
+            self._spill_chunk()
+
+        # Announce the slots about to be written so readers can tell a copy was torn.
+        self._reserved = self._head + n
+        start = self._head % self.capacity
+        first = min(n, self.capacity - start)
+        self._data[start:start + first] = block[:first]
+        if first < n:
+            self._data[:n - first] = block[first:]
+
+        # Publishing the new head is what makes the samples visible to readers.
+        self._head += n
+
+    # Function to return a copy of the last n samples (all samples in memory if n is None).
+    def snapshot(self, n=None):
+        while True:
+            head = self._head
+            available = min(head, self.capacity)
+            count = available if n is None else max(0, min(n, available))
+            start = head - count
+            out = self._copy_range(start, head)
+
+            # If the producer lapped the region while it was being copied, the copy may be torn.
+            if self._reserved - start <= self.capacity:
+                return out
+
+    # Function for consumers that follow the stream (e.g. a recorder). Returns (samples, position, lost):
+    # a copy of everything appended since `position` (a previous return value, or 0), the position to pass
+    # next time, and how many samples were already overwritten before they could be read.
+    def read_since(self, position):
+        while True:
+            head = self._head
+            start = max(position, head - self.capacity)
+            out = self._copy_range(start, head)
+            if self._reserved - start <= self.capacity:
+                return out, head, start - position
+
+    # Function to return the most recent sample, or None if the buffer is empty.
+    def latest(self):
+        snap = self.snapshot(1)
+        return snap[0] if len(snap) else None
+
+    # Function to return the columns of the last n samples as separate arrays, all of them unless names are given.
+    def columns(self, n=None, names=None):
+        snap = self.snapshot(n)
+        return tuple(snap[name] for name in (names or self.dtype.names))
+
+    # Function to write any samples still in memory to disk, e.g. at the end of a session.
+    def flush(self):
+        while self._spilled < self._head:
+            self._spill_chunk()
+
+    # Function to read back every sample of the session still kept, spilled chunks first.
+    def load_all(self):
+        parts = [np.load(path) for path in self.spill_files]
+        parts.append(self._copy_range(self._spilled, self._head))
+        return np.concatenate(parts) if parts else np.zeros(0, dtype=self.dtype)
+
+    def _spill_chunk(self):
+        start = self._spilled
+        size = min(self.chunk_size, self._head - start)
+        self._spill_block(self._copy_range(start, start + size))
+        self._spilled = start + size
+
+    def _spill_block(self, block):
+        if self.spill_dir is None or len(block) == 0:
+            return
+        path = os.path.join(self.spill_dir, f'chunk_{self._spilled:012d}.npy')  # Named after its first sample
+        np.save(path, block)
+        self.spill_files.append(path)
+        self.spill_bytes += os.path.getsize(path)
+        while self.spill_max_bytes is not None and self.spill_bytes > self.spill_max_bytes and len(self.spill_files) > 1:
+            oldest = self.spill_files.pop(0)
+            self.spill_bytes -= os.path.getsize(oldest)
+            os.remove(oldest)
+
+    # Function to delete everything spilled and the spill directory, e.g. once a session has closed cleanly.
+    # Samples still in memory are not spilled any more.
+    def discard_spill(self):
+        if self.spill_dir is not None:
+            shutil.rmtree(self.spill_dir, ignore_errors=True)
+        self.spill_dir = None
+        self.spill_files = []
+        self.spill_bytes = 0
+
+    def _copy_range(self, start, stop):
+        count = stop - start
+        if count <= 0:
+            return np.zeros(0, dtype=self.dtype)
+        i = start % self.capacity
+        first = min(count, self.capacity - i)
+        if first == count:
+            return self._data[i:i + count].copy()
+        return np.concatenate((self._data[i:], self._data[:count - first]))
+
+    def _as_records(self, block):
+        if isinstance(block, np.ndarray) and block.dtype == self.dtype:
+            return block
+        block = np.asarray(block, dtype='f8')
+        if block.ndim == 1:
+            block = block.reshape(1, -1)
+        records = np.zeros(len(block), dtype=self.dtype)
+        for i, name in enumerate(self.dtype.names[:block.shape[1]]):
+            records[name] = block[:, i]
+        return records
+
+class SharedRingBuffer(RingBuffer):
+    ''' A RingBuffer in multiprocessing.shared_memory, so another process can read it without copying it across.
+
+    Made without a name, it creates the block; other processes attach with its name.
+    Only the process made with producer=True may append, and it alone spills to
+    spill_dir; everyone else reads with snapshot, read_since, columns and latest. The
+    head and reserved counters live in the block's header, so the torn-copy check works
+    across processes just as it does across threads.
+    '''
+    HEADER = 64  # Bytes before the samples: head and reserved (int64), then the host time of the newest block (float64)
+
+    def __init__(self, capacity=200000, name=None, producer=False, spill_dir=None, chunk_size=None, dtype=SAMPLE_DTYPE, spill_max_bytes=None):
+        from multiprocessing import shared_memory
+        chunk_size = min(20000, capacity) if chunk_size is None else chunk_size
+        if chunk_size > capacity:
+            raise ValueError("chunk_size must not be larger than capacity")
+        self.capacity = capacity
+        self.chunk_size = chunk_size
+        self.spill_dir = spill_dir if producer else None
+        self.dtype = np.dtype(dtype)
+        self.producer = producer
+        self.created = name is None
+        size = self.HEADER + capacity * self.dtype.itemsize
+        self.shm = shared_memory.SharedMemory(name=name, create=self.created, size=size if self.created else 0)
+        self.name = self.shm.name
+        self._counters = np.ndarray((2,), dtype=np.int64, buffer=self.shm.buf)
+        self._received = np.ndarray((1,), dtype=np.float64, buffer=self.shm.buf, offset=16)
+        self._data = np.ndarray((capacity,), dtype=self.dtype, buffer=self.shm.buf, offset=self.HEADER)
+        if self.created:
+            self._counters[:] = 0
+            self._received[0] = 0.0
+        self._spilled = self._head  # Anything written before this process attached is not its to spill
+        self.spill_max_bytes = spill_max_bytes
+        self.spill_files = []
+        self.spill_bytes = 0
+
+        if self.spill_dir is not None:
+            os.makedirs(self.spill_dir, exist_ok=True)
+
+    @property
+    def _head(self):
+        return int(self._counters[0])
+
+    @_head.setter
+    def _head(self, value):
+        self._counters[0] = value
+
+    @property
+    def _reserved(self):
+        return int(self._counters[1])
+
+    @_reserved.setter
+    def _reserved(self, value):
+        self._counters[1] = value
+
+    @property
+    def received(self):
+        ''' Host time.time() when the producer stored the newest block, 0 before the first '''
+        return float(self._received[0])
+
+    def extend(self, block):
+        if not self.producer:
+            raise RuntimeError("Only the producer process can append to a SharedRingBuffer")
+        super().extend(block)
+        self._received[0] = time.time()
+
+    def flush(self):
+        if self.producer:
+            super().flush()
+
+    # Function to let go of the shared block. The process that created it also removes it.
+    def close(self):
+        self._counters = self._received = self._data = None  # Views into the block have to go before it can be closed
+        self.shm.close()
+        if self.created:
+            self.shm.unlink()
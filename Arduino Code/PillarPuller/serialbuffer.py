@@ -0,0 +1,141 @@
+import os
+import re
+import time
+from collections import deque
+from ringbuffer import RingBuffer
+from telemetry import StreamDecoder
+from device import DeviceSession
+from acquisition import AcquisitionProcess, RemoteBreakDetector
+from breakdetect import BreakDetector
+from calibration import Calibrate, Calibration
+from metrics import Metrics, merge_snapshots
+
+# One rig's host stack, shared by the GUI (template.py) and the headless daemon (daemon.py):
+# the session reading the port, the ring buffer of samples, the filtered and calibrated
+# channels, the break detector and the metrics. Nothing here imports a GUI toolkit.
+
+class serialBuffer():
+    # Constants
+    SERIAL_PORT = 'COM3'
+    BAUD_RATE = 115200
+    BUFFER_CAPACITY = 200000 # Samples kept in memory, older samples are spilled to SPILL_DIR
+    SPILL_DIR = 'spill'
+    SPILL_MAX_BYTES = 1 << 30 # Disk a rig's spill may take, past it the oldest spilled samples are deleted
+    SMOOTH_CUTOFF = 50 # Hz, low pass of the host-filtered force
+    SLOW_DECIMATION = 10 # The slow channel keeps one sample in this many (about 170 Hz)
+
+    # The spill is only there to recover samples after a crash: unless keep_spill is set it is deleted when the rig closes cleanly.
+    def __init__(self, port=None, in_process=False, spill_dir=None, keep_spill=False):
+        port = port or self.SERIAL_PORT
+        # One spill directory per rig and run, e.g. spill/20240826-124612-COM3
+        spill_dir = os.path.join(spill_dir or self.SPILL_DIR, time.strftime("%Y%m%d-%H%M%S") + '-' + re.sub(r'[^A-Za-z0-9]+', '_', port).strip('_'))
+        self.keep_spill = keep_spill
+        self.status_lines = deque(maxlen=1000) # Non-data lines from the Teensy, drained by the GUI
+        self.command_listeners = [] # Functions called with every command sent to the Teensy
+        # Filtered copies of the stream, filtered once as it arrives. The raw samples are what gets recorded.
+        # Empty until add_channels() is called, as dsp is loaded after the window appears.
+        self.channels = {}
+        self._stop_on_break = False
+        self.calibration = Calibration(rig=port) # Applied to the channels, see calibration.py. The samples stay as the Teensy sent them.
+        self.metrics = Metrics() # Counters and timings of the reader, graph and recorder, shown in the Metrics tab
+        self.in_process = in_process
+        # The session owns the port: it reads in the background and queues commands. Call session.start() to connect.
+        if in_process:
+            # Read on a thread of this process, sharing the interpreter lock with Tk and the graph
+            self.samples = RingBuffer(self.BUFFER_CAPACITY, spill_dir=spill_dir, spill_max_bytes=self.SPILL_MAX_BYTES)
+            self.decoder = StreamDecoder(columns=4) # ASCII until binary mode is acknowledged by the Teensy
+            self.break_detector = BreakDetector(force_column=3) # Watches the filtered force for a pillar breaking
+            self.session = DeviceSession(self, port, self.BAUD_RATE, metrics=self.metrics)
+        else:
+            # Read, decoded, spilled and watched for breaks in a worker process, see acquisition.py. The samples
+            # arrive in a ring buffer in shared memory, and process() is called with what is new.
+            self.session = AcquisitionProcess(self, port, self.BAUD_RATE, capacity=self.BUFFER_CAPACITY, spill_dir=spill_dir,
+                                              spill_max_bytes=self.SPILL_MAX_BYTES, keep_spill=keep_spill)
+            self.samples = self.session.samples
+            self.break_detector = RemoteBreakDetector(self.session)
+
+    # Function to stop reading and close the port. The spill is written out if keep_spill is set, otherwise deleted.
+    def close(self):
+        self.session.close()
+        if self.in_process:
+            if self.keep_spill:
+                self.samples.flush()
+            else:
+                self.samples.discard_spill()
+
+    # Function to start the filtered channels. Called on the Tk thread once dsp has been loaded.
+    def add_channels(self):
+        if self.channels:
+            return
+        self.channels = self.make_channels()
+
+    # Function to switch to another calibration. The channels start again from the next block.
+    def set_calibration(self, calibration):
+        self.calibration = calibration
+        if self.channels:
+            self.channels = self.make_channels()
+
+    def make_channels(self):
+        from dsp import Channel, Decimate, LowPass, MedianDespike, Pipeline
+        columns = ('force', 'position', 'filtered')
+        # Swapped in whole, the reader thread only ever sees no channels or all of them
+        return {
+            'calibrated': Channel(Calibrate(self.calibration, columns), columns=columns, capacity=self.BUFFER_CAPACITY),
+            'smooth': Channel(Pipeline(Calibrate(self.calibration, ('force', 'filtered')), MedianDespike(5), LowPass(self.SMOOTH_CUTOFF)), capacity=self.BUFFER_CAPACITY),
+            'slow': Channel(Pipeline(Calibrate(self.calibration, columns), Decimate(self.SLOW_DECIMATION)), columns=columns),
+        }
+
+    # Send "stop" as soon as the host detects a break
+    @property
+    def stop_on_break(self):
+        return self._stop_on_break
+
+    @stop_on_break.setter
+    def stop_on_break(self, enabled):
+        self._stop_on_break = enabled
+        if not self.in_process:
+            self.session.set_stop_on_break(enabled) # The worker sends "stop" itself, without waiting for this process
+
+    # Called by the in-process session with every block it reads from the port
+    def ingest(self, samples, status):
+        if len(samples) > 0:
+            self.samples.extend(samples)
+        self.process(samples, status)
+
+    # Function to filter and watch samples that are already in self.samples
+    def process(self, samples, status):
+        if len(samples) > 0:
+            for channel in self.channels.values():
+                channel.feed(samples)
+            event = self.break_detector.feed(samples)
+            if event is not None:
+                self.on_break(event)
+        self.status_lines.extend(status)
+
+    # Called when the host detects a break. Stops the motor if stop_on_break is set.
+    def on_break(self, event):
+        if self.stop_on_break:
+            self.stop_on_break = False
+            self.send_command("stop")
+        self.status_lines.append(f"Host detected a break at time {event.time}: peak force {event.peak_force:.2f}, "
+                                 f"force {event.force:.2f}, position {event.position:.2f}")
+
+    # Function returning a metrics snapshot of the rig, with the acquisition process' reader metrics
+    def metrics_snapshot(self):
+        snapshot = self.metrics.snapshot()
+        remote = getattr(self.session, 'remote_metrics', None)
+        return snapshot if remote is None else merge_snapshots(remote, snapshot)
+
+    # Returns copies of the last n samples (everything in memory if n is None) as four arrays.
+    def get_data(self, n=None):
+        return self.samples.columns(n, ('time', 'force', 'position', 'filtered'))
+
+    # Queues a command for the Teensy. Returns a future that resolves to the latency in seconds once it has been written.
+    def send_command(self, command, expect=None, timeout=2.0):
+        for listener in self.command_listeners:
+            listener(command)
+        return self.session.submit(command, expect=expect, timeout=timeout)
+
+    # Asks the Teensy to switch between binary frames and ASCII lines. The decoder follows once the Teensy acknowledges.
+    def set_binary_mode(self, enabled):
+        return self.send_command("binary" if enabled else "ascii", expect="BINARY ON" if enabled else "ASCII ON")
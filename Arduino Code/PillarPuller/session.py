@@ -0,0 +1,256 @@
+import argparse
+import glob
+import json
+import os
+import shutil
+import time
+import numpy as np
+from lineparser import LineParser
+from recorder import Recorder
+from ringbuffer import SAMPLE_DTYPE
+from timebase import detect_units
+
+# A session is a directory holding one raw little-endian file per column plus meta.json:
+#
+#   pillar_puller_20240826-124612.session/
+#       meta.json        columns and their dtypes, row count, creation time, time_units (units per
+#                        second of the time column, see timebase.detect_units), calibration
+#                        (see calibration.py) and the commands sent during the session
+#       time.bin
+#       force.bin
+#       ...
+#
+# Columns are only ever appended to, so a session can be written while it is captured
+# and read with numpy.memmap at any time, even after a crash (the shortest column wins).
+FORMAT_VERSION = 1
+
+# How the firmware turns raw readings into units (see readAndPrintData in main.cpp)
+DEFAULT_CALIBRATION = {
+    'force_offset': 3000.0,  # mass = (nau.read() - 3000) / 600
+    'force_scale': 600.0,
+    'steps_per_mm': 1600.0,  # platformTravel = steps / 3200 * 2
+}
+
+# Column names used in the CSV files, and the session column each one becomes
+CSV_COLUMNS = {
+    'Time': 'time',
+    'Forces': 'force',
+    'Platform Position': 'position',
+    'Filtered Forces': 'filtered',
+}
+
+class SessionWriter():
+    ''' Appends blocks of samples to a session directory '''
+    def __init__(self, path, dtype=SAMPLE_DTYPE, calibration=None, **metadata):
+        os.makedirs(path)
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self.meta = {
+            'format': FORMAT_VERSION,
+            'created': time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            'calibration': DEFAULT_CALIBRATION if calibration is None else calibration,
+            'columns': {name: self.dtype[name].newbyteorder('<').str for name in self.dtype.names},
+            'rows': 0,
+            'time_units': None,  # Worked out from the first block with more than one sample, unless given
+            'commands': [],
+        }
+        self.meta.update(metadata)
+        self._files = {name: open(os.path.join(path, f'{name}.bin'), 'ab') for name in self.dtype.names}
+        self._write_meta()
+
+    # Function to append a structured array with (at least) this session's columns.
+    def append(self, block):
+        for name, f in self._files.items():
+            f.write(np.ascontiguousarray(block[name], dtype=self.meta['columns'][name]).tobytes())
+        self.meta['rows'] += len(block)
+        if self.meta['time_units'] is None and 'time' in self._files and len(block) > 1:
+            self.meta['time_units'] = detect_units(block['time'])
+
+    # Function to note a command sent to the Teensy during the session.
+    def log_command(self, command, timestamp=None):
+        self.meta['commands'].append({'time': time.time() if timestamp is None else timestamp, 'command': command})
+
+    def size(self):
+        return sum(f.tell() for f in self._files.values())
+
+    def flush(self, fsync=False):
+        for f in self._files.values():
+            f.flush()
+            if fsync:
+                os.fsync(f.fileno())
+        self._write_meta()
+
+    def close(self):
+        self.flush(fsync=True)
+        for f in self._files.values():
+            f.close()
+
+    def _write_meta(self):
+        write_meta(self.path, self.meta)
+
+# Function to write a session's meta.json. Written then renamed, so it is never half written.
+def write_meta(path, meta):
+    tmp = os.path.join(path, 'meta.json.tmp')
+    with open(tmp, 'w') as f:
+        json.dump(meta, f, indent=2)
+    os.replace(tmp, os.path.join(path, 'meta.json'))
+
+class Session():
+    ''' A session opened for reading. Columns are memory-mapped, so opening is instant at any size '''
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'meta.json')) as f:
+            self.meta = json.load(f)
+        dtypes = {name: np.dtype(dt) for name, dt in self.meta['columns'].items()}
+        sizes = [os.path.getsize(os.path.join(path, f'{name}.bin')) // dt.itemsize for name, dt in dtypes.items()]
+        self.rows = min(sizes) if sizes else 0
+        self.columns = {}
+        for name, dt in dtypes.items():
+            if self.rows == 0:
+                self.columns[name] = np.zeros(0, dtype=dt)
+            else:
+                self.columns[name] = np.memmap(os.path.join(path, f'{name}.bin'), dtype=dt, mode='r', shape=(self.rows,))
+
+    @property
+    def names(self):
+        return list(self.columns)
+
+    def __len__(self):
+        return self.rows
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    # Function to copy rows start:stop of every column into one structured array.
+    def read(self, start=0, stop=None):
+        stop = self.rows if stop is None else min(stop, self.rows)
+        out = np.zeros(max(stop - start, 0), dtype=[(name, col.dtype) for name, col in self.columns.items()])
+        for name, col in self.columns.items():
+            out[name] = col[start:stop]
+        return out
+
+def open_session(path):
+    return Session(path)
+
+class SessionRecorder(Recorder):
+    ''' Records the ring buffer into a session directory while capturing '''
+    def __init__(self, samples, calibration=None, **kwargs):
+        super().__init__(samples, **kwargs)
+        self.calibration = calibration
+        self.metadata = {}  # Extra meta.json entries for the next session, e.g. rig and operator
+        self._writer = None
+
+    # Function to register with serialBuffer.command_listeners, so commands end up in the session metadata.
+    def log_command(self, command):
+        writer = self._writer
+        if writer is not None:
+            writer.log_command(command)
+
+    def _open(self, filename):
+        self._writer = SessionWriter(filename, dtype=self.samples.dtype, calibration=self.calibration, **self.metadata)
+
+    def _write(self, block):
+        self._writer.append(block)
+
+    def _size(self):
+        return self._writer.size()
+
+    def _sync(self):
+        self._writer.flush(fsync=True)
+
+    def _close(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+# Function returning the session column names and dtype for a CSV header line.
+def csv_dtype(header):
+    columns = header.decode('utf-8').strip().split(',') if isinstance(header, bytes) else header
+    names = [CSV_COLUMNS.get(column, column.strip().lower().replace(' ', '_')) for column in columns]
+    return names, np.dtype([(name, SAMPLE_DTYPE[name] if name in SAMPLE_DTYPE.names else 'f8') for name in names])
+
+# Function to read a whole recorded CSV file into a structured array with session column names.
+def read_csv(path):
+    with open(path, 'rb') as f:
+        names, dtype = csv_dtype(f.readline())
+        samples, status = LineParser(columns=len(names)).feed(f.read() + b'\n')
+    out = np.zeros(len(samples), dtype=dtype)
+    for i, name in enumerate(names):
+        out[name] = samples[:, i]
+    return out
+
+# Function returning the units per second of a recording's time column: what its session or archive
+# metadata says, or for a CSV file (or a session written before time_units) what its time stamps suggest.
+def time_units(path, times):
+    units = None
+    if os.path.isdir(path):
+        with open(os.path.join(path, 'meta.json')) as f:
+            units = json.load(f).get('time_units')
+    elif path.endswith('.pparc'):
+        from archive import Archive
+        with Archive(path) as archive:
+            units = archive.meta.get('time_units')
+    return units or detect_units(times)
+
+# Function to load a recording (CSV file, session directory or archive) into a structured array.
+def load(path):
+    if os.path.isdir(path):
+        return open_session(path).read()
+    if path.endswith('.pparc'):
+        from archive import Archive
+        with Archive(path) as archive:
+            return archive.read()
+    return read_csv(path)
+
+# Function to convert a recorded CSV file into a session. Returns the session path.
+def convert_csv(csv_path, session_path=None, chunk_bytes=1 << 22):
+    if session_path is None:
+        session_path = os.path.splitext(csv_path)[0] + '.session'
+    with open(csv_path, 'rb') as f:
+        names, dtype = csv_dtype(f.readline())
+        writer = SessionWriter(session_path, dtype=dtype, source=os.path.basename(csv_path),
+                               created=time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(os.path.getmtime(csv_path))))
+        parser = LineParser(columns=len(names))
+        skipped = []
+        while True:
+            data = f.read(chunk_bytes)
+            if not data:
+                data = b'\n'  # Finish a last line without a newline
+            samples, status = parser.feed(data)
+            skipped.extend(status)
+            if len(samples) > 0:
+                block = np.zeros(len(samples), dtype=dtype)
+                for i, name in enumerate(names):
+                    block[name] = samples[:, i]
+                writer.append(block)
+            if data == b'\n':
+                break
+        writer.meta['skipped_lines'] = len(skipped)
+        writer.close()
+    return session_path
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Convert pillar puller CSV files to sessions, or describe a session")
+    commands = arg_parser.add_subparsers(dest='command', required=True)
+    convert = commands.add_parser('convert', help="convert CSV files (default: pillar_puller_*.csv in this folder)")
+    convert.add_argument('files', nargs='*')
+    convert.add_argument('--force', action='store_true', help="replace sessions that already exist")
+    info = commands.add_parser('info', help="print a session's metadata")
+    info.add_argument('session')
+    args = arg_parser.parse_args()
+
+    if args.command == 'convert':
+        files = args.files or sorted(glob.glob(os.path.join(os.path.dirname(__file__) or '.', 'pillar_puller_*.csv')))
+        for path in files:
+            target = os.path.splitext(path)[0] + '.session'
+            if os.path.exists(target):
+                if not args.force:
+                    print(f'{target} exists, skipping')
+                    continue
+                shutil.rmtree(target)
+            start = time.perf_counter()
+            convert_csv(path, target)
+            print(f'{path} -> {target}: {len(open_session(target))} rows in {time.perf_counter() - start:.2f} s')
+    elif args.command == 'info':
+        session = open_session(args.session)
+        print(json.dumps(session.meta, indent=2))
@@ -0,0 +1,249 @@
+import argparse
+import os
+import random
+import select
+import threading
+import time
+import tty
+import numpy as np
+from session import load
+from telemetry import encode_frames
+
+# Simulated Teensy on a pseudo terminal, so the host stack can be run, profiled and
+# benchmarked on any Linux box without the rig.
+#
+#   python simulator.py                              synthesized pulls at the real rate
+#   python simulator.py --replay pillar_puller_20240822-162339.csv --rate 10 --garbage 0.01
+#
+# It prints the port to pass to the GUI, e.g. python template.py --port /dev/pts/5
+#
+# Samples are stamped with millis() like main.cpp, so at the rig's sample spacing about two
+# samples in three share a stamp with the one before. --micros stamps them with micros()
+# instead, like the older PillarPuller.ino.
+
+SAMPLE_INTERVAL_US = 597  # Sample spacing of the rig, whichever clock stamps the samples
+FILTER_ALPHA = 0.35  # Same low pass filter as readAndPrintData in main.cpp
+SPEED_MM_S = 1.875  # speed = 1500 steps/s at 1600 steps/mm
+MAX_BLOCK = 1000  # Most samples written at once, the rest are skipped if the host holds up the pty
+STATUS_LINES = ["DIAG0 error", "Overtemp. PW", "Opening till force 4"]
+
+class SimulatedTeensy():
+    ''' Speaks the Teensy's serial protocol on a pty.
+
+    Samples come from a recorded session (replay) or a simple pull model (synthesize):
+    the platform moves with open/close/move_to_position/home, force rises with position
+    past contact and drops back to baseline when the pillar breaks. The commands from
+    processCommand in main.cpp are understood, including binary/ascii. Noise, dropped
+    samples and garbage lines can be injected.
+    '''
+    def __init__(self, replay=None, rate=1.0, noise=0.0, dropout=0.0, garbage=0.0, seed=None,
+                 contact=0.5, stiffness=4.0, break_force=10.0, baseline=1.5, micros=False):
+        self.rate = rate  # 1.0 is real time, 10.0 is ten times faster
+        self.micros = micros  # Stamp samples with micros() (PillarPuller.ino) instead of millis() (main.cpp)
+        self.noise = noise  # Standard deviation of noise added to force
+        self.dropout = dropout  # Probability that a sample is never sent
+        self.garbage = garbage  # Probability of a garbage line after a sample
+        self.random = random.Random(seed)
+        self.numpy_random = np.random.default_rng(seed)
+        self.contact = contact  # Position (mm) where the pillar starts to load
+        self.stiffness = stiffness  # Force per mm once loaded
+        self.break_force = break_force
+        self.baseline = baseline
+
+        self.replay = load(replay) if replay else None
+        self._replay_index = 0
+
+        self.binary = False
+        self.sent = 0
+        self.dropped = 0
+        self.skipped = 0  # Samples that fell due while the simulator was blocked writing, never generated
+        self.started = None  # time.monotonic() when the first sample was due
+        self.commands = []  # (time.monotonic(), command) for every command received
+        self._seq = 0
+        self._time_us = 0
+        self._position = 0.0
+        self._target = None
+        self._speed = 0.0
+        self._broken = False
+        self._filtered = baseline
+        self._running = False
+
+        self.master, slave = os.openpty()
+        tty.setraw(slave)
+        os.set_blocking(self.master, False)
+        self.port = os.ttyname(slave)
+        self._slave = slave  # Kept open so the pty survives the host closing and reopening it
+
+    def start(self):
+        self._running = True
+        self.started = time.monotonic()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._running = False
+        self._thread.join()
+        os.close(self.master)
+        os.close(self._slave)
+
+    def _run(self):
+        interval = SAMPLE_INTERVAL_US / 1e6 / self.rate
+        next_time = self.started
+        pending = b''
+        while self._running:
+            # Read commands, then send every sample that is due
+            timeout = max(next_time - time.monotonic(), 0)
+            readable, _, _ = select.select([self.master], [], [], min(timeout, 0.005))
+            if readable:
+                try:
+                    pending += os.read(self.master, 1024)
+                except BlockingIOError:
+                    pass
+                except OSError:
+                    pending = b''
+                *lines, pending = pending.split(b'\n')
+                for line in lines:
+                    self.process_command(line.decode('utf-8', errors='replace').strip())
+
+            now = time.monotonic()
+            due = int((now - next_time) / interval) + 1 if now >= next_time else 0
+            if due:
+                next_time += due * interval
+                skipped = max(due - MAX_BLOCK, 0)
+                self.skipped += skipped
+                self._time_us += skipped * SAMPLE_INTERVAL_US  # Leave a gap in time like a real loss
+                self._write(self._samples(min(due, MAX_BLOCK)))
+
+    # Function returning the time.monotonic() at which the first sample stamped stamp was due to be sent.
+    # With millis() stamps that is up to a millisecond (of simulated time) before the last sample stamped stamp.
+    def due_time(self, stamp):
+        time_us = stamp if self.micros else stamp * 1000
+        return self.started + (max(np.ceil(time_us / SAMPLE_INTERVAL_US), 1) - 1) * SAMPLE_INTERVAL_US / 1e6 / self.rate
+
+    # Function to handle one command the way processCommand in main.cpp does.
+    def process_command(self, command):
+        self.commands.append((time.monotonic(), command))
+        if command.startswith("open"):
+            self._target, self._speed = None, SPEED_MM_S
+        elif command.startswith("close"):
+            self._target, self._speed = None, -SPEED_MM_S
+        elif command.startswith("stop"):
+            self._target, self._speed = None, 0.0
+        elif "move_to_position" in command:
+            try:
+                self._target = float(command[command.index("move_to_position") + len("move_to_position"):] or 0)
+            except ValueError:
+                self._target = 0.0
+            self._speed = SPEED_MM_S if self._target > self._position else -SPEED_MM_S
+        elif command.startswith("home"):
+            self._target, self._speed = 0.0, -SPEED_MM_S if self._position > 0 else SPEED_MM_S
+        elif command.startswith("break"):
+            self._target, self._speed = None, SPEED_MM_S
+        elif command.startswith("zero_position"):
+            self._position = 0.0
+            self._broken = False
+        elif command.startswith("binary"):
+            self._write_text("BINARY ON")
+            self._seq = 0
+            self.binary = True
+        elif command.startswith("ascii"):
+            self.binary = False
+            self._write_text("ASCII ON")
+        elif command:
+            self._write_text("Invalid command")
+
+    # Function returning the next n samples as (time stamp, force, position, filtered) arrays.
+    def _samples(self, n):
+        if self.replay is not None:
+            index = (self._replay_index + np.arange(n)) % len(self.replay)
+            self._replay_index = int(index[-1]) + 1
+            force = self.replay['force'][index].astype(np.float64)
+            position = self.replay['position'][index].astype(np.float64)
+        else:
+            force, position = self._synthesize(n)
+        times = self._time_us + SAMPLE_INTERVAL_US * np.arange(1, n + 1)
+        self._time_us = int(times[-1])
+        if not self.micros:
+            times = times // 1000
+        if self.noise:
+            force = force + self.numpy_random.normal(0, self.noise, n)
+        filtered = np.empty(n)
+        for i in range(n):
+            self._filtered = FILTER_ALPHA * force[i] + (1 - FILTER_ALPHA) * self._filtered
+            filtered[i] = self._filtered
+        return times, force, position, filtered
+
+    def _synthesize(self, n):
+        step = self._speed * SAMPLE_INTERVAL_US / 1e6
+        position = self._position + step * np.arange(1, n + 1)
+        if self._target is not None:
+            position = np.minimum(position, self._target) if step > 0 else np.maximum(position, self._target)
+            if position[-1] == self._target:
+                self._speed = 0.0
+        self._position = float(position[-1]) if n else self._position
+        force = self.baseline + self.stiffness * np.maximum(position - self.contact, 0)
+        broken = np.logical_or.accumulate(force >= self.break_force) | self._broken
+        force[broken] = self.baseline
+        self._broken = bool(broken[-1])
+        return force, position
+
+    def _write(self, samples):
+        times, force, position, filtered = samples
+        keep = self.numpy_random.random(len(times)) >= self.dropout
+        self.dropped += int(np.sum(~keep))
+        if self.binary:
+            seq = (self._seq + np.arange(len(times))) % 65536
+            self._seq = (self._seq + len(times)) % 65536
+            data = encode_frames(seq[keep], times[keep] % 2**32, force[keep], position[keep], filtered[keep])
+        else:
+            lines = []
+            for t, f, p, ff in zip(times[keep], force[keep], position[keep], filtered[keep]):
+                lines.append(f'{int(t) % 2**32},{f:.2f},{p:.2f},{ff:.2f}\r\n')
+                if self.garbage and self.random.random() < self.garbage:
+                    lines.append(self._garbage_line())
+            data = ''.join(lines).encode('utf-8')
+        self.sent += int(np.sum(keep))
+        self._write_bytes(data)
+
+    def _garbage_line(self):
+        if self.random.random() < 0.5:
+            return self.random.choice(STATUS_LINES) + '\r\n'
+        return ''.join(chr(self.random.randint(33, 126)) for _ in range(self.random.randint(1, 30))) + '\r\n'
+
+    def _write_text(self, text):
+        self._write_bytes((text + '\r\n').encode('utf-8'))
+
+    def _write_bytes(self, data):
+        # Blocks while the pty is full (the host is not keeping up), but never past stop()
+        data = memoryview(data)
+        while data and self._running:
+            _, writable, _ = select.select([], [self.master], [], 0.05)
+            if not writable:
+                continue
+            try:
+                data = data[os.write(self.master, data):]
+            except BlockingIOError:
+                continue
+            except OSError:
+                return  # Nobody is reading, drop it like a USB serial port would
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Simulated pillar puller on a pseudo terminal")
+    arg_parser.add_argument('--replay', help="CSV file or session directory to replay (default: synthesize pulls)")
+    arg_parser.add_argument('--rate', type=float, default=1.0, help="speed multiplier, 1.0 is real time")
+    arg_parser.add_argument('--noise', type=float, default=0.0, help="standard deviation of force noise")
+    arg_parser.add_argument('--dropout', type=float, default=0.0, help="probability a sample is not sent")
+    arg_parser.add_argument('--garbage', type=float, default=0.0, help="probability of a garbage line after a sample")
+    arg_parser.add_argument('--seed', type=int, default=None)
+    arg_parser.add_argument('--micros', action='store_true', help="stamp samples with micros() like PillarPuller.ino, not millis() like main.cpp")
+    args = arg_parser.parse_args()
+
+    device = SimulatedTeensy(args.replay, args.rate, args.noise, args.dropout, args.garbage, args.seed, micros=args.micros).start()
+    print(f'Simulated Teensy on {device.port}, Ctrl+C to stop')
+    try:
+        while True:
+            time.sleep(5)
+            print(f'{device.sent} samples sent, {device.dropped} dropped, {len(device.commands)} commands received')
+    except KeyboardInterrupt:
+        device.stop()
@@ -0,0 +1,98 @@
+import sys
+import threading
+import time
+
+# Start up timing for the GUI, reported in its Status tab.
+#
+#   startup = StartupTimer().install()    first thing in the program, before the other imports
+#   ...
+#   startup.mark('window shown')
+#   for line in startup.report():
+#       logger.info(line)
+#
+# While installed, every module imported is timed the way python -X importtime does it:
+# cumulative time (the module and everything it imported) and self time (without them).
+# The report lists the imports made directly by the program, which is what moving an
+# import or loading it later changes, and the slowest modules by self time.
+
+class ImportTimer():
+    ''' A sys.meta_path finder that times how long each module takes to execute.
+
+    It finds nothing itself: it asks the finders after it, then wraps the loader's
+    exec_module of what they found. Each thread keeps its own stack of imports, so
+    modules loaded in the background don't skew the ones loaded on the Tk thread.
+    '''
+    def __init__(self, clock=time.perf_counter):
+        self.clock = clock
+        self.modules = {}  # Name -> (cumulative seconds, self seconds, depth it was imported at, thread name)
+        self._local = threading.local()
+
+    def find_spec(self, name, path=None, target=None):
+        if getattr(self._local, 'finding', False):
+            return None
+        self._local.finding = True
+        try:
+            for finder in sys.meta_path:
+                if finder is self or not hasattr(finder, 'find_spec'):
+                    continue
+                spec = finder.find_spec(name, path, target)
+                if spec is not None:
+                    break
+            else:
+                return None
+        finally:
+            self._local.finding = False
+        loader = spec.loader
+        # Built-in and frozen modules are loaded by their finder class itself, which is shared, and they are quick
+        if loader is None or isinstance(loader, type) or not hasattr(loader, 'exec_module'):
+            return spec
+        exec_module = loader.exec_module
+        def timed_exec_module(module):
+            stack = self._local.__dict__.setdefault('stack', [])
+            stack.append(0.0)  # Time spent in nested imports
+            start = self.clock()
+            try:
+                exec_module(module)
+            finally:
+                elapsed = self.clock() - start
+                nested = stack.pop()
+                if stack:
+                    stack[-1] += elapsed
+                self.modules[name] = (elapsed, elapsed - nested, len(stack), threading.current_thread().name)
+        loader.exec_module = timed_exec_module
+        return spec
+
+class StartupTimer():
+    ''' Times the start up of the program: what it imported, and when it got to each mark '''
+    def __init__(self, start=None):
+        self.start = time.perf_counter() if start is None else start
+        self.marks = {}  # Name -> seconds from start
+        self.imports = ImportTimer()
+
+    # Function to start timing imports. Returns the timer.
+    def install(self):
+        if self.imports not in sys.meta_path:
+            sys.meta_path.insert(0, self.imports)
+        return self
+
+    # Function to stop timing imports, once start up is over.
+    def uninstall(self):
+        if self.imports in sys.meta_path:
+            sys.meta_path.remove(self.imports)
+
+    # Function to note that start up got somewhere, e.g. 'window shown'. Only the first time counts.
+    def mark(self, name):
+        self.marks.setdefault(name, time.perf_counter() - self.start)
+
+    # Function returning the report as lines of text.
+    def report(self, top=8):
+        lines = ['Start up: ' + ', '.join(f'{name} after {seconds:.2f} s' for name, seconds in sorted(self.marks.items(), key=lambda item: item[1]))]
+        modules = self.imports.modules
+        direct = sorted(((cumulative, name, thread) for name, (cumulative, own, depth, thread) in modules.items() if depth == 0), reverse=True)
+        if direct:
+            lines.append('Imports (cumulative, like python -X importtime): ' + ', '.join(
+                f'{name} {cumulative * 1000:.0f} ms' + ('' if thread == 'MainThread' else f' [{thread}]') for cumulative, name, thread in direct[:top]))
+            slowest = sorted(((own, name) for name, (cumulative, own, depth, thread) in modules.items()), reverse=True)
+            lines.append('Slowest modules (self): ' + ', '.join(f'{name} {own * 1000:.0f} ms' for own, name in slowest[:top]))
+            lines.append(f'{len(modules)} modules imported in {sum(own for cumulative, own, depth, thread in modules.values()):.2f} s')
+        return lines
@@ -0,0 +1,257 @@
+import numpy as np
+from lineparser import LineParser
+
+# Binary frame sent by the firmware after the "binary" command (see processCommand in main.cpp).
+# Little endian, packed, 22 bytes:
+#   sync (u16 0xA55A) | seq (u16) | time (u32) | force (f32) | position (f32) | filtered (f32) | crc (u16)
+# crc is CRC-16/CCITT-FALSE over seq..filtered. time is the Teensy's millis(), like the ASCII lines
+# (writeFrame(millis(), ...) in readAndPrintData); see timebase.py for how the host works out the units.
+#
+#   python telemetry.py      checks the CRC, resyncing past bad frames and the mode switch
+SYNC = 0xA55A
+SYNC_BYTES = SYNC.to_bytes(2, 'little')
+FRAME_DTYPE = np.dtype([
+    ('sync', '<u2'),
+    ('seq', '<u2'),
+    ('time', '<u4'),
+    ('force', '<f4'),
+    ('position', '<f4'),
+    ('filtered', '<f4'),
+    ('crc', '<u2'),
+])
+FRAME_SIZE = FRAME_DTYPE.itemsize
+
+# Lines the firmware prints to acknowledge a mode change
+BINARY_ACK = b'BINARY ON\r\n'
+ASCII_ACK = b'ASCII ON\r\n'
+MAX_TEXT_LINE = 256
+
+def _crc_table():
+    table = np.zeros(256, dtype=np.uint16)
+    for i in range(256):
+        crc = i << 8
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x1021) if crc & 0x8000 else (crc << 1)
+        table[i] = crc & 0xFFFF
+    return table
+
+CRC_TABLE = _crc_table()
+
+# Function to compute the CRC-16/CCITT-FALSE of every row of an (n, length) uint8 array at once.
+def crc16(rows):
+    rows = np.atleast_2d(rows)
+    crc = np.full(len(rows), 0xFFFF, dtype=np.uint16)
+    for i in range(rows.shape[1]):
+        crc = (crc << 8) ^ CRC_TABLE[(crc >> 8) ^ rows[:, i]]
+    return crc
+
+# Function to build frames, used by the simulator and the checks at the end of this file.
+def encode_frames(seq, time, force, position, filtered):
+    frames = np.zeros(len(np.atleast_1d(seq)), dtype=FRAME_DTYPE)
+    frames['sync'] = SYNC
+    frames['seq'] = seq
+    frames['time'] = time
+    frames['force'] = force
+    frames['position'] = position
+    frames['filtered'] = filtered
+    raw = frames.view(np.uint8).reshape(len(frames), FRAME_SIZE)
+    frames['crc'] = crc16(raw[:, 2:FRAME_SIZE - 2])
+    return frames.tobytes()
+
+class FrameDecoder():
+    ''' Decodes binary frames from the byte stream.
+
+    Frames are read in place with numpy.frombuffer. Anything between frames that is
+    not a valid frame (text the firmware still prints, line noise) is skipped until
+    the next sync word, and returned as status text. Lost frames are counted from
+    gaps in the sequence number.
+    '''
+    def __init__(self):
+        self._pending = b''
+        self._last_seq = None
+        self.frames = 0
+        self.dropped = 0  # Frames missing according to the sequence number
+        self.corrupt = 0  # Sync words found where the frame failed the CRC check
+        self.junk_bytes = 0  # Bytes between frames that were not readable text
+
+    # Function to decode a chunk of bytes. Returns (frames, status_lines), frames is a structured array.
+    def feed(self, data):
+        buf = self._pending + data
+        parts = []
+        junk = [[]]  # Bytes that were not frames, one list per gap between runs of good frames
+        pos = 0
+        while True:
+            start = buf.find(SYNC_BYTES, pos)
+            if start < 0:
+                # Keep an unfinished text line (or half a sync word) for the next read, everything else is junk
+                keep = max(buf.rfind(b'\n', pos) + 1, pos)
+                if len(buf) - keep > MAX_TEXT_LINE:
+                    keep = len(buf) - 1 if buf.endswith(SYNC_BYTES[:1]) else len(buf)
+                junk[-1].append(buf[pos:keep])
+                pos = keep
+                break
+            junk[-1].append(buf[pos:start])
+            count = (len(buf) - start) // FRAME_SIZE
+            if count == 0:
+                pos = start
+                break
+
+            frames = np.frombuffer(buf, dtype=FRAME_DTYPE, count=count, offset=start)
+            raw = np.frombuffer(buf, dtype=np.uint8, count=count * FRAME_SIZE, offset=start).reshape(count, FRAME_SIZE)
+            valid = (frames['sync'] == SYNC) & (crc16(raw[:, 2:FRAME_SIZE - 2]) == frames['crc'])
+
+            # Take the run of good frames, then resync one byte past the first bad one
+            bad = np.flatnonzero(~valid)
+            good = count if len(bad) == 0 else bad[0]
+            if good > 0:
+                parts.append(frames[:good])
+                junk.append([])
+            pos = start + good * FRAME_SIZE
+            if good < count:
+                if frames['sync'][good] == SYNC:
+                    self.corrupt += 1
+                junk[-1].append(buf[pos:pos + 1])
+                pos += 1
+
+        self._pending = buf[pos:]
+        frames = np.concatenate(parts) if len(parts) > 1 else (parts[0] if parts else np.zeros(0, dtype=FRAME_DTYPE))
+        self._count_gaps(frames)
+        self.frames += len(frames)
+
+        # Text the firmware printed between frames is passed on, binary noise is only counted
+        status = []
+        for gap in junk:
+            # The firmware ends text with println, so an unterminated tail is noise
+            lines = b''.join(gap).split(b'\n')
+            self.junk_bytes += len(lines.pop())
+            for line in lines:
+                line = line.decode('ascii', errors='replace').strip()
+                if line.isprintable():
+                    if line:
+                        status.append(line)
+                else:
+                    self.junk_bytes += len(line)
+        return frames, status
+
+    def _count_gaps(self, frames):
+        if len(frames) == 0:
+            return
+        seq = frames['seq'].astype(np.int64)
+        if self._last_seq is not None:
+            seq = np.concatenate(([self._last_seq], seq))
+        steps = np.diff(seq) % 65536
+        # Small forward steps are lost frames. A large step is the firmware restarting its count, not a loss.
+        gaps = steps[(steps > 1) & (steps < 32768)]
+        self.dropped += int(np.sum(gaps - 1))
+        self._last_seq = int(seq[-1])
+
+class StreamDecoder():
+    ''' Reads the serial stream in ASCII or binary mode.
+
+    Starts in ASCII mode. The switch happens at the firmware's acknowledgement line,
+    so bytes either side of it in the same read go to the right decoder. If the
+    firmware does not know the "binary" command it answers "Invalid command" and
+    the stream stays ASCII.
+    '''
+    def __init__(self, columns=4):
+        self.columns = columns
+        self.lines = LineParser(columns=columns)
+        self.frames = FrameDecoder()
+        self.binary = False
+        self.bytes = 0
+
+    # Function to read everything the serial port has buffered. Returns ((n, columns) samples, status_lines).
+    def read(self, ser):
+        waiting = ser.in_waiting
+        return self.feed(ser.read(waiting if waiting > 0 else 1))
+
+    def feed(self, data):
+        self.bytes += len(data)
+        blocks = []
+        status = []
+        while data:
+            ack = ASCII_ACK if self.binary else BINARY_ACK
+            # The acknowledgement may have been split across two reads, so look for it in what the decoder held back too
+            data = self._take_pending() + data
+            i = data.find(ack)
+            head, data = (data, b'') if i < 0 else (data[:i + len(ack)], data[i + len(ack):])
+            if self.binary:
+                frames, lines = self.frames.feed(head)
+                blocks.append(self.to_samples(frames))
+            else:
+                samples, lines = self.lines.feed(head)
+                blocks.append(samples)
+            status.extend(lines)
+            if i >= 0:
+                self.binary = not self.binary
+        if not blocks:
+            return np.empty((0, self.columns)), status
+        return np.concatenate(blocks) if len(blocks) > 1 else blocks[0], status
+
+    # Returns the bytes the current decoder is holding back for its next read, and forgets them
+    def _take_pending(self):
+        if self.binary:
+            carry, self.frames._pending = self.frames._pending, b''
+        else:
+            carry, self.lines._partial = self.lines._partial, b''
+        return carry
+
+    # Function to convert decoded frames to the same (n, columns) layout the ASCII parser returns.
+    def to_samples(self, frames):
+        names = ('time', 'force', 'position', 'filtered')[:self.columns]
+        return np.column_stack([frames[name].astype(np.float64) for name in names]) if len(frames) else np.empty((0, self.columns))
+
+# Function to check the CRC against its standard check value and the frame decoder against a damaged stream:
+# a frame with a flipped byte, junk and a status line between frames, a lost frame and a split read.
+# Returns a list of what went wrong, empty if nothing did.
+def check_frames(frames=20):
+    problems = []
+    crc = int(crc16(np.frombuffer(b'123456789', dtype=np.uint8))[0])
+    if crc != 0x29B1:
+        problems.append(f'CRC-16/CCITT-FALSE of 123456789 is {crc:#06x}, not 0x29b1')
+    seq = np.arange(frames)
+    good = [encode_frames(n, 1000 + n, n * 0.5, n * 0.25, n * 0.125) for n in seq]
+    damaged = bytearray(good[5])
+    damaged[8] ^= 0xFF  # In the force
+    stream = b''.join(good[:5]) + bytes(damaged) + b'\x00\xff\x5a' + b''.join(good[6:10]) + b'Opening till force 4\r\n' \
+        + b''.join(good[11:])  # Frame 10 is lost
+    expected = [1000 + n for n in seq if n not in (5, 10)]
+    decoder = FrameDecoder()
+    split = len(stream) // 2 + 3  # Not on a frame boundary
+    first, status = decoder.feed(stream[:split])
+    second, more = decoder.feed(stream[split:])
+    times = np.concatenate((first, second))['time'].tolist()
+    if times != expected:
+        problems.append(f'decoded frames {times}, expected {expected}')
+    if status + more != ['Opening till force 4']:
+        problems.append(f'status lines {status + more}')
+    if decoder.corrupt != 1:
+        problems.append(f'{decoder.corrupt} corrupt frames counted, expected 1')
+    if decoder.dropped != 2:
+        problems.append(f'{decoder.dropped} dropped frames counted, expected 2 (the corrupt one and the lost one)')
+    return problems
+
+# Function to check that a stream switching ASCII -> binary -> ASCII decodes the same however it is split into reads.
+# Returns the split points that lost or garbled samples, every split is tried at every position around both acknowledgements.
+def check_mode_switch(frames=20):
+    seq = np.arange(frames)
+    binary = encode_frames(seq, 1000 + seq, seq * 0.5, seq * 0.25, seq * 0.125)
+    stream = b'1,1.5,0,1.5\r\n2,1.5,0,1.5\r\n' + BINARY_ACK + binary + ASCII_ACK + b'3,1.5,0,1.5\r\n'
+    expected = [1, 2] + list(1000 + seq) + [3]
+    ack_ends = (stream.index(BINARY_ACK) + len(BINARY_ACK), stream.index(ASCII_ACK) + len(ASCII_ACK))
+    failed = []
+    for end in ack_ends:
+        for split in range(end - 2 * len(BINARY_ACK), end + FRAME_SIZE + 2):
+            decoder = StreamDecoder(columns=4)
+            first, status = decoder.feed(stream[:split])
+            second, more = decoder.feed(stream[split:])
+            times = np.concatenate((first, second))[:, 0].astype(int).tolist()
+            if times != expected or status + more != ['BINARY ON', 'ASCII ON'] or decoder.binary:
+                failed.append(split)
+    return failed
+
+if __name__ == "__main__":
+    problems = check_frames()
+    print('\n'.join(problems) if problems else 'CRC and frame decoding are right')
+    failed = check_mode_switch()
+    print(f'Mode switch decoded wrongly when split at bytes {failed}' if failed else 'Mode switch decodes the same at every split')
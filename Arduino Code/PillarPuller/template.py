@@ -1,62 +1,48 @@
-import csv
+from startup import StartupTimer
+startup = StartupTimer().install() # Times everything imported from here on, reported in the Status tab
+
+# Only what the window needs is imported here. matplotlib and scipy (dsp) take over a second
+# to import, so they are loaded in the background once the window is up, see load_modules.
+import argparse
+import getpass
 import os
-import time
-import serial
 import threading
+import time
 import tkinter
 import tkinter.messagebox
+import tkinter.filedialog
 import customtkinter
-from PIL import Image, ImageTk
+from PIL import Image
 import logging
-import time
-import matplotlib.pyplot as plt
-from matplotlib.animation import FuncAnimation
-from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
+import itertools
 import numpy as np
 import re
-import concurrent.futures
+from liveplot import LivePlot
+from recorder import CsvRecorder
+from session import SessionRecorder
+from calibration import CalibrationStore
+from metrics import MetricsServer, format_snapshot, log_snapshots
+from serialbuffer import serialBuffer
+from rigs import DeviceManager, discover
+from profiles import ProfileRunner, load_profile, planned_duration
 
 customtkinter.set_appearance_mode("Dark")  # Modes: "System" (standard), "Dark", "Light"
 customtkinter.set_default_color_theme("dark-blue")  # Themes: "blue" (standard), "green", "dark-blue"
 
-class serialBuffer():
-    # Constants
-    SERIAL_PORT = 'COM3'
-    BAUD_RATE = 115200
-
-    def __init__(self):
-        self.micros = []
-        self.forces = []
-        self.platformDistances = []
-        self.filtered_forces = []
-        self.ser = serial.Serial(self.SERIAL_PORT, self.BAUD_RATE)
-
-    def populate(self):
-        while self.ser.is_open and self.ser.readable():
-            line = self.ser.readline().decode('utf-8').strip()
-            if ',' in line:
-                sensorValues = line.split(',')
-                current_time = float(sensorValues[0])
-                force = float(sensorValues[1])
-                platform_distance = float(sensorValues[2])
-                filtered_force = float(sensorValues[3])  # Calculate filtered force
-
-                # Append the data to the lists
-                self.micros.append(current_time)
-                self.forces.append(force)
-                self.platformDistances.append(platform_distance)
-                self.filtered_forces.append(filtered_force)
-                # print(line)
-
-    def get_data(self):
-        return self.micros, self.forces, self.platformDistances, self.filtered_forces
-
-    def send_command(self, command):
-        self.ser.write((command + '\n').encode('utf-8'))
-
 class App(customtkinter.CTk):
-    def __init__(self, buffer):
+    PLOT_WINDOW = 2000 # Number of most recent samples shown on the graph
+    RECORDING_MAX_BYTES = 500 * 1024 * 1024 # Recordings continue in a new file after this size
+    METRICS_LOG = 'metrics.jsonl' # Metrics snapshots are appended here every METRICS_LOG_INTERVAL updates
+    METRICS_LOG_INTERVAL = 10 # The Metrics tab updates once a second
+    CATALOG = 'catalog.sqlite' # Finished recordings are indexed here, see catalog.py
+    CALIBRATION_DIR = 'calibrations' # Every rig's calibration sets, see calibration.py
+    TARE_SAMPLES = 800 # About half a second, averaged by the Tare button
+    RIG_SCAN_INTERVAL = 2000 # ms between looking for newly plugged in rigs, when they are discovered automatically
+
+    def __init__(self, manager, metrics_server=None, scan_for_rigs=False, startup=None):
         super().__init__()
+        self.startup = startup or StartupTimer()
+        self.bind("<Map>", lambda event: self.startup.mark('window shown'), add="+")
 
         # configure window
         self.title("Contactile")
@@ -93,11 +79,13 @@ class App(customtkinter.CTk):
         self.logo_label = customtkinter.CTkLabel(self.logo, text="Template", font=customtkinter.CTkFont(size=24, weight="bold"))
         self.logo_label.grid(row=0, column=1, padx=(20,0), pady=(0,0))
 
-        # Add entry box and button for CSV generation
+        # Add entry box and button for CSV recording
         self.filename_entry = customtkinter.CTkEntry(self.sidebar_left, placeholder_text="Enter filename")
         self.filename_entry.grid(row=1, column=0, padx=20, pady=(1, 1), sticky="ew")
-        self.generate_csv_button = customtkinter.CTkButton(self.sidebar_left, text="Generate CSV", command=lambda: self.generate_csv(self.filename_entry.get()))
+        self.generate_csv_button = customtkinter.CTkButton(self.sidebar_left, text="Start Recording", command=lambda: self.toggle_recording(self.filename_entry.get()))
         self.generate_csv_button.grid(row=2, column=0, padx=20, pady=(1, 1), sticky="ew")
+        self.format_menu = customtkinter.CTkOptionMenu(self.sidebar_left, values=["CSV", "Session"])
+        self.format_menu.grid(row=5, column=0, padx=20, pady=(1, 1), sticky="ew")
 
         # Add entry box and button for target_position
         self.position_entry = customtkinter.CTkEntry(self.sidebar_left, placeholder_text="Enter a position (mm)")
@@ -129,14 +117,33 @@ class App(customtkinter.CTk):
         self.zero_position_button = customtkinter.CTkButton(self.sidebar_left, text="zero position", command=self.zero_position)
         self.zero_position_button.grid(row=12, column=0, padx=20, pady=(1, 1), sticky="ew")
 
+        # Add a switch to use the binary telemetry protocol instead of ASCII lines
+        self.binary_switch = customtkinter.CTkSwitch(self.sidebar_left, text="binary telemetry", command=self.toggle_binary_mode)
+        self.binary_switch.grid(row=13, column=0, padx=20, pady=(1, 1), sticky="ew")
+
+        # Add a button to run a test profile (see profiles.py) on the selected rig, or abort the one running
+        self.profile_button = customtkinter.CTkButton(self.sidebar_left, text="Run Profile", command=self.toggle_profile)
+        self.profile_button.grid(row=14, column=0, padx=20, pady=(1, 1), sticky="ew")
+
+        # Add a button to zero the force on the host, as a new calibration set
+        self.tare_button = customtkinter.CTkButton(self.sidebar_left, text="tare force", command=self.tare)
+        self.tare_button.grid(row=15, column=0, padx=20, pady=(1, 1), sticky="ew")
+
 
         # create central tabview
         self.tabview = customtkinter.CTkTabview(self)
         self.tabview.grid(row=0, column=1, sticky="nsew", padx=(2,2), pady=(0,2))
         self.tabview.add("Home")
         self.tabview.add("Tab 2")
+        self.tabview.add("History")
+        self.tabview.add("Compare")
         self.tabview.tab("Home").grid_columnconfigure(0, weight=1)
+        self.tabview.tab("Home").grid_rowconfigure(1, weight=1)
         self.tabview.tab("Tab 2").grid_columnconfigure(0, weight=1)
+        self.tabview.tab("History").grid_columnconfigure(1, weight=1)
+        self.tabview.tab("History").grid_rowconfigure(1, weight=1)
+        self.tabview.tab("Compare").grid_columnconfigure(3, weight=1)
+        self.tabview.tab("Compare").grid_rowconfigure(1, weight=1)
 
         # create lower tabview
         self.tabview_lower = customtkinter.CTkTabview(self)
@@ -144,11 +151,21 @@ class App(customtkinter.CTk):
         self.tabview_lower.add("Status")
         self.tabview_lower.tab("Status").grid_columnconfigure(0, weight=1)
         self.tabview_lower.tab("Status").grid_rowconfigure(0, weight=1)
+        self.tabview_lower.add("Metrics")
+        self.tabview_lower.tab("Metrics").grid_columnconfigure(0, weight=1)
+        self.tabview_lower.tab("Metrics").grid_rowconfigure(0, weight=1)
 
         # Create status window
         self.status_text = customtkinter.CTkTextbox(self.tabview_lower.tab("Status"), corner_radius=2, font=customtkinter.CTkFont(size=16))
         self.status_text.grid(sticky="nsew")
 
+        # Create metrics window
+        self.metrics_text = customtkinter.CTkTextbox(self.tabview_lower.tab("Metrics"), corner_radius=2, font=customtkinter.CTkFont(family="Courier", size=14))
+        self.metrics_text.grid(sticky="nsew")
+        self.metrics_server = metrics_server
+        self.metrics_updates = 0
+        self.metrics_missing = {} # reader.missing_samples of each rig at the last update
+
         # Create a logger to write to the status window
         formatter = logging.Formatter("%(asctime)s [%(levelname)s] %(message)s", "%Y-%m-%d %I:%M:%S%p")
         self.text_handler = TextHandler(self.status_text, formatter)
@@ -158,8 +175,27 @@ class App(customtkinter.CTk):
         self.logger.addHandler(self.text_handler)
         self.logger.setLevel(logging.DEBUG)
 
-        # Store the buffer
-        self.buffer = buffer
+        # Store the rigs. The sidebar and graph act on the selected one, every rig keeps reading and recording.
+        self.manager = manager
+        self.selected = next(iter(manager))
+        self.recorders = {} # Port -> {"CSV": CsvRecorder, "Session": SessionRecorder}
+        self.active_recorders = {} # Port -> the recorder last started on that rig
+        self.profile_runners = {} # Port -> the ProfileRunner last started on that rig
+        self.recording_tags = {} # Port -> catalogue tags of the recording running on that rig, as it started
+        self.calibrations = CalibrationStore(self.CALIBRATION_DIR)
+        for port, buffer in manager.items():
+            self.load_calibration(port, buffer)
+            self.add_recorders(port, buffer)
+
+        # Rig selector above the graph, one tab per rig
+        self.rig_selector = customtkinter.CTkSegmentedButton(self.tabview.tab("Home"), values=list(manager), command=self.select_rig)
+        self.rig_selector.grid(row=0, column=0, padx=20, pady=(0, 2), sticky="w")
+        self.rig_selector.set(self.selected)
+
+        # Whether the selected rig is connected. The sessions connect in the background, so this starts as "Connecting..."
+        self.connection_label = customtkinter.CTkLabel(self.tabview.tab("Home"), text="")
+        self.connection_label.grid(row=0, column=0, padx=20, pady=(0, 2), sticky="e")
+        self.connected_ports = set()
 
         # Create a status bar for long running processes
         self.progressbar = customtkinter.CTkProgressBar(self)
@@ -170,18 +206,83 @@ class App(customtkinter.CTk):
 
         self.logger.warning('Progress bar started running as indeterminate')
 
+        # The graph is set up once matplotlib has loaded. There is one for all rigs, it draws whichever is selected.
+        self.live_plot = None
+        self.graph_placeholder = customtkinter.CTkLabel(self.tabview.tab("Home"), text="Loading graph...")
+        self.graph_placeholder.grid(row=1, column=0, sticky="nsew")
+        self.loader = threading.Thread(target=self.load_modules, daemon=True, name='loader')
+        self.loader.start()
+        self.after(50, self.finish_startup)
+
         # Schedule the periodic buffer logging
+        self.update_connection_status()
         self.log_buffer_periodically()
-
-        # Set up the graph
-        self.setup_graph()
+        self.log_device_status()
+        self.update_metrics()
+        if scan_for_rigs:
+            self.after(self.RIG_SCAN_INTERVAL, self.scan_for_rigs)
+
+    # The rig the sidebar controls and the graph shows
+    @property
+    def buffer(self):
+        return self.manager[self.selected]
+
+    @property
+    def recorder(self):
+        return self.active_recorders[self.selected]
+
+    @recorder.setter
+    def recorder(self, recorder):
+        self.active_recorders[self.selected] = recorder
+
+    # Function to give a rig its newest saved calibration
+    def load_calibration(self, port, buffer):
+        calibration = self.calibrations.latest(port)
+        if calibration is not None:
+            buffer.set_calibration(calibration)
+            self.logger.info(f"{self.rig_prefix(port)}Calibration {calibration.version} from {calibration.created}")
+
+    def add_recorders(self, port, buffer):
+        csv_recorder = CsvRecorder(buffer.samples, max_bytes=self.RECORDING_MAX_BYTES, metrics=buffer.metrics)
+        session_recorder = SessionRecorder(buffer.samples, max_bytes=self.RECORDING_MAX_BYTES, metrics=buffer.metrics)
+        buffer.command_listeners.append(session_recorder.log_command)
+        self.recorders[port] = {"CSV": csv_recorder, "Session": session_recorder}
+        self.active_recorders[port] = csv_recorder
+
+    # Function to switch the sidebar and graph to another rig
+    def select_rig(self, port):
+        self.selected = port
+        self.generate_csv_button.configure(text="Stop Recording" if self.recorder.recording else "Start Recording")
+        if self.buffer.session.binary:
+            self.binary_switch.select()
+        else:
+            self.binary_switch.deselect()
+        if self.live_plot is not None:
+            self.live_plot.metrics = self.buffer.metrics
+        self.update_profile_button()
+        self.logger.info(f"Showing rig on {port}")
+
+    # Function to add rigs plugged in since the last scan
+    def scan_for_rigs(self):
+        for port in self.manager.discover_new():
+            self.load_calibration(port, self.manager[port])
+            self.add_recorders(port, self.manager[port])
+            if self.live_plot is not None:
+                self.manager[port].add_channels()
+            self.rig_selector.configure(values=list(self.manager))
+            self.logger.info(f"Found a rig on {port}")
+        self.after(self.RIG_SCAN_INTERVAL, self.scan_for_rigs)
+
+    # Prefix for messages about a rig, only needed when there is more than one
+    def rig_prefix(self, port):
+        return f"[{port}] " if len(self.manager) > 1 else ""
 
     def center_geometry(self, width, height):
         ''' Set the window size and center on screen '''
         self.update_idletasks()
         self.geometry(f"{1920}x{1080}")
 
-        print(self.geometry())
+        logging.getLogger(__name__).debug(f"Window geometry {self.geometry()}")  # Runs before self.logger is set up
 
         # Get screen resolution
         screen_width = self.winfo_screenwidth()
@@ -192,26 +293,135 @@ class App(customtkinter.CTk):
 
         self.geometry(f"{width}x{height}+{int(x)}+{int(y)}")
 
-    # Function to generate a CSV file from the buffer
-    def generate_csv(self, filename_entry):
+    # Function to start recording samples to a CSV file, or stop the current recording
+    def toggle_recording(self, filename_entry):
+        if self.recorder.recording:
+            self.recorder.stop()
+            self.generate_csv_button.configure(text="Start Recording")
+            self.logger.info(f"Recorded {self.recorder.rows} samples to {', '.join(self.recorder.files)}")
+            if self.recorder.lost:
+                self.logger.warning(f"{self.recorder.lost} samples were lost while recording")
+            self.catalog_recording(self.recorder.files, self.recording_tags.pop(self.selected, {}))
+            return
+
+        # Sessions are a folder of binary columns, see session.py
+        extension = '.session' if self.format_menu.get() == "Session" else '.csv'
+        self.recorder = self.recorders[self.selected][self.format_menu.get()]
+
         timestamp = time.strftime("%Y%m%d-%H%M%S")
+        # With several rigs, the port goes in the name so recordings from different rigs never collide
+        rig = '_' + re.sub(r'[^A-Za-z0-9]+', '_', self.selected).strip('_') if len(self.manager) > 1 else ''
         if filename_entry:
-            filename = f'{filename_entry}.csv'
+            filename = f'{filename_entry}{rig}{extension}'
         else:
-            filename = f'pillar_puller_{timestamp}.csv'
-    
-        with open(filename, 'w', newline='') as csvfile:
-            writer = csv.writer(csvfile)
-            writer.writerow(['Time', 'Forces', 'Platform Position'])
-            for i in range(len(self.buffer.micros)):
-                writer.writerow([self.buffer.micros[i], self.buffer.forces[i], self.buffer.platformDistances[i]])
-
-    # Function which tells the Teensy to stop the motor.
+            filename = f'pillar_puller_{timestamp}{rig}{extension}'
+
+        self.recording_tags[self.selected] = self.tags()
+        if isinstance(self.recorder, SessionRecorder):
+            self.recorder.metadata = self.recording_tags[self.selected]
+            self.recorder.calibration = self.buffer.calibration.to_dict() # So the session can be recalibrated later
+        try:
+            self.recorder.start(filename)
+        except OSError as e:
+            self.recording_tags.pop(self.selected, None)
+            self.logger.error(f"{self.rig_prefix(self.selected)}Can't record to {filename}: {e}")
+            return
+        self.generate_csv_button.configure(text="Stop Recording")
+        self.logger.info(f"Recording to {self.recorder.filename}")
+        self.after(500, self.watch_recording, self.selected, self.recorder)
+
+    # Function to report a recording that stopped by itself because it couldn't be written
+    def watch_recording(self, port, recorder):
+        if recorder.recording:
+            self.after(500, self.watch_recording, port, recorder)
+            return
+        if port not in self.recording_tags or self.active_recorders.get(port) is not recorder:
+            return  # Stopped with the button
+        recorder.stop()
+        tags = self.recording_tags.pop(port)
+        self.logger.error(f"{self.rig_prefix(port)}Recording stopped: {recorder.error}. {recorder.rows} samples were written to {', '.join(recorder.files)}")
+        if recorder.rows:
+            self.catalog_recording(recorder.files, tags)
+        if port == self.selected:
+            self.generate_csv_button.configure(text="Start Recording")
+
+    # Function to run a test profile on the selected rig, or abort the one that is running
+    def toggle_profile(self):
+        runner = self.profile_runners.get(self.selected)
+        if runner is not None and runner.running:
+            runner.abort()
+            return
+
+        path = tkinter.filedialog.askopenfilename(title="Run test profile", filetypes=[("Test profiles", "*.json *.yaml *.yml"), ("All files", "*.*")])
+        if not path:
+            return
+        try:
+            profile = load_profile(path)
+        except (OSError, ValueError) as e:  # ProfileError and JSON errors are ValueErrors
+            self.logger.error(f"Can't run {path}: {e}")
+            return
+
+        # The log of planned and actual command times goes next to the recordings
+        timestamp = time.strftime("%Y%m%d-%H%M%S")
+        rig = '_' + re.sub(r'[^A-Za-z0-9]+', '_', self.selected).strip('_') if len(self.manager) > 1 else ''
+        log_path = f'profile_{profile["name"]}_{timestamp}{rig}.csv'
+        planned = planned_duration(profile)
+        runner = ProfileRunner(self.buffer, profile, log_path=log_path).start()
+        self.profile_runners[self.selected] = runner
+        self.update_profile_button()
+        self.logger.info(f"{self.rig_prefix(self.selected)}Running profile {profile['name']} ({planned:.0f} s planned), logging to {log_path}")
+        self.after(500, self.watch_profile, self.selected, runner)
+
+    # Function to report when a profile finishes
+    def watch_profile(self, port, runner):
+        if runner.running:
+            self.after(500, self.watch_profile, port, runner)
+            return
+        late = [row['late_ms'] for row in runner.log]
+        summary = f"{len(runner.log)} commands, at most {max(late):.1f} ms late" if late else "no commands sent"
+        if runner.error is not None:
+            self.logger.error(f"{self.rig_prefix(port)}Profile {runner.profile['name']} failed at step {runner.step}: {runner.error}")
+        elif runner.aborted:
+            self.logger.warning(f"{self.rig_prefix(port)}Profile {runner.profile['name']} aborted at step {runner.step}, {summary}")
+        else:
+            self.logger.info(f"{self.rig_prefix(port)}Profile {runner.profile['name']} finished, {summary}, {runner.breaks} breaks")
+        self.update_profile_button()
+
+    def update_profile_button(self):
+        runner = self.profile_runners.get(self.selected)
+        self.profile_button.configure(text="Abort Profile" if runner is not None and runner.running else "Run Profile")
+
+    # Tags stored with a recording of the selected rig in the session catalogue
+    def tags(self):
+        runner = self.profile_runners.get(self.selected)
+        return {
+            'rig': self.selected,
+            'operator': getpass.getuser(),
+            'profile': runner.profile['name'] if runner is not None and runner.running else None,
+        }
+
+    # Function to add finished recordings to the session catalogue, on a thread so a long recording doesn't hold up the GUI
+    def catalog_recording(self, files, tags):
+        def index():
+            try:
+                from catalog import Catalog  # sqlite3 and analyse.py, only needed once something has been recorded
+                with Catalog(self.CATALOG) as catalog:
+                    catalog.index(files, workers=1, **tags)
+                self.logger.info(f"Added {', '.join(files)} to {self.CATALOG}")
+            except Exception as e:
+                self.logger.error(f"Couldn't add {', '.join(files)} to {self.CATALOG}: {e}")
+        threading.Thread(target=index, daemon=True, name='catalog').start()
+
+    # Function which tells the Teensy to stop the motor. A profile running on the rig is aborted too.
     def stop(self):
+        runner = self.profile_runners.get(self.selected)
+        if runner is not None and runner.running:
+            runner.abort()
         self.buffer.send_command("stop")
     
     # Funcion which tells the Teensy to open.
     def open_rig(self):
+        self.buffer.break_detector.reset()
         self.buffer.send_command("open")
     
     # Function which tells the Teensy to close.
@@ -226,139 +436,374 @@ class App(customtkinter.CTk):
     def home(self):
         self.buffer.send_command("home")
 
+    # Function which tells the Teensy to open until the pillar breaks. The host also watches for the break and sends stop.
     def open_until_break(self):
+        self.buffer.break_detector.reset()
+        self.buffer.stop_on_break = True
         self.buffer.send_command("break")
 
     def zero_position(self):
         self.buffer.send_command("zero_position")
 
+    # Function to tare the force on the host: the mean of the last half second reads zero from now on. Saved as a new calibration set.
+    def tare(self):
+        forces, = self.buffer.samples.columns(self.TARE_SAMPLES, ('force',))
+        if len(forces) == 0:
+            self.logger.warning("Nothing to tare on yet, no samples from the rig")
+            return
+        calibration = self.buffer.calibration.with_tare(np.mean(forces))
+        self.calibrations.save(calibration)
+        self.buffer.set_calibration(calibration)
+        self.logger.info(f"{self.rig_prefix(self.selected)}Tared at {np.mean(forces):.3f}, calibration {calibration.version}")
+
+    def toggle_binary_mode(self):
+        self.buffer.set_binary_mode(self.binary_switch.get() == 1)
+
     # Function to log the most recent data point from the buffer periodically
     def log_buffer_periodically(self):
         ''' Log the most recent data point from the buffer periodically '''
-        micros, forces, platformDistances, filtered_forces = self.buffer.get_data()
-        if micros and forces and platformDistances:  # Check if there is data in the buffer
-            self.logger.info(f"Time: {micros[-1]}, Forces: {forces[-1]}, Platform Position: {platformDistances[-1]}, Filtered Forces: {filtered_forces[-1]}")
+        sample = self.buffer.samples.latest()
+        if sample is not None:  # Check if there is data in the buffer
+            self.logger.info(f"Time: {sample['time']}, Forces: {sample['force']}, Platform Position: {sample['position']}, Filtered Forces: {sample['filtered']}")
+        if self.live_plot is not None:
+            self.logger.info(f"Graph: {self.live_plot.fps:.1f} fps, {self.live_plot.decimation:.1f} samples per point, {self.live_plot.full_redraws} full redraws")
+        stop_latencies = self.buffer.session.latencies.get("stop")
+        if stop_latencies:
+            self.logger.info(f"Last stop command written in {stop_latencies[-1] * 1000:.1f} ms")
+        for port, buffer in self.manager.items():
+            if not buffer.session.connected:
+                self.logger.warning(f"Not connected to {port}, retrying")
         self.after(5000, self.log_buffer_periodically)  # Schedule this method to run again after 5000 ms (5 second)
 
+    # Function to log status lines from the Teensy (e.g. "DIAG0 error") to the status window
+    def log_device_status(self):
+        for port, buffer in self.manager.items():
+            while buffer.status_lines:
+                self.logger.info(f"{self.rig_prefix(port)}Device: {buffer.status_lines.popleft()}")
+        self.after(100, self.log_device_status)
+
+    # Function to refresh the Metrics tab, publish the metrics and warn when the host falls behind the Teensy
+    def update_metrics(self):
+        snapshots = {port: buffer.metrics_snapshot() for port, buffer in self.manager.items()}
+        self.metrics_text.configure(state='normal')
+        self.metrics_text.delete("1.0", tkinter.END)
+        self.metrics_text.insert(tkinter.END, format_snapshot(snapshots[self.selected]))
+        self.metrics_text.configure(state='disabled')
+        if self.metrics_server is not None:
+            self.metrics_server.publish(snapshots)
+
+        self.metrics_updates += 1
+        if self.metrics_updates % self.METRICS_LOG_INTERVAL == 0:
+            log_snapshots(self.METRICS_LOG, snapshots)
+
+        for port, snapshot in snapshots.items():
+            total = snapshot['counters'].get('reader.missing_samples', 0)
+            missing = total - self.metrics_missing.get(port, 0)
+            self.metrics_missing[port] = total
+            if missing:
+                self.logger.warning(f"{self.rig_prefix(port)}{missing} samples missing from the Teensy's time stamps in the last second")
+            lost = snapshot['rates'].get('writer.lost', 0)
+            if lost:
+                self.logger.warning(f"{self.rig_prefix(port)}Recorder is falling behind, losing {lost:.0f} samples/s")
+        self.after(1000, self.update_metrics)
+
+    # Function to import the modules the window doesn't need to appear. Runs on the loader thread.
+    def load_modules(self):
+        import matplotlib.pyplot
+        import matplotlib.animation
+        import matplotlib.backends.backend_tkagg
+        import dsp
+        import history
+        import compare
+
+    # Function to set up what had to wait for load_modules, and report how long start up took
+    def finish_startup(self):
+        if self.loader.is_alive():
+            self.after(50, self.finish_startup)
+            return
+        for buffer in self.manager.rigs.values():
+            buffer.add_channels()
+        self.setup_graph()
+        self.setup_history()
+        self.setup_compare()
+        self.startup.mark('graph shown')
+        self.startup.uninstall()
+        for line in self.startup.report():
+            self.logger.info(line)
+
+    # Function to show whether the selected rig is connected, and log when each rig connects
+    def update_connection_status(self):
+        session = self.buffer.session
+        if session.connected:
+            self.connection_label.configure(text=f"Connected to {session.port}")
+        elif session.ever_connected:
+            self.connection_label.configure(text=f"Lost {session.port}, reconnecting...")
+        else:
+            self.connection_label.configure(text=f"Connecting to {session.port}...")
+        for port, buffer in self.manager.items():
+            if buffer.session.connected and port not in self.connected_ports:
+                self.connected_ports.add(port)
+                self.logger.info(f"Connected to {port} after {time.perf_counter() - self.startup.start:.2f} s")
+        self.after(250, self.update_connection_status)
+
     # Function to set up the graph
     def setup_graph(self):
+        import matplotlib.pyplot as plt
+        from matplotlib.animation import FuncAnimation
+        from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
+
+        self.graph_placeholder.destroy()
         self.fig, self.ax = plt.subplots()
         self.ax.set_aspect('auto')
         self.line1, = self.ax.plot([], [], label='Platform Distances')
         self.line2, = self.ax.plot([], [], label='Forces')
         self.line3, = self.ax.plot([], [], label='Filtered Forces')  # Add line for filtered forces
+        self.line4, = self.ax.plot([], [], label='Host Filtered Forces')
         self.ax.legend(loc='upper left')
         self.ax.set_title('Pillar Puller Data')
+        self.ax.set_xlabel('Samples ago')
 
         self.canvas = FigureCanvasTkAgg(self.fig, master=self.tabview.tab("Home"))
-        self.canvas.get_tk_widget().grid(row=0, column=0, sticky="nsew")
-
-
-        self.micros = []
-        self.forces = []
-        self.platformDistances = []
-        self.filtered_forces = []
-        self.counter = 0
-
-        self.ani = FuncAnimation(self.fig, self.animate, interval=10, blit=True)
-
-    # Function to animate the graph
-    def animate(self, frame):
-        micros, forces, platformDistances, filtered_forces = self.buffer.get_data()
-
-        if len(micros) > 0 and len(forces) > 0 and len(platformDistances) > 0:
-            current_time = micros[-1]
-            force = forces[-1]
-            platform_distance = platformDistances[-1]
-            filtered_force = filtered_forces[-1]
-
-            self.counter += 1
-
-            if self.counter % 2 == 0:
-                self.micros.append(current_time)
-                self.forces.append(force)
-                self.platformDistances.append(platform_distance)
-                self.filtered_forces.append(filtered_force)
-
-                max_points = 40 # Adjust this value to see how many points u want to plot on the graph / modulus value
-                length = max(min(len(self.micros), max_points), 1)
-
-                self.micros = self.micros[-length:]
-                self.forces = self.forces[-length:]
-                self.platformDistances = self.platformDistances[-length:]
-                self.filtered_forces = self.filtered_forces[-length:]
-
-                self.line1.set_ydata(self.platformDistances)
-                self.line2.set_ydata(self.forces)
-                self.line3.set_ydata(self.filtered_forces)
-
-                if length <= max_points:
-                    xs = list(range(0, length))
-                    if length > 1:
-                        self.ax.set_xlim(0, length - 1)
-                    else:
-                        self.ax.set_xlim(-0.5, 0.5)
-                    self.line1.set_xdata(xs)
-                    self.line2.set_xdata(xs)
-                    self.line3.set_xdata(xs)
-
-                ymin = float("inf")
-                ymax = float("-inf")
-                for line in [self.line1, self.line2, self.line3]:
-                    a = line.get_alpha()
-                    if a is None or a > 0:
-                        lmin = np.min(line.get_ydata())
-                        lmax = np.max(line.get_ydata())
-                        if lmin < ymin:
-                            ymin = lmin
-                        if lmax > ymax:
-                            ymax = lmax
-
-                yrange = ymax - ymin
-                self.ax.set_ylim(ymin - 0.1 * yrange, ymax + 0.1 * yrange)
-        return self.line1, self.line2, self.line3
+        self.canvas.get_tk_widget().grid(row=1, column=0, sticky="nsew")
+
+        self.live_plot = LivePlot(self.ax, [self.line1, self.line2, self.line3, self.line4], self.get_plot_columns, window=self.PLOT_WINDOW, metrics=self.buffer.metrics)
+        self.ani = FuncAnimation(self.fig, self.live_plot.update, interval=10, blit=True, cache_frame_data=False)
+
+    # Function to set up the History tab, which shows finished recordings of any length
+    def setup_history(self):
+        import matplotlib.pyplot as plt
+        from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg, NavigationToolbar2Tk
+        from history import HistoryViewer
+
+        tab = self.tabview.tab("History")
+        self.history_button = customtkinter.CTkButton(tab, text="Open Recording", command=self.open_history)
+        self.history_button.grid(row=0, column=0, padx=20, pady=(0, 2), sticky="w")
+        self.history_label = customtkinter.CTkLabel(tab, text="Scroll to zoom, drag with the pan tool to move")
+        self.history_label.grid(row=0, column=1, padx=20, pady=(0, 2), sticky="w")
+
+        self.history_fig, self.history_ax = plt.subplots()
+        self.history_canvas = FigureCanvasTkAgg(self.history_fig, master=tab)
+        self.history_canvas.get_tk_widget().grid(row=1, column=0, columnspan=2, sticky="nsew")
+        self.history_toolbar = NavigationToolbar2Tk(self.history_canvas, tab, pack_toolbar=False)
+        self.history_toolbar.grid(row=2, column=0, columnspan=2, sticky="ew")
+        self.history_viewer = HistoryViewer(self.history_ax)
+
+    # Function to open a CSV file or session for the History tab. Converting and indexing a long one the
+    # first time takes a while, so it is done on a thread.
+    def open_history(self):
+        path = tkinter.filedialog.askopenfilename(title="Open recording", filetypes=[("Recordings", "*.csv meta.json"), ("All files", "*.*")])
+        if not path:
+            return
+        if os.path.basename(path) == 'meta.json':  # A session is a directory, open it by its meta.json
+            path = os.path.dirname(path)
+        from history import load_history
+        result = {}
+        def load():
+            try:
+                result['history'] = load_history(path)
+            except Exception as e:
+                result['error'] = e
+        thread = threading.Thread(target=load, daemon=True, name='history')
+        thread.start()
+        self.history_button.configure(state="disabled")
+        self.history_label.configure(text=f"Opening {os.path.basename(path)}...")
+        self.after(100, self.show_history, thread, result, path)
+
+    def show_history(self, thread, result, path):
+        if thread.is_alive():
+            self.after(100, self.show_history, thread, result, path)
+            return
+        self.history_button.configure(state="normal")
+        if 'error' in result:
+            self.history_label.configure(text="")
+            self.logger.error(f"Can't open {path}: {result['error']}")
+            return
+        session, pyramid = result['history']
+        self.history_viewer.show(session, pyramid)
+        self.history_toolbar.update()  # Home goes back to the whole recording
+        self.history_label.configure(text=f"{session.path}: {len(session):,} samples")
+        self.tabview.set("History")
+
+    # Function to set up the Compare tab, which overlays many pulls lined up on contact or break
+    def setup_compare(self):
+        import matplotlib.pyplot as plt
+        from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg, NavigationToolbar2Tk
+        from compare import ALIGN_EVENTS, AXES
+
+        tab = self.tabview.tab("Compare")
+        self.compare_button = customtkinter.CTkButton(tab, text="Compare Recordings", command=self.open_comparison)
+        self.compare_button.grid(row=0, column=0, padx=20, pady=(0, 2), sticky="w")
+        self.compare_align_menu = customtkinter.CTkOptionMenu(tab, values=list(ALIGN_EVENTS), command=lambda value: self.run_comparison())
+        self.compare_align_menu.grid(row=0, column=1, padx=(0, 10), pady=(0, 2), sticky="w")
+        self.compare_axis_menu = customtkinter.CTkOptionMenu(tab, values=list(AXES), command=lambda value: self.run_comparison())
+        self.compare_axis_menu.grid(row=0, column=2, padx=(0, 10), pady=(0, 2), sticky="w")
+        self.compare_label = customtkinter.CTkLabel(tab, text="Line pulls up on contact, break or their start")
+        self.compare_label.grid(row=0, column=3, padx=20, pady=(0, 2), sticky="w")
+
+        self.compare_fig, self.compare_ax = plt.subplots()
+        self.compare_canvas = FigureCanvasTkAgg(self.compare_fig, master=tab)
+        self.compare_canvas.get_tk_widget().grid(row=1, column=0, columnspan=4, sticky="nsew")
+        self.compare_toolbar = NavigationToolbar2Tk(self.compare_canvas, tab, pack_toolbar=False)
+        self.compare_toolbar.grid(row=2, column=0, columnspan=4, sticky="ew")
+        self.compare_paths = []
+
+    def open_comparison(self):
+        paths = tkinter.filedialog.askopenfilenames(title="Compare recordings", filetypes=[("Recordings", "*.csv meta.json"), ("All files", "*.*")])
+        if not paths:
+            return
+        self.compare_paths = [os.path.dirname(path) if os.path.basename(path) == 'meta.json' else path for path in paths]
+        self.run_comparison()
+
+    # Function to align the chosen recordings on a thread. Only the ones not in the cache are read.
+    def run_comparison(self):
+        if not self.compare_paths or str(self.compare_button.cget("state")) == "disabled":
+            return
+        from compare import compare
+        align, axis = self.compare_align_menu.get(), self.compare_axis_menu.get()
+        result = {}
+        def load():
+            try:
+                result['comparison'] = compare(self.compare_paths, align, axis)
+            except Exception as e:
+                result['error'] = e
+        thread = threading.Thread(target=load, daemon=True, name='compare')
+        thread.start()
+        self.compare_button.configure(state="disabled")
+        self.compare_label.configure(text=f"Aligning {len(self.compare_paths)} recordings on {align}...")
+        self.after(100, self.show_comparison, thread, result)
+
+    def show_comparison(self, thread, result):
+        if thread.is_alive():
+            self.after(100, self.show_comparison, thread, result)
+            return
+        self.compare_button.configure(state="normal")
+        if 'error' in result:
+            self.compare_label.configure(text="")
+            self.logger.error(f"Can't compare those recordings: {result['error']}")
+            return
+        comparison, aligned = result['comparison']
+        self.compare_ax.clear()
+        if len(comparison.paths):
+            comparison.plot(self.compare_ax)
+        self.compare_canvas.draw_idle()
+        self.compare_toolbar.update()
+        skipped = f", {len(comparison.skipped)} without a {comparison.align}" if comparison.skipped else ""
+        self.compare_label.configure(text=f"{len(comparison.paths)} pulls ({aligned} aligned, the rest cached){skipped}")
+
+    # Function returning the columns drawn by the graph, in the same order as its lines
+    def get_plot_columns(self, n):
+        channels = self.buffer.channels
+        if 'calibrated' not in channels:
+            micros, forces, platformDistances, filtered_forces = self.buffer.get_data(n)
+            return platformDistances, forces, filtered_forces, forces[:0]
+        micros, forces, platformDistances, filtered_forces = channels['calibrated'].columns(n)
+        smooth_micros, smooth_forces, smooth_filtered = channels['smooth'].columns(n)
+        return platformDistances, forces, filtered_forces, smooth_forces
 
     def on_closing(self):
-        self.buffer.ser.close()  # Close the serial port
+        for runner in self.profile_runners.values():
+            runner.abort()  # Each sends stop to its rig
+            runner.join(2.0)
+        for recorder in self.active_recorders.values():
+            recorder.stop()  # Finish writing the current recordings
+        self.manager.close()  # Stop the readers and writers, close the serial ports and delete the spill (see --keep-spill)
+        if self.metrics_server is not None:
+            self.metrics_server.close()
 
-### WARNING: This is not thread safe. Look at https://github.com/beenje/tkinter-logging-text-widget for a thread-safe logger
 class TextHandler(logging.Handler):
-    """This class allows you to log to a Tkinter Text or ScrolledText widget"""
-    def __init__(self, text, formatter=None):
+    """This class allows you to log to a Tkinter Text or ScrolledText widget from any thread.
+
+    emit() only queues the record, and a message that is already queued just has its
+    count bumped. The Tk thread drains the queue every interval ms and inserts up to
+    max_batch messages at once, repeats shown once with a count, and the widget keeps at
+    most max_lines lines. Past max_queued different messages the rest are counted instead
+    of shown, so a flood of log messages can't starve the graph or the buttons.
+    """
+    def __init__(self, text, formatter=None, interval=100, max_batch=200, max_lines=2000, max_queued=5000):
         logging.Handler.__init__(self)
-        
+
         self.text = text # Destination Text or ScrolledText widget
+        self.interval = interval
+        self.max_batch = max_batch
+        self.max_lines = max_lines
+        self.max_queued = max_queued
+        self.queued = {} # (level, message) -> [first record, count], oldest first
+        self.dropped = 0 # Records that did not fit in the queue since the last batch
 
         if formatter is not None:
             self.setFormatter(formatter)
-        
 
+        self.text.after(self.interval, self.poll)
+
+    # Called by logging.Handler.handle with self.lock held
     def emit(self, record):
-        msg = self.format(record)
-        def append():
+        key = (record.levelno, record.getMessage())
+        entry = self.queued.get(key)
+        if entry is not None:
+            entry[1] += 1
+        elif len(self.queued) < self.max_queued:
+            self.queued[key] = [record, 1]
+        else:
+            self.dropped += 1
+
+    # Runs on the Tk thread: insert what was queued since the last poll as one batch
+    def poll(self):
+        self.acquire()
+        try:
+            keys = list(itertools.islice(self.queued, self.max_batch))
+            batch = [self.queued.pop(key) for key in keys]
+            dropped, self.dropped = self.dropped, 0
+        finally:
+            self.release()
+
+        lines = []
+        for record, count in batch:
+            msg = self.format(record)
+            lines.append(msg if count == 1 else f"{msg} (x{count})")
+        if dropped:
+            lines.append(f"... {dropped} log messages dropped, logging faster than the status window can show")
+
+        if lines:
             self.text.configure(state='normal')
-            self.text.insert(tkinter.END, msg + '\n')
+            self.text.insert(tkinter.END, '\n'.join(lines) + '\n')
+            # Keep the last max_lines lines
+            excess = int(self.text.index('end-1c').split('.')[0]) - 1 - self.max_lines
+            if excess > 0:
+                self.text.delete("1.0", f"{excess + 1}.0")
             self.text.configure(state='disabled')
             # Autoscroll to the bottom
             self.text.yview(tkinter.END)
 
-        # This is necessary because we can't modify the Text from other threads
-        self.text.after(0, append)
+        self.text.after(self.interval, self.poll)
 
 if __name__ == "__main__":
     # [Optional] Set up the console logger
     logging.basicConfig(format="%(asctime)s %(levelname)s %(message)s", 
                         datefmt="%Y-%m-%d %I:%M:%S%p", 
                         level=logging.INFO)
-    buffer = serialBuffer()
-
-    # Populate the buffer in a separate thread
-    populate_thread = threading.Thread(target=buffer.populate)  # Create a thread to populate the buffer
-    populate_thread.daemon = True
-    populate_thread.start()
-
-    app = App(buffer)
+    arg_parser = argparse.ArgumentParser(description="Contactile pillar puller GUI")
+    arg_parser.add_argument('--port', action='append', help="serial port of a rig (or of simulator.py), repeat for several rigs. "
+                            "Default: every Teensy plugged in, found by USB id")
+    arg_parser.add_argument('--metrics-port', type=int, help="serve the metrics as JSON on http://127.0.0.1:PORT/metrics")
+    arg_parser.add_argument('--in-process', action='store_true', help="read the serial ports on threads of the GUI process "
+                            "instead of a worker process per rig")
+    arg_parser.add_argument('--spill-dir', default=serialBuffer.SPILL_DIR, help="where samples that no longer fit in memory are "
+                            "kept while running, to recover them after a crash (default: %(default)s)")
+    arg_parser.add_argument('--keep-spill', action='store_true', help="keep the spill when closing cleanly instead of deleting it")
+    args = arg_parser.parse_args()
+
+    manager = DeviceManager(lambda port: serialBuffer(port, in_process=args.in_process, spill_dir=args.spill_dir, keep_spill=args.keep_spill))
+    ports = args.port or discover()
+    if not ports:
+        logging.warning(f"No rigs found by USB id, trying {serialBuffer.SERIAL_PORT}")
+        ports = [serialBuffer.SERIAL_PORT]
+    for port in ports:
+        manager.add(port)
+    metrics_server = MetricsServer(args.metrics_port).start() if args.metrics_port else None
+
+    # Connect and populate the buffers in the background
+    manager.start()
+
+    app = App(manager, metrics_server, scan_for_rigs=not args.port, startup=startup)
     app.mainloop()
-    app.on_closing()
-
-    buffer.ser.close()
\ No newline at end of file
+    app.on_closing()
\ No newline at end of file
@@ -0,0 +1,193 @@
+import argparse
+from collections import deque
+import numpy as np
+from metrics import SampleClock
+
+# The Teensy's time stamps, made safe to store and compare.
+#
+#   python timebase.py pillar_puller_20240826-124612.csv 270824.csv
+#
+# The time column is the Teensy's millis() (main.cpp), or micros() in recordings made with the
+# older PillarPuller.ino: an unsigned 32 bit counter that wraps (every 71 minutes in micros(),
+# 49 days in millis()) and starts again from zero when the Teensy restarts. Which of the two a
+# stream counts is worked out from its time stamps (detect_units), and sessions store it in
+# meta.json as time_units, units per second. DeviceClock sits between the decoder and the buffer and turns it into
+# one count that only goes up, kept as int64 in the ring buffer and sessions. It also counts
+# what is wrong with the stream (gaps, repeated time stamps, wraps, restarts) and attaches
+# the host time each block was read, so a recording says when its samples reached the host.
+#
+# From those host times it follows how far the Teensy's crystal drifts from the host's clock:
+# the host time minus the device time of a block is the clock offset plus however long the
+# block took to arrive, so the least of it over DRIFT_WINDOW seconds is close to the offset
+# alone. A line through the last DRIFT_WINDOWS of those minima gives the drift, and how far a
+# block is above that line is its latency.
+WRAP = 2 ** 32  # micros() and millis() are uint32
+WRAP_GAP = 60.0  # Seconds: a step back is a wrap if, with the wrap added, it is a step forward of less than this
+DRIFT_WINDOW = 10.0  # Seconds of host time per minimum offset
+DRIFT_WINDOWS = 60  # Minima the drift is fitted to, 10 minutes
+MICROS, MILLIS = 1e6, 1e3  # Units per second of micros() and millis()
+FIRMWARE_UNITS = MILLIS  # main.cpp stamps samples with millis()
+MILLIS_MAX_STEP = 50  # A typical step between samples this small is millis(): as micros() it would be over 20 kHz
+DETECT_SAMPLES = 32  # Time stamps DeviceClock looks at before it decides the units
+
+# Function returning the units per second of a time column from its typical step between samples:
+# millis() if it is a few units, micros() if it is hundreds. default if there are no steps to go by.
+def detect_units(times, default=FIRMWARE_UNITS):
+    steps = np.diff(np.asarray(times, dtype=np.float64))
+    steps = steps[steps > 0]  # Repeats, wraps and restarts say nothing about the units
+    if len(steps) == 0:
+        return default
+    return MILLIS if np.median(steps) <= MILLIS_MAX_STEP else MICROS
+
+class DeviceClock():
+    ''' Unwraps the time column of blocks from the decoder and keeps track of the device clock.
+
+    feed(samples, received) returns the block with the time column unwrapped and a column of
+    the host time it was received appended. After a restart the count carries on one sample
+    interval after the last time stamp, so times never go backwards within a stream.
+    If units_per_second isn't given it is worked out from the first DETECT_SAMPLES time
+    stamps; until then there is no drift or latency.
+    '''
+    def __init__(self, units_per_second=None, wrap=WRAP, window=DRIFT_WINDOW, windows=DRIFT_WINDOWS):
+        self.units_per_second = units_per_second  # 1e3 for millis(), 1e6 for micros(), None until detected
+        self.wrap = wrap
+        self.window = window
+        self.gaps = SampleClock()  # Learns the sample interval and counts the samples missing from gaps
+        self.duplicates = 0  # Samples with the same time stamp as the one before
+        self.wraps = 0
+        self.restarts = 0  # Time stamps that went backwards without wrapping: the Teensy restarted
+        self.drift = None  # Device clock rate minus host clock rate, in parts per million (positive: the Teensy runs fast)
+        self.latency = None  # Seconds the last block arrived after the quickest blocks, None until the offset is known
+        self._offset = 0  # Added to the raw time stamps
+        self._last_raw = None
+        self._minima = deque(maxlen=windows)  # (host time, least host - device seconds) of each finished window
+        self._window_start = None
+        self._window_min = None
+        self._fit = None  # (host time, offset at that time, slope) of the line through the minima
+        self._first = []  # Raw time stamps kept until the units are known
+
+    @property
+    def missing(self):
+        return self.gaps.missing
+
+    # Function to unwrap a block of (n, columns) samples. Returns an (n, columns + 1) block, the last column received.
+    def feed(self, samples, received):
+        samples = np.asarray(samples, dtype=np.float64)
+        out = np.empty((len(samples), samples.shape[1] + 1))
+        out[:, :-1] = samples
+        out[:, -1] = received
+        if len(samples) == 0:
+            return out
+        raw = np.rint(samples[:, 0]).astype(np.int64)
+        if self.units_per_second is None:
+            self._first.extend(raw[:DETECT_SAMPLES].tolist())
+            if len(self._first) >= DETECT_SAMPLES:
+                self.units_per_second = detect_units(self._first)
+                self._first = []
+        first = self._last_raw is None
+        steps = np.diff(raw, prepend=raw[0] if first else self._last_raw)
+        self._last_raw = int(raw[-1])
+        back = np.flatnonzero(steps < 0)
+        if len(back):
+            # A wrap goes from near the top of the counter to near zero, anything else backwards is a restart
+            wrapped = steps[back] + self.wrap <= WRAP_GAP * (self.units_per_second or FIRMWARE_UNITS)
+            interval = int(round(self.gaps.interval)) if self.gaps.interval else 1
+            adjust = np.zeros(len(raw), dtype=np.int64)
+            adjust[back] = np.where(wrapped, self.wrap, interval - steps[back])
+            self.wraps += int(np.count_nonzero(wrapped))
+            restarts = int(np.count_nonzero(~wrapped))
+            if restarts:
+                self.restarts += restarts
+                self._reset_drift()  # The offset between the clocks is a new one
+            offsets = self._offset + np.cumsum(adjust)
+            self._offset = int(offsets[-1])
+            times = raw + offsets
+        else:
+            times = raw + self._offset
+        self.duplicates += int(np.count_nonzero(steps == 0)) - (1 if first else 0)
+        self.gaps.feed(times)
+        out[:, 0] = times
+        if self.units_per_second is not None:
+            self._follow(float(received), float(times[-1]) / self.units_per_second)
+        return out
+
+    def _follow(self, received, device_seconds):
+        offset = received - device_seconds
+        if self._window_start is None:
+            self._window_start, self._window_min = received, (received, offset)
+        elif offset < self._window_min[1]:
+            self._window_min = (received, offset)
+        if received - self._window_start >= self.window:
+            self._minima.append(self._window_min)
+            self._window_start, self._window_min = received, (received, offset)
+            if len(self._minima) >= 3:
+                hosts, offsets = np.array(self._minima).T
+                slope, intercept = np.polyfit(hosts - hosts[-1], offsets, 1)
+                self._fit = (hosts[-1], intercept, slope)
+                self.drift = -slope * 1e6
+        if self._fit is not None:
+            at, intercept, slope = self._fit
+            self.latency = max(offset - (intercept + slope * (received - at)), 0.0)
+        else:
+            self.latency = offset - min([self._window_min[1]] + [o for h, o in self._minima])
+
+    def _reset_drift(self):
+        self._minima.clear()
+        self._window_start = self._window_min = self._fit = None
+        self.latency = None
+
+# Function to unwrap a whole recording's time column at once. Returns (int64 times, DeviceClock with the counts).
+def unwrap(times, units_per_second=None):
+    times = np.asarray(times, dtype=np.float64)
+    clock = DeviceClock(detect_units(times) if units_per_second is None else units_per_second)
+    block = clock.feed(times.reshape(-1, 1), 0.0)
+    return block[:, 0].astype(np.int64), clock
+
+# Function to describe the time stamps of a recording: its length, rate, gaps, repeats, wraps and restarts,
+# and if it has the host's receive times, the drift and latency.
+def timing_report(samples):
+    times = np.asarray(samples['time'], dtype=np.float64)
+    if len(times) < 2:
+        return {'samples': len(times)}
+    units = detect_units(times)
+    unwrapped, clock = unwrap(times, units)
+    report = {
+        'samples': len(times),
+        'units': 'ms' if units == MILLIS else 'us',
+        'duration_s': float(unwrapped[-1] - unwrapped[0]) / units,
+        'interval': clock.gaps.interval,
+        'rate_hz': units / clock.gaps.interval if clock.gaps.interval else None,
+        'gaps': clock.gaps.gaps,
+        'missing': clock.missing,
+        'missing_fraction': clock.missing / (len(times) + clock.missing),
+        'duplicates': clock.duplicates,
+        'wraps': clock.wraps,
+        'restarts': clock.restarts,
+    }
+    if 'received' in samples.dtype.names:
+        received = np.asarray(samples['received'], dtype=np.float64)
+        if np.any(received > 0):
+            # Blocks were read at once, so every sample of one has the same receive time: feed them a block at a time
+            clock = DeviceClock(units)
+            starts = np.flatnonzero(np.diff(received, prepend=-1.0) != 0)
+            latencies = []
+            for start, stop in zip(starts, np.append(starts[1:], len(times))):
+                clock.feed(times[start:stop].reshape(-1, 1), received[start])
+                if clock.latency is not None:
+                    latencies.append(clock.latency)
+            report['drift_ppm'] = clock.drift
+            if latencies:
+                report['latency_p50_ms'], report['latency_p99_ms'] = (float(v) * 1000 for v in np.percentile(latencies, [50, 99]))
+    return report
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Check the time stamps of recordings for gaps, repeats, wraps and restarts")
+    arg_parser.add_argument('recordings', nargs='+', help="CSV files or session directories")
+    args = arg_parser.parse_args()
+
+    from session import load
+    for path in args.recordings:
+        report = timing_report(load(path))
+        print(path)
+        for name, value in report.items():
+            print(f'  {name:18} {value:,.4g}' if isinstance(value, float) else f'  {name:18} {value}')
@@ -27,6 +27,21 @@ int switchState;
 float mass;
 float platformTravel;
 
+// Binary telemetry. Off by default, the host turns it on with the "binary" command.
+// Frame layout must match FRAME_DTYPE in telemetry.py.
+#define FRAME_SYNC 0xA55A
+struct __attribute__((packed)) TelemetryFrame {
+  uint16_t sync;
+  uint16_t seq;
+  uint32_t time;
+  float force;
+  float position;
+  float filtered;
+  uint16_t crc;
+};
+bool binaryMode = false;
+uint16_t frameSeq = 0;
+
 // Bounce2 library button initialization
 // INSTANTIATE A Button OBJECT
 Bounce2::Button limitSwitch = Bounce2::Button();
@@ -62,6 +77,32 @@ class LowPassFilter {
     float _filtered_value;
 };
 
+// CRC-16/CCITT-FALSE, polynomial 0x1021, initial value 0xFFFF.
+uint16_t crc16(const uint8_t *data, size_t length) {
+  uint16_t crc = 0xFFFF;
+  for (size_t i = 0; i < length; i++) {
+    crc ^= (uint16_t)data[i] << 8;
+    for (uint8_t bit = 0; bit < 8; bit++) {
+      crc = (crc & 0x8000) ? (crc << 1) ^ 0x1021 : crc << 1;
+    }
+  }
+  return crc;
+}
+
+// Function to send one sample as a binary frame.
+void writeFrame(uint32_t time, float force, float position, float filtered) {
+  TelemetryFrame frame;
+  frame.sync = FRAME_SYNC;
+  frame.seq = frameSeq++;
+  frame.time = time;
+  frame.force = force;
+  frame.position = position;
+  frame.filtered = filtered;
+  // The CRC covers everything between the sync word and the CRC itself.
+  frame.crc = crc16((const uint8_t *)&frame.seq, sizeof(frame) - 2 * sizeof(uint16_t));
+  Serial.write((const uint8_t *)&frame, sizeof(frame));
+}
+
 // Function to read and print data
 void readAndPrintData() {
   int32_t val = nau.read();
@@ -72,6 +113,11 @@ void readAndPrintData() {
   float filtered_mass = mass * a + (previous_filtered_mass * (1-a));
   previous_filtered_mass = filtered_mass;
 
+  if (binaryMode) {
+    writeFrame(millis(), mass, platformTravel, filtered_mass);
+    return;
+  }
+
   // Print the values in serial format
   Serial.print(millis());
   Serial.print(",");
@@ -229,6 +275,14 @@ void processCommand(String command) {
   } else if (command.startsWith("zero_position")) {
     SerialUSB1.println("Setting the current position to 0.");
     stepper.setCurrentPosition(0);
+  } else if (command.startsWith("binary")) {
+    // The host switches decoders at this line, so print it before the first frame.
+    Serial.println("BINARY ON");
+    frameSeq = 0;
+    binaryMode = true;
+  } else if (command.startsWith("ascii")) {
+    binaryMode = false;
+    Serial.println("ASCII ON");
   } else {
     Serial.println("Invalid command");
   }